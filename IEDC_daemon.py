@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a long-lived worker that validates and uploads candidate files, or hands it a job. The worker keeps pandas,
+openpyxl, the database connection, and the reference tables loaded, so small files are processed without the startup
+cost of a new process. Jobs and results are exchanged over a spool directory, see `IEDC_tools.daemon`.
+
+Usage example:
+    python IEDC_daemon.py --spool ./spool --workers 4
+    python IEDC_daemon.py --spool ./spool --submit validate my_data.xlsx --wait
+    python IEDC_daemon.py --spool ./spool --submit upload my_data.xlsx --path ./candidates --replace
+"""
+import argparse
+import json
+
+from IEDC_tools import daemon
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--spool', required=True, help="Spool directory of the worker")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of jobs processed at the same time. Uploads still run one at a time.")
+    parser.add_argument('--snapshot', default=None,
+                        help="Serve the reference tables from this local snapshot instead of the database")
+    parser.add_argument('--submit', nargs=2, metavar=('ACTION', 'FILE'), default=None,
+                        help="Don't run the worker, submit a job to it instead. ACTION: validate or upload")
+    parser.add_argument('--path', default=None, help="Job: directory of the file. Default: IEDC_paths.candidates")
+    parser.add_argument('--replace', action='store_true', help="Upload job: replace the dataset if it exists")
+    parser.add_argument('--update', action='store_true', help="Upload job: update the dataset if it exists")
+    parser.add_argument('--wait', action='store_true', help="Job: wait for the result and print it")
+    args = parser.parse_args()
+
+    if args.submit is None:
+        daemon.serve(args.spool, workers=args.workers, snapshot_path=args.snapshot)
+    else:
+        action, file = args.submit
+        options = {'replace': args.replace, 'update': args.update} if action == 'upload' else {}
+        job_id = daemon.submit(args.spool, action, file, path=args.path, **options)
+        print("Submitted job %s" % job_id)
+        if args.wait:
+            print(json.dumps(daemon.wait_for(args.spool, job_id), indent=1))
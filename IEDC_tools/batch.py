@@ -0,0 +1,534 @@
+"""
+Batch ingestion of a directory of candidate files, both LIST and TABLE type.
+
+Every file goes through three stages:
+ 1. parse: read metadata and data from the Excel file. Runs in a process pool, as reading Excel files is slow and
+    CPU bound.
+ 2. validate: run the upload checks, see `validate.dry_run_checks()`. Can use a local snapshot of the reference tables.
+ 3. write: a single writer creates custom classifications, users, licences and the catalog entry and resolves the data.
+    The data of small datasets is grouped, as Arrow tables (see `columnar`), and inserted together. The data inserts can
+    run in several threads and database connections at once. Files whose data are identical to a dataset in the
+    database, or to another file of the batch, are skipped before anything is written, see `fingerprint`.
+
+An error in one file does not stop the batch. It is recorded in the summary report instead.
+"""
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+from IEDC_tools import catalog, checkpoint, classifications, columnar, dbio, file_io, fingerprint, integrity, lazy, \
+    profiling, snapshot, validate
+
+pd = lazy.lazy_import('pandas')
+IEDC_paths = lazy.lazy_import('IEDC_paths')
+
+# Number of files whose custom classifications are registered together, see `validate.register_custom_classifications()`
+REGISTER_FILES = 20
+
+
+def parse_file(file, path=None):
+    """
+    Parse stage: reads a candidate file. Needs no database connection.
+
+    :param file: Filename of the file to process
+    :param path: Path of the file. Default: IEDC_paths.candidates
+    :return: Dictionary with the file's metadata, aspects table, and data
+    """
+    if path is None:
+        path = IEDC_paths.candidates
+    file_meta = file_io.read_candidate_meta(file, path=path)
+    aspect_table = validate.create_aspects_table(file_meta)
+    if file_meta['data_type'] == 'LIST':
+        file_data = file_io.read_candidate_data_list(file, path)
+    else:
+        file_data = file_io.read_candidate_data_table(file, aspect_table, path)
+    return {'file': file,
+            'file_meta': file_meta,
+            'aspect_table': aspect_table,
+            'file_data': file_data}
+
+
+def _parse_file_timed(file, path, profile=None):
+    if profile is not None:
+        # Worker processes have their own profiling state
+        profiling.enable(**profile)
+        profiling.start_file(file)
+    start = time.time()
+    parsed = parse_file(file, path)
+    parsed['parse_s'] = time.time() - start
+    if profile is not None:
+        parsed['profile'] = profiling.get_report()['stages']
+    return parsed
+
+
+def run(path=None, files=None, exclude=(), workers=None, upload=True, replace=False, update=False,
+        snapshot_path=None, group_rows=50000, report=None, profile_dir=None, threads=1, skip_identical=True,
+        bulk_load=False, clear_cache=True, parsed=None, spill_dir=None):
+    """
+    Parses, validates, and uploads all candidate files in a directory.
+
+    :param path: Directory of the candidate files. Default: IEDC_paths.candidates
+    :param files: List of filenames to process. Default: all candidate files in `path`
+    :param exclude: List of filenames to skip
+    :param workers: Number of parser processes. None: number of CPUs, 0: parse in this process
+    :param upload: If False, stop after the validation stage (dry run)
+    :param replace: Replace datasets that are already in the database. Otherwise they are skipped. Datasets whose
+        upload was interrupted are resumed in either case, see `validate.upload_incomplete()`.
+    :param update: Update datasets that are already in the database with the rows that changed, see
+        `validate.update_data()`. Otherwise they are skipped.
+    :param snapshot_path: Validate against a local snapshot of the reference tables, see `snapshot.export_snapshot()`
+    :param group_rows: Data of datasets is collected until this many rows are reached and then inserted together
+    :param report: Write the summary report to this CSV file
+    :param profile_dir: Write a profiling report per file to this directory, see `profiling`. The reports are written
+        at the end of the batch and cover all stages of the file, including the write stage. Stages done for several
+        files at once, e.g. grouped inserts, are in the reports of each of them, with the time divided evenly.
+    :param threads: Number of threads, i.e. database connections, inserting the data of different datasets
+        concurrently. Catalog entries and custom classifications are always created one at a time.
+    :param skip_identical: Skip files with the same data as a dataset in the database or an earlier file of the batch,
+        see `fingerprint`. Their status is 'identical'.
+    :param bulk_load: Upload large datasets in a bulk load session, see `checkpoint.upload_checkpointed()`. The grouped
+        inserts of small datasets are not affected.
+    :param clear_cache: Empty the classification store first, see `classifications`. A long-running caller that keeps
+        it up to date, e.g. `daemon`, can skip this.
+    :param parsed: Dictionary of filename: files that were parsed already, see parse_file(). They are not read again.
+    :param spill_dir: Large datasets are inserted from a memory-mapped file in this directory, see
+        `checkpoint.upload_checkpointed()`
+    :return: Summary report as dataframe, one row per file. `insert_s` and `rows_per_s` refer to the data insert.
+    """
+    if path is None:
+        path = IEDC_paths.candidates
+    if files is None:
+        files = file_io.get_candidate_filenames(path, verbose=1)
+    files = [f for f in files if f not in exclude]
+    if snapshot_path is not None:
+        snapshot.activate(snapshot_path)
+    if clear_cache:
+        classifications.clear()
+    profile = None
+    if profile_dir is not None:
+        # Keeps tracemalloc/cProfile settings if the caller enabled profiling already
+        profile = dict(profiling.settings(), outdir=profile_dir)
+        profiling.enable(**profile)
+    summary = {f: {'data_type': None, 'status': 'pending', 'stage': 'parse', 'dataset_id': None, 'rows': 0,
+                   'parse_s': 0., 'validate_s': 0., 'write_s': 0., 'insert_s': 0., 'error': None} for f in files}
+    profiles = {}  # file: profiling stage records, see `profiling.recording()`
+    writer = _Writer(summary, path, group_rows, threads, skip_identical, bulk_load, profiles, spill_dir)
+    for parsed in _parse_all(files, path, workers, summary, profile, already=parsed):
+        file = parsed['file']
+        profiles[file] = list(parsed.get('profile') or [])
+        with profiling.recording(profiles[file], file):
+            summary[file]['data_type'] = parsed['file_meta']['data_type']
+            summary[file]['parse_s'] = parsed['parse_s']
+            # validate stage
+            summary[file]['stage'] = 'validate'
+            start = time.time()
+            try:
+                problems = validate.dry_run_checks(file, parsed['file_meta'], parsed['aspect_table'],
+                                                   parsed['file_data'], path)
+            except Exception as e:
+                problems = ["%s: %s" % (type(e).__name__, e)]
+            summary[file]['validate_s'] = time.time() - start
+            if problems:
+                _fail(summary[file], 'invalid', '; '.join(problems))
+                continue
+            if not upload:
+                summary[file]['status'] = 'valid'
+                continue
+            exists = file_io.ds_in_db(parsed['file_meta'], crash=False)
+            # write stage
+            summary[file]['stage'] = 'write'
+            if exists and update:
+                writer.update(file, parsed)
+                continue
+            # An interrupted upload of the file is resumed, see _Writer._prepare()
+            if exists and not replace and \
+                    not validate.upload_incomplete(validate.get_dataset_id(parsed['file_meta'])):
+                summary[file]['status'] = 'skipped'
+                continue
+            writer.add(file, parsed, replace)
+    writer.close()
+    if profile is not None:
+        for file, stages in profiles.items():
+            profiling.start_file(file, stages)
+            profiling.write_report()
+        profiling.disable()
+        print(profiling.aggregate_reports(profile_dir).to_string(float_format=lambda x: '%.3f' % x))
+    summary = pd.DataFrame.from_dict(summary, orient='index')
+    summary.index.name = 'file'
+    summary['rows_per_s'] = (summary['rows'] / summary['insert_s']).where(summary['insert_s'] > 0)
+    print("Batch done: %s" % ', '.join('%s %s' % (n, s) for s, n in summary['status'].value_counts().items()))
+    if report is not None:
+        summary.to_csv(report)
+    return summary
+
+
+def _parse_all(files, path, workers, summary, profile=None, already=None):
+    """
+    Yields parsed files as they become ready, those that were parsed `already` first. Files that fail to parse are
+    marked in the summary.
+    """
+    already = already or {}
+    for file in files:
+        if file in already:
+            yield dict(already[file], parse_s=already[file].get('parse_s', 0.))
+    files = [f for f in files if f not in already]
+    if workers == 0:
+        for file in files:
+            try:
+                yield _parse_file_timed(file, path, profile)
+            except Exception as e:
+                _parse_failed(summary[file], e)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_parse_file_timed, file, path, profile): file for file in files}
+        for future in as_completed(futures):
+            try:
+                parsed = future.result()
+            except Exception as e:
+                _parse_failed(summary[futures[future]], e)
+                continue
+            yield parsed
+
+
+def _parse_failed(file_summary, error):
+    """
+    A file that fails the integrity checks while it is read is invalid, see `integrity`. Other errors are failures.
+    """
+    if isinstance(error, integrity.IntegrityError):
+        _fail(file_summary, 'invalid', str(error))
+    else:
+        _fail(file_summary, 'failed', error)
+
+
+def _fail(file_summary, status, error):
+    file_summary['status'] = status
+    if isinstance(error, BaseException):
+        print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        error = "%s: %s" % (type(error).__name__, error)
+    file_summary['error'] = error
+    print("ERROR (%s stage): %s" % (file_summary['stage'], error))
+
+
+class _Writer(object):
+    """
+    The database writer of a batch. Catalog steps, i.e. custom classifications, users, licences, and the `datasets`
+    entry, are done one file at a time, so ids are allocated in a consistent order. The data inserts of several
+    datasets can run concurrently in a bounded pool of threads, each with its own database connection.
+
+    The custom classifications of up to REGISTER_FILES files are written together. The resolved data of small datasets
+    with the same columns are collected and inserted together. Large datasets are uploaded in restartable chunks, see
+    `checkpoint`.
+    """
+
+    def __init__(self, summary, path, group_rows, threads=1, skip_identical=True, bulk_load=False, profiles=None,
+                 spill_dir=None):
+        self.summary = summary
+        self.path = path
+        self.group_rows = group_rows
+        self.pending = {}  # sql_columns: list of (file, Arrow table of the data)
+        self.pending_rows = 0
+        self.checked_snapshot = False
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.running = {}  # future: names of the files it inserts
+        self.skip_identical = skip_identical
+        self.fingerprints = {}  # file: (dataset_id, fingerprint, rows) of the datasets written in this batch
+        self.data_summaries = {}  # file: summary of the data being inserted, see `catalog.compute()`
+        self.queue = []  # (file, parsed, replace) waiting for the registration of their custom classifications
+        self.datasets = {}  # (dataset_name, dataset_version): file, of the files written in this batch
+        self.bulk_load = bulk_load
+        self.profiles = {} if profiles is None else profiles  # file: profiling stage records
+        self.spill_dir = spill_dir
+
+    def add(self, file, parsed, replace):
+        """
+        Queues a file. It is written once REGISTER_FILES files are queued, or when the writer is closed.
+        """
+        self.queue.append((file, parsed, replace))
+        if len(self.queue) >= REGISTER_FILES:
+            self._write_queue()
+
+    def _write_queue(self):
+        """
+        Checks the queued files for identical data and their catalog entries, registers the custom classifications of
+        the files that passed at once, and then writes them one by one.
+        """
+        queue, self.queue = self.queue, []
+        checked = []
+        for file, parsed, replace in queue:
+            name = parsed['file']
+            start = time.time()
+            try:
+                with self._recording(name):
+                    if not self.checked_snapshot:
+                        snapshot.assert_fresh()
+                        self.checked_snapshot = True
+                    name_ver = self._check_catalog(parsed, replace)
+                    identical = self._check(file, parsed, replace)
+            except Exception as e:
+                _fail(self.summary[name], 'failed', e)
+                continue
+            finally:
+                self.summary[name]['write_s'] += time.time() - start
+            if identical['same']:
+                self.summary[name]['status'] = 'identical'
+                self.summary[name]['error'] = "Same data as %s" % ', '.join(identical['same'])
+                print("Skipping '%s': %s" % (name, self.summary[name]['error']))
+                continue
+            self.fingerprints[name] = (None, identical['fingerprint'], None)
+            self.datasets[name_ver] = name
+            checked.append((file, parsed, replace, identical))
+        if not checked:
+            return
+        start = time.time()
+        records = []
+        try:
+            with profiling.recording(records):
+                validate.register_custom_classifications(
+                    [validate.get_new_custom_classifications(parsed['file_meta'], parsed['aspect_table'],
+                                                             parsed['file_data']) for _, parsed, _, _ in checked])
+        except Exception as e:
+            # _prepare() creates what is missing file by file
+            print("Could not register the custom classifications of %s files together (%s: %s)" %
+                  (len(checked), type(e).__name__, e))
+        elapsed = (time.time() - start) / len(checked)
+        for file, parsed, replace, identical in checked:
+            self.summary[parsed['file']]['write_s'] += elapsed
+            self.profiles.setdefault(parsed['file'], []).extend(profiling.split(records, len(checked)))
+            with self._recording(parsed['file']):
+                self._add(file, parsed, replace, identical)
+
+    def _add(self, file, parsed, replace, identical):
+        name = parsed['file']
+        start = time.time()
+        try:
+            resolved = self._prepare(file, parsed, replace, identical)
+        except Exception as e:
+            self.fingerprints.pop(name, None)
+            _fail(self.summary[name], 'failed', e)
+            return
+        finally:
+            self.summary[name]['write_s'] += time.time() - start
+        self.fingerprints[name] = (resolved['dataset_id'], resolved['fingerprint'], len(resolved['data'].index))
+        self.data_summaries[name] = catalog.compute(resolved['sql_columns'], resolved['data'])
+        self.summary[name]['dataset_id'] = resolved['dataset_id']
+        self.summary[name]['rows'] = len(resolved['data'].index)
+        if resolved['resume'] or len(resolved['data'].index) >= self.group_rows:
+            # Large datasets are uploaded on their own, in restartable chunks
+            self._submit(_insert_checkpointed, name, resolved, self.bulk_load, self.spill_dir)
+            return
+        table = columnar.to_arrow(resolved['sql_columns'], resolved['data'])
+        self.pending.setdefault(tuple(resolved['sql_columns']), []).append((name, table))
+        self.pending_rows += table.num_rows
+        if self.pending_rows >= self.group_rows:
+            self.flush()
+
+    def update(self, file, parsed):
+        name = parsed['file']
+        start = time.time()
+        try:
+            validate.add_user(parsed['file_meta'], quiet=True)
+            validate.add_license(parsed['file_meta'], quiet=True)
+            validate.update_dataset_entry(parsed['file_meta'])
+            res = validate.update_data(file, parsed['file_meta'], parsed['aspect_table'], parsed['file_data'],
+                                       path=self.path)
+            self.summary[name]['dataset_id'] = validate.get_dataset_id(parsed['file_meta'])
+            self.summary[name]['rows'] = res['inserted'] + res['updated'] + res['deleted']
+            self.summary[name]['status'] = 'updated'
+        except Exception as e:
+            _fail(self.summary[name], 'failed', e)
+        self.summary[name]['write_s'] += time.time() - start
+
+    def _recording(self, name):
+        """
+        Records the profiling stages of the current thread in the report of a file, see `profiling.recording()`.
+        """
+        return profiling.recording(self.profiles.setdefault(name, []), name)
+
+    def _check_catalog(self, parsed, replace):
+        """
+        The checks of the `datasets` entry that _prepare() would fail on, done before anything is written for the file:
+        the dataset must not be in the database, unless it is replaced or its upload was interrupted, and no other file
+        of the batch may have the same dataset name and version.
+
+        :return: (dataset_name, dataset_version)
+        """
+        file_meta = parsed['file_meta']
+        name_ver = tuple(validate.get_dataset_name_ver(file_meta))
+        assert name_ver not in self.datasets, "'%s' of this batch has the same dataset (dataset_name, " \
+            "dataset_version): %s" % (self.datasets.get(name_ver), list(name_ver))
+        if not replace and file_io.ds_in_db(file_meta, crash=False):
+            assert validate.upload_incomplete(validate.get_dataset_id(file_meta)), \
+                "Database already contains the following dataset (dataset_name, dataset_version):\n %s" % list(name_ver)
+        return name_ver
+
+    def _check(self, file, parsed, replace):
+        """
+        Checks for identical data before anything is written. The dataset that is replaced doesn't count.
+
+        :return: see `validate.find_identical_datasets()`, plus 'same': the datasets and files with the same data
+        """
+        file_meta = parsed['file_meta']
+        own_id = validate.get_dataset_id(file_meta) if replace and file_io.ds_in_db(file_meta, crash=False) else None
+        identical = validate.find_identical_datasets(file, file_meta, parsed['aspect_table'], parsed['file_data'],
+                                                     own_id, self.path)
+        identical['same'] = []
+        if self.skip_identical:
+            identical['same'] = ['dataset_id %s' % i for i in identical['identical']] + \
+                                [f for f, (_, fp, _) in self.fingerprints.items() if fp == identical['fingerprint']]
+        return identical
+
+    def _prepare(self, file, parsed, replace, identical):
+        """
+        Everything the debug loops did before the actual upload, one file at a time.
+        """
+        file_meta, aspect_table, file_data = parsed['file_meta'], parsed['aspect_table'], parsed['file_data']
+        class_names = validate.get_class_names(file_meta, aspect_table)
+        if not all(validate.check_classification_definition(class_names, crash=False, warn=False)):
+            validate.create_db_class_defs(file_meta, aspect_table)
+        if not all(validate.check_classification_items(class_names, file_meta, file_data, crash=False, warn=False)):
+            validate.create_db_class_items(file_meta, aspect_table, file_data)
+        validate.add_user(file_meta, quiet=True)
+        validate.add_license(file_meta, quiet=True)
+        # An upload that was interrupted after the catalog entry was written continues with the same entry and
+        # dataset_id, also if the file was to replace it
+        incomplete = file_io.ds_in_db(file_meta, crash=False) and \
+            validate.upload_incomplete(validate.get_dataset_id(file_meta))
+        validate.check_datasets_entry(file_meta, crash_on_exist=not (replace or incomplete), create=True, update=False,
+                                      replace=replace and not incomplete)
+        dataset_id = validate.get_dataset_id(file_meta)
+        # Data from an interrupted upload can be resumed, anything else is a conflict
+        resume = validate.dataset_has_data(dataset_id)
+        if resume and not checkpoint.has_checkpoints(dataset_id):
+            raise AssertionError("The database already contains values for dataset_id '%s' in the 'data' table."
+                                 % dataset_id)
+        identical['resolved']['data']['dataset_id'] = dataset_id
+        resolved = validate.lookup_aspects(file_meta, aspect_table, file_data, identical['resolved'])
+        resolved['dataset_id'] = dataset_id
+        resolved['resume'] = resume
+        resolved['fingerprint'] = identical['fingerprint']
+        return resolved
+
+    def flush(self):
+        """
+        Inserts the collected data of small datasets.
+        """
+        for sql_columns, datasets in self.pending.items():
+            self._submit(_insert_group, list(sql_columns), datasets)
+        self.pending = {}
+        self.pending_rows = 0
+
+    def close(self):
+        """
+        Writes the queued files, flushes, and waits for all inserts to finish.
+        """
+        self._write_queue()
+        self.flush()
+        if self.pool is not None:
+            self._collect(wait(self.running).done)
+            self.pool.shutdown()
+
+    def _submit(self, job, *args):
+        """
+        Runs an insert job, in the thread pool if there is one. The number of jobs waiting in the pool is limited, as
+        each one holds the data of its datasets in memory.
+        """
+        if self.pool is None:
+            self._done(*_recorded(job, *args))
+            return
+        while len(self.running) >= 2 * self.threads:
+            self._collect(wait(self.running, return_when=FIRST_COMPLETED).done)
+        names = [args[0]] if job is _insert_checkpointed else [name for name, _ in args[1]]
+        self.running[self.pool.submit(_recorded, job, *args)] = names
+
+    def _collect(self, futures):
+        for future in futures:
+            names = self.running.pop(future)
+            try:
+                results, elapsed, records = future.result()
+            except Exception as e:
+                results, elapsed, records = {name: e for name in names}, 0., []
+            self._done(results, elapsed, records)
+
+    def _done(self, results, elapsed, records):
+        """
+        Records the outcome of an insert job in the summary and its profiling stages in the reports of the files. The
+        time of a grouped insert is split evenly.
+        """
+        elapsed /= len(results)
+        for name, error in results.items():
+            self.profiles.setdefault(name, []).extend(profiling.split(records, len(results)))
+            self.summary[name]['write_s'] += elapsed
+            self.summary[name]['insert_s'] += elapsed
+            data_summary = self.data_summaries.pop(name)
+            if error is not None:
+                _fail(self.summary[name], 'failed', error)
+                continue
+            self.summary[name]['status'] = 'uploaded'
+            catalog.record(self.fingerprints[name][0], data_summary)
+            fingerprint.record(*self.fingerprints[name])
+            # The upload is complete, there is nothing left to resume
+            checkpoint.clear_checkpoints(self.fingerprints[name][0])
+            print("Wrote data for '%s', dataset_id: %s (%.0f rows/s)" %
+                  (name, self.summary[name]['dataset_id'], self.summary[name]['rows'] / max(elapsed, 1e-9)))
+
+
+def _recorded(job, *args):
+    """
+    Runs an insert job, see _insert_checkpointed() and _insert_group().
+
+    :return: The results of the job, the seconds it took, and the profiling stages it ran
+    """
+    with profiling.recording([]) as records:
+        results, elapsed = job(*args)
+    return results, elapsed, records
+
+
+def _insert_checkpointed(name, resolved, bulk_load=False, spill_dir=None):
+    """
+    Insert job for one large dataset, double checked with `checkpoint.verify_upload()`.
+
+    :return: Dictionary of file: exception or None, and the seconds it took
+    """
+    start = time.time()
+    try:
+        checkpoint.upload_checkpointed(resolved['dataset_id'], resolved['sql_columns'], resolved['data'],
+                                       bulk_load=bulk_load, spill_dir=spill_dir)
+        checkpoint.verify_upload(resolved['dataset_id'], resolved['sql_columns'], resolved['data'])
+        error = None
+    except Exception as e:
+        error = e
+    return {name: error}, time.time() - start
+
+
+def _insert_group(sql_columns, datasets):
+    """
+    Insert job for the data of several small datasets with the same columns. Each dataset is double checked, see
+    `checkpoint.verify_upload()`.
+
+    :param datasets: List of (file, Arrow table of the data)
+    :return: Dictionary of file: exception or None, and the seconds it took
+    """
+    start = time.time()
+    # The rows are only built here, so the collected datasets wait as the much smaller Arrow tables
+    datasets = [(name, columnar.to_rows(table)) for name, table in datasets]
+    try:
+        dbio.bulk_sql_insert('data', sql_columns, [row for _, rows in datasets for row in rows])
+        results = {name: None for name, _ in datasets}
+    except Exception:
+        # Find the culprit(s) by inserting the datasets one by one
+        results = {}
+        for name, rows in datasets:
+            try:
+                dbio.bulk_sql_insert('data', sql_columns, rows)
+                results[name] = None
+            except Exception as e:
+                results[name] = e
+    for name, rows in datasets:
+        if results[name] is None and rows:
+            try:
+                checkpoint.verify_upload(rows[0][sql_columns.index('dataset_id')], sql_columns,
+                                         pd.DataFrame(rows, columns=sql_columns))
+            except Exception as e:
+                results[name] = e
+    return results, time.time() - start
@@ -0,0 +1,164 @@
+"""
+Summaries of the uploaded datasets, to answer catalog questions like "how many values, which years and regions, and
+which units does dataset X have" without scanning the `data` table.
+
+The summary is computed at upload time from the resolved data that are in memory anyway, see `compute()`, and kept in
+the table `dataset_summaries`, one row per dataset: the number of rows and of NULL values, the range of the values, the
+distinct classification items of each aspect, and the units used. `get_summaries()` reads this table and translates
+the ids with the reference tables.
+
+Usage example:
+    catalog.get_summaries([42]).loc[42, 'time']
+"""
+import json
+import time
+
+from IEDC_tools import classifications, dbio, export, lazy
+
+pd = lazy.lazy_import('pandas')
+
+SUMMARY_TABLE = 'dataset_summaries'
+# Databases in which this process created the summary table already, see _summary_table()
+_created = set()
+
+
+def create_summary_table():
+    """
+    Creates the table `dataset_summaries` if it doesn't exist yet.
+    """
+    dbio.run_this_command("""
+        CREATE TABLE IF NOT EXISTS %s (
+          dataset_id INT NOT NULL,
+          n_rows INT NOT NULL,
+          n_null INT NOT NULL,
+          value_min DOUBLE,
+          value_max DOUBLE,
+          items MEDIUMTEXT NOT NULL,
+          units TEXT NOT NULL,
+          created DATETIME NOT NULL,
+          PRIMARY KEY (dataset_id)
+        );""" % SUMMARY_TABLE)
+
+
+def _summary_table():
+    """
+    Creates the summary table once per process and database, instead of before every statement.
+    """
+    key = (dbio.database(), dbio.connection_factory)
+    if key not in _created:
+        create_summary_table()
+        _created.add(key)
+
+
+def compute(sql_columns, data):
+    """
+    Summary of a dataset.
+
+    :param sql_columns: Columns of the `data` table, see `validate.resolve_data_list()`
+    :param data: The dataset's rows as they are uploaded, i.e. with the ids of classification items and units
+    :return: Dictionary with the number of rows ('n_rows') and NULL values ('n_null'), 'value_min' and 'value_max',
+        'items': dictionary of aspect column, e.g. 'aspect1': sorted list of item ids, and 'units': sorted list of the
+        [unit_nominator, unit_denominator] ids that occur
+    """
+    def column(name):
+        return data.iloc[:, sql_columns.index(name)]
+
+    value = pd.to_numeric(column('value'))
+    units = pd.DataFrame({'nominator': column('unit_nominator'), 'denominator': column('unit_denominator')})
+    units = [[_plain_id(n), _plain_id(d)] for n, d in units.drop_duplicates().itertuples(index=False)]
+    return {'n_rows': len(data.index),
+            'n_null': int(value.isna().sum()),
+            'value_min': None if value.isna().all() else float(value.min()),
+            'value_max': None if value.isna().all() else float(value.max()),
+            'items': {c: sorted(int(i) for i in pd.unique(column(c).dropna()))
+                      for c in sql_columns if c.startswith('aspect')},
+            'units': sorted(units, key=lambda u: [(i is None, i or 0) for i in u])}
+
+
+def record(dataset_id, summary):
+    """
+    Stores the summary of an uploaded dataset. Replaces an older summary of the same dataset.
+
+    :param summary: see compute()
+    """
+    _summary_table()
+    _store(int(dataset_id), summary)
+
+
+def summarize_uploaded(dataset_id):
+    """
+    Computes and stores the summary of a dataset from its rows in the `data` table, for datasets that were uploaded
+    before summaries were kept. The only function of this module that reads `data`.
+
+    :return: The summary, see compute()
+    """
+    aspects = export.get_dataset_aspects(dataset_id)
+    sql_columns = ['dataset_id'] + list(aspects.index) + ['value', 'unit_nominator', 'unit_denominator']
+    data = dbio.get_sql_table_as_df('data', sql_columns, index=None, addSQL="WHERE dataset_id = %s" % int(dataset_id))
+    summary = compute(sql_columns, data[sql_columns])
+    record(dataset_id, summary)
+    return summary
+
+
+def clear(dataset_id):
+    """
+    Forgets the summary of a dataset, e.g. once it was deleted.
+    """
+    _summary_table()
+    dbio.run_this_command("DELETE FROM %s WHERE dataset_id = %s;" % (SUMMARY_TABLE, int(dataset_id)))
+
+
+def get_summaries(dataset_ids=None, attributes=None, names=True):
+    """
+    Summaries of uploaded datasets. Reads the tables `dataset_summaries` and `datasets` and the reference tables, but
+    not `data`.
+
+    :param dataset_ids: List of dataset ids. Default: all datasets with a summary
+    :param attributes: Dictionary of aspect: attribute number used for the item names, see `export.stream_dataset()`
+    :param names: If False, classification items and units are given as ids
+    :return: Dataframe indexed by dataset_id with the 'dataset_name' and 'dataset_version', 'n_rows', 'n_null',
+        'value_min', 'value_max', 'units' (list of unit codes, e.g. 't/yr', or of [nominator, denominator] ids), and
+        one column per aspect, e.g. 'time', with the list of its items. Aspects a dataset doesn't have are NaN.
+    """
+    _summary_table()
+    where = ''
+    if dataset_ids is not None:
+        where = "WHERE dataset_id IN (%s)" % ', '.join(str(int(i)) for i in dataset_ids) if len(dataset_ids) else \
+            "WHERE 1 = 0"
+    found = dbio.get_sql_table_as_df(SUMMARY_TABLE, index='dataset_id', addSQL=where)
+    db_datasets = dbio.get_sql_table_as_df('datasets', addSQL=where.replace('dataset_id', 'id'))
+    db_aspects = dbio.get_sql_table_as_df('aspects')
+    units = dbio.get_sql_table_as_df('units')['unitcode'] if names else None
+    attributes = attributes or {}
+    rows = {}
+    for dataset_id, summary in found.iterrows():
+        row = {'dataset_name': db_datasets.loc[dataset_id, 'dataset_name'],
+               'dataset_version': db_datasets.loc[dataset_id, 'dataset_version']}
+        row.update({c: summary[c] for c in ('n_rows', 'n_null', 'value_min', 'value_max')})
+        row['units'] = json.loads(summary['units'])
+        if names:
+            row['units'] = ['/'.join(units[i] for i in u if i is not None) for u in row['units']]
+        items = json.loads(summary['items'])
+        for column, aspect in export.get_dataset_aspects(dataset_id, db_datasets, db_aspects).iterrows():
+            row[aspect['aspect']] = items[column]
+            if names:
+                row[aspect['aspect']] = list(classifications.decode(
+                    aspect['classification_id'], attributes.get(aspect['aspect'], 1), items[column]))
+        rows[dataset_id] = row
+    summaries = pd.DataFrame.from_dict(rows, orient='index').sort_index()
+    summaries.index.name = 'dataset_id'
+    return summaries
+
+
+@dbio.db_cursor_write
+def _store(curs, dataset_id, summary):
+    dbio.table_changed(SUMMARY_TABLE)
+    curs.execute("DELETE FROM %s WHERE dataset_id = %%s;" % SUMMARY_TABLE, (dataset_id,))
+    curs.execute("INSERT INTO %s (dataset_id, n_rows, n_null, value_min, value_max, items, units, created) "
+                 "VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s);" % SUMMARY_TABLE,
+                 (dataset_id, summary['n_rows'], summary['n_null'], summary['value_min'], summary['value_max'],
+                  json.dumps(summary['items']), json.dumps(summary['units']), time.strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def _plain_id(i):
+    return None if i is None or pd.isna(i) else int(i)
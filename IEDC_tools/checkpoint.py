@@ -0,0 +1,380 @@
+"""
+Checkpointed, restartable uploads to the `data` table.
+
+The rows of a dataset are inserted in chunks. Every chunk is committed in the same transaction as a record in the
+table `upload_checkpoints`, which is keyed by dataset_id, a hash of the dataset's content, and the chunk number. If an
+upload fails halfway, running it again skips the chunks that were already committed. Transient errors, e.g. a lost
+connection or a lock wait timeout, are retried with exponential backoff, in a bulk load session over a new
+connection.
+
+Large loads can run in a bulk load session, see `dbio.bulk_load_session()`: all chunks go over one connection without
+InnoDB's unique and foreign key checks, sorted by the key of the `data` table. On MySQL, each chunk is written to a
+temporary file and loaded with LOAD DATA LOCAL INFILE, if the server allows it. The loaded rows are checked afterwards
+with `verify_load()`.
+
+The chunks are cut from an Arrow table of the data, see `columnar`, which can be spilled to a memory-mapped file.
+"""
+import contextlib
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+from IEDC_tools import columnar, dbio, lazy, profiling
+
+pd = lazy.lazy_import('pandas')
+pymysql = lazy.lazy_import('pymysql')
+
+CHECKPOINT_TABLE = 'upload_checkpoints'
+# Connection already closed (pymysql's InterfaceError(0)), MySQL server has gone away, lost connection, lock wait
+# timeout, deadlock
+TRANSIENT_ERRORS = (0, 2006, 2013, 1205, 1213)
+# LOAD DATA LOCAL INFILE is not allowed by the server: 'The used command is not allowed with this MySQL version',
+# 'Loading local data is disabled'
+LOAD_DATA_REFUSED = (1148, 3948)
+# Foreign keys of the `data` table: column: referenced table. The aspect columns refer to `classification_items`.
+DATA_FOREIGN_KEYS = {'dataset_id': 'datasets', 'unit_nominator': 'units', 'unit_denominator': 'units'}
+
+
+def create_checkpoint_table():
+    """
+    Creates the table `upload_checkpoints` if it doesn't exist yet.
+    """
+    dbio.run_this_command("""
+        CREATE TABLE IF NOT EXISTS %s (
+          dataset_id INT NOT NULL,
+          content_hash CHAR(40) NOT NULL,
+          chunk_no INT NOT NULL,
+          n_rows INT NOT NULL,
+          committed DATETIME NOT NULL,
+          PRIMARY KEY (dataset_id, content_hash, chunk_no)
+        );""" % CHECKPOINT_TABLE)
+
+
+def get_checkpoints(dataset_id):
+    """
+    Returns the committed chunks of a dataset.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :return: Dataframe with columns content_hash, chunk_no, n_rows, committed
+    """
+    create_checkpoint_table()
+    return dbio.get_sql_table_as_df(CHECKPOINT_TABLE, index=None, addSQL="WHERE dataset_id = %s" % int(dataset_id))
+
+
+def has_checkpoints(dataset_id):
+    """
+    Checks if an earlier upload of the dataset committed (some of) its chunks.
+    """
+    return not get_checkpoints(dataset_id).empty
+
+
+def clear_checkpoints(dataset_id):
+    """
+    Forgets the committed chunks of a dataset, e.g. once its data was replaced or updated by other means.
+    """
+    create_checkpoint_table()
+    dbio.run_this_command("DELETE FROM %s WHERE dataset_id = %s;" % (CHECKPOINT_TABLE, int(dataset_id)))
+
+
+def content_hash(sql_columns, data, chunk_size):
+    """
+    Hash of a resolved dataset. The chunk size is part of the hash, because the chunk numbers depend on it.
+
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data, see `validate.resolve_data_list()`
+    :param chunk_size: Number of rows per chunk
+    :return: SHA-1 hex digest
+    """
+    h = hashlib.sha1()
+    h.update(repr((list(sql_columns), int(chunk_size), len(data.index))).encode())
+    h.update(pd.util.hash_pandas_object(data.astype(str), index=False).values.tobytes())
+    return h.hexdigest()
+
+
+@profiling.stage('upload_checkpointed')
+def upload_checkpointed(dataset_id, sql_columns, data, chunk_size=10000, retries=5, backoff=2., bulk_load=False,
+                        spill_dir=None):
+    """
+    Inserts resolved data into the `data` table chunk by chunk. Resumes an earlier, interrupted upload of the same
+    content.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data as dataframe, see `validate.resolve_data_list()`
+    :param chunk_size: Number of rows per chunk / transaction
+    :param retries: How often a chunk is retried after a transient error
+    :param backoff: Seconds to wait before the first retry. Doubles with every retry.
+    :param bulk_load: Insert the chunks in a bulk load session, sorted by key, and check the rows in the end, see
+        verify_load(). On MySQL, the chunks are loaded with LOAD DATA LOCAL INFILE, or inserted if the server doesn't
+        allow it. Resuming needs the same setting, as the sort order is part of the content hash.
+    :param spill_dir: Convert the data slice by slice to an Arrow table in a temporary file in this directory and read
+        the chunks from a memory map of it, see `columnar.spill()`, instead of converting them in memory. The file is
+        deleted afterwards.
+    :return: Number of rows inserted in this run
+    """
+    dataset_id = int(dataset_id)
+    if bulk_load:
+        data = sort_by_key(sql_columns, data)
+    chash = content_hash(sql_columns, data, chunk_size)
+    done = get_checkpoints(dataset_id)
+    if any(done['content_hash'] != chash):
+        raise AssertionError("The database contains data for dataset_id '%s' from an interrupted upload with different "
+                             "content. Please delete the dataset's data before uploading it again." % dataset_id)
+    committed = set(done['chunk_no'])
+    n_chunks = -(-len(data.index) // chunk_size)  # ceil
+    if committed:
+        print("Resuming upload of dataset_id %s: %s of %s chunks already committed" %
+              (dataset_id, len(committed), n_chunks))
+    spilled = None
+    if spill_dir is None:
+        table = columnar.to_arrow(sql_columns, data)
+    else:
+        fd, spilled = tempfile.mkstemp(suffix='.arrows', prefix='dataset_%s_' % dataset_id, dir=spill_dir)
+        os.close(fd)
+        table = columnar.spill(sql_columns, data, spilled, chunk_size)
+    inserted = 0
+    try:
+        with contextlib.ExitStack() as session:
+            conn = session.enter_context(dbio.bulk_load_session(local_infile=True)) if bulk_load else None
+            load_data = conn is not None and not isinstance(conn, sqlite3.Connection)
+            for chunk_no, chunk in enumerate(columnar.slices(table, chunk_size)):
+                if chunk_no in committed:
+                    continue
+                for attempt in range(retries + 1):
+                    try:
+                        if conn is None:
+                            _insert_chunk(sql_columns, columnar.to_rows(chunk), dataset_id, chash, chunk_no)
+                        else:
+                            load_data = _insert_chunk_bulk(conn, sql_columns, chunk, dataset_id, chash, chunk_no,
+                                                           load_data)
+                        break
+                    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                        if attempt == retries or (e.args and e.args[0] not in TRANSIENT_ERRORS):
+                            raise
+                        wait = backoff * 2 ** attempt
+                        print("Transient error on chunk %s of dataset_id %s (%s). Retrying in %s s..." %
+                              (chunk_no, dataset_id, e, wait))
+                        time.sleep(wait)
+                        if conn is not None:
+                            # The session's connection may be lost. Continue in a new session with the same settings.
+                            session.close()
+                            conn = session.enter_context(dbio.bulk_load_session(local_infile=True))
+                        # The commit may have gone through before the connection dropped
+                        if chunk_no in set(get_checkpoints(dataset_id)['chunk_no']):
+                            break
+                inserted += chunk.num_rows
+    finally:
+        # Frees the memory map, which must be closed before the file can be deleted on Windows
+        table = chunk = None
+        if spilled is not None:
+            os.remove(spilled)
+    if bulk_load:
+        verify_load(dataset_id, sql_columns, len(data.index))
+    return inserted
+
+
+def sort_by_key(sql_columns, data):
+    """
+    Sorts resolved data by dataset_id and aspects, i.e. the key of the `data` table, so the rows reach its indexes in
+    order.
+
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data, see `validate.resolve_data_list()`. Its columns are in the order of `sql_columns`.
+    :return: Sorted dataframe
+    """
+    keys = [data.columns[n] for n, c in enumerate(sql_columns) if c == 'dataset_id' or c.startswith('aspect')]
+    return data.sort_values(keys, kind='mergesort')
+
+
+@profiling.stage('verify_load')
+def verify_load(dataset_id, sql_columns, n_rows):
+    """
+    Checks the rows of a dataset after a bulk load, which skipped the unique and foreign key checks of the database:
+    the number of rows, the ids in the foreign key columns, and the unique indexes of the `data` table.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param sql_columns: Column names of the `data` table
+    :param n_rows: Expected number of rows
+    """
+    db = dbio.database()
+    references = [(c, 'classification_items' if c.startswith('aspect') else DATA_FOREIGN_KEYS[c])
+                  for c in sql_columns if c.startswith('aspect') or c in DATA_FOREIGN_KEYS]
+    counts = ['COUNT(*) AS n_rows'] + \
+             ["SUM(CASE WHEN d.%s IS NOT NULL AND r%s.id IS NULL THEN 1 ELSE 0 END) AS %s" % (c, n, c)
+              for n, (c, _) in enumerate(references)]
+    joins = ' '.join("LEFT JOIN %s.%s r%s ON d.%s = r%s.id" % (db, t, n, c, n) for n, (c, t) in enumerate(references))
+    counts = dbio.get_sql_table_as_df('data d', counts, index=None,
+                                      addSQL="%s WHERE d.dataset_id = %s" % (joins, int(dataset_id))).iloc[0]
+    problems = []
+    if int(counts['n_rows']) != n_rows:
+        problems.append("%s rows instead of %s" % (int(counts['n_rows']), n_rows))
+    problems += ["%s ids in column %s not found in table %s" % (int(counts[c]), c, t)
+                 for c, t in references if counts[c]]
+    indexes = dbio.get_indexes(db)
+    for columns in indexes.loc[(indexes['table'] == 'data') & indexes['unique'] & ~indexes['primary'], 'columns']:
+        match = ' AND '.join('n.%s = o.%s' % (c, c) for c in columns)
+        duplicates = dbio.get_sql_table_as_df('data n', ['COUNT(*) AS n'], index=None,
+                                              addSQL="JOIN %s.data o ON %s AND n.id <> o.id WHERE n.dataset_id = %s"
+                                                     % (db, match, int(dataset_id))).iloc[0]['n']
+        if duplicates:
+            problems.append("%s rows violate the unique index on %s" % (int(duplicates), ', '.join(columns)))
+    if problems:
+        raise AssertionError("The bulk load of dataset_id %s left inconsistent data: %s. Please delete the dataset's "
+                             "data and upload it again." % (dataset_id, '; '.join(problems)))
+
+
+def upload_aggregates(sql_columns):
+    """
+    Aggregates to double check an upload with, see verify_upload(): the number of rows, the sum, minimum, maximum, and
+    number of NULLs of `value`, and the number of distinct ids and NULLs of each aspect column.
+
+    :param sql_columns: Column names of the `data` table
+    :return: Dictionary of metric: SQL expression
+    """
+    aggregates = {'rows': 'COUNT(*)',
+                  'value_sum': 'SUM(value)',
+                  'value_min': 'MIN(value)',
+                  'value_max': 'MAX(value)',
+                  'value_nulls': 'SUM(CASE WHEN value IS NULL THEN 1 ELSE 0 END)'}
+    for c in sql_columns:
+        if c.startswith('aspect'):
+            aggregates[c + '_distinct'] = 'COUNT(DISTINCT %s)' % c
+            aggregates[c + '_nulls'] = 'SUM(CASE WHEN %s IS NULL THEN 1 ELSE 0 END)' % c
+    return aggregates
+
+
+def expected_aggregates(sql_columns, data):
+    """
+    The aggregates of upload_aggregates(), computed from resolved data.
+
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data, see `validate.resolve_data_list()`. Its columns are in the order of `sql_columns`.
+    :return: Dictionary of metric: value. None for the sum, minimum, and maximum if all values are NULL.
+    """
+    values = pd.to_numeric(data.iloc[:, list(sql_columns).index('value')], errors='coerce')
+    filled = values.notna().any()
+    res = {'rows': len(data.index),
+           'value_sum': values.sum() if filled else None,
+           'value_min': values.min() if filled else None,
+           'value_max': values.max() if filled else None,
+           'value_nulls': int(values.isna().sum())}
+    for n, c in enumerate(sql_columns):
+        if c.startswith('aspect'):
+            res[c + '_distinct'] = int(data.iloc[:, n].nunique())
+            res[c + '_nulls'] = int(data.iloc[:, n].isna().sum())
+    return res
+
+
+@profiling.stage('verify_upload')
+def verify_upload(dataset_id, sql_columns, data, crash=True, rtol=1e-6):
+    """
+    Double checks the uploaded data of a dataset without reading them back: the aggregates of upload_aggregates() are
+    computed from the uploaded dataframe and by the database, in one GROUP BY query, and compared.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data as uploaded, see `validate.resolve_data_list()`
+    :param crash: Raise an AssertionError if an aggregate doesn't match
+    :param rtol: Relative tolerance for the aggregates of `value`. The database may sum in a different order.
+    :return: Dataframe indexed by metric, with columns 'expected', 'found', and 'ok'
+    """
+    aggregates = upload_aggregates(sql_columns)
+    expected = expected_aggregates(sql_columns, data)
+    found = dbio.get_sql_table_as_df('data', ['%s AS %s' % (sql, m) for m, sql in aggregates.items()], index=None,
+                                     addSQL="WHERE dataset_id = %s GROUP BY dataset_id" % int(dataset_id))
+    counts = [m for m in aggregates if m == 'rows' or m.endswith(('_nulls', '_distinct'))]
+    if found.empty:
+        found = {m: 0 if m in counts else None for m in aggregates}
+    else:
+        found = {m: int(v) if m in counts else v for m, v in found.iloc[0].to_dict().items()}
+    # A sum of many values in a different order differs by more than rtol of the result, if they cancel out
+    scale = pd.to_numeric(data.iloc[:, list(sql_columns).index('value')], errors='coerce').abs().sum()
+    report = pd.DataFrame({'expected': [expected[m] for m in aggregates], 'found': [found[m] for m in aggregates]},
+                          index=list(aggregates), dtype=object)
+    report['ok'] = [_same_aggregate(expected[m], found[m], rtol, rtol * scale if m == 'value_sum' else 0.)
+                    for m in aggregates]
+    if not report['ok'].all():
+        mismatches = report[~report['ok']]
+        print("Uploaded data of dataset_id %s don't match:\n%s" % (dataset_id, mismatches.to_string()))
+        if crash:
+            raise AssertionError("The uploaded data of dataset_id %s don't match the file: %s" %
+                                 (dataset_id, ', '.join('%s %s instead of %s' % (m, r['found'], r['expected'])
+                                                        for m, r in mismatches.iterrows())))
+    return report
+
+
+def _same_aggregate(expected, found, rtol, atol):
+    if pd.isna(expected) or pd.isna(found):
+        return pd.isna(expected) and pd.isna(found)
+    return abs(float(found) - float(expected)) <= atol + rtol * abs(float(expected))
+
+
+@dbio.db_cursor_write
+def _insert_chunk(curs, sql_columns, rows, dataset_id, chash, chunk_no):
+    """
+    Inserts one chunk and its checkpoint in a single transaction.
+    """
+    _write_chunk(curs, sql_columns, rows, dataset_id, chash, chunk_no)
+
+
+def _insert_chunk_bulk(conn, sql_columns, chunk, dataset_id, chash, chunk_no, load_data=False):
+    """
+    Same as _insert_chunk(), over the connection of a bulk load session.
+
+    :param chunk: Arrow table of the chunk's rows
+    :param load_data: Load the rows with LOAD DATA LOCAL INFILE, see _load_chunk()
+    :return: `load_data`, False if the server refused LOAD DATA LOCAL INFILE and the rows were inserted instead
+    """
+    curs = conn.cursor()
+    try:
+        if load_data:
+            load_data = _load_chunk(curs, sql_columns, chunk)
+        if load_data:
+            _write_checkpoint(curs, dataset_id, chash, chunk_no, chunk.num_rows)
+        else:
+            _write_chunk(curs, sql_columns, columnar.to_rows(chunk), dataset_id, chash, chunk_no)
+        conn.commit()
+    except BaseException:
+        # Fails as well if the connection is lost
+        with contextlib.suppress(Exception):
+            conn.rollback()
+        raise
+    finally:
+        curs.close()
+    return load_data
+
+
+def _load_chunk(curs, sql_columns, chunk):
+    """
+    Loads the rows of a chunk into the `data` table from a temporary file, see `columnar.write_tsv()`. Like an INSERT
+    IGNORE, LOAD DATA LOCAL INFILE only warns about rows it can't load, which verify_load() finds afterwards.
+
+    :return: False if the server doesn't allow LOAD DATA LOCAL INFILE. Nothing was loaded then.
+    """
+    fd, file = tempfile.mkstemp(suffix='.tsv', prefix='data_')
+    os.close(fd)
+    try:
+        columnar.write_tsv(chunk, file)
+        curs.execute(columnar.load_data_sql(file, 'data', sql_columns))
+    except pymysql.err.MySQLError as e:
+        if not e.args or e.args[0] not in LOAD_DATA_REFUSED:
+            raise
+        print("LOAD DATA LOCAL INFILE is not allowed (%s). Inserting the rows instead." % e)
+        return False
+    finally:
+        os.remove(file)
+    return True
+
+
+def _write_chunk(curs, sql_columns, rows, dataset_id, chash, chunk_no):
+    sql = "INSERT INTO data (%s) VALUES (%s);" % (', '.join(sql_columns), ', '.join(['%s'] * len(sql_columns)))
+    curs.executemany(sql, rows)
+    _write_checkpoint(curs, dataset_id, chash, chunk_no, len(rows))
+
+
+def _write_checkpoint(curs, dataset_id, chash, chunk_no, n_rows):
+    sql = "INSERT INTO %s (dataset_id, content_hash, chunk_no, n_rows, committed) VALUES (%%s, %%s, %%s, %%s, %%s);" \
+          % CHECKPOINT_TABLE
+    curs.execute(sql, (dataset_id, chash, chunk_no, n_rows, time.strftime('%Y-%m-%d %H:%M:%S')))
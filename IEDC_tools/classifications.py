@@ -0,0 +1,208 @@
+"""
+In-memory store of the classifications, shared by all functions of a run.
+
+`classification_items` is by far the largest reference table and consists mostly of strings. Instead of downloading it
+as a whole, the store loads the items of one classification at a time, and only the attribute column that is actually
+used, e.g. `attribute2_oto`. Ids are kept as int32 and attribute values as categorical. Names from the data files are
+then resolved to ids with `lookup()`.
+
+The store is filled on demand and lives until `clear()` is called, e.g. at the start of a batch. Writes through `dbio`
+are noticed (see `dbio.table_versions`) and drop the outdated part of the store. After changes made otherwise, e.g. by
+another process, call `invalidate()`.
+"""
+from IEDC_tools import dbio, lazy
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+
+_store = {'definitions': None,  # classification_definition table
+          'ids': None,  # classification_name: id
+          'items': {},  # (classification_id, column): see _load_items()
+          'has_items': {},  # classification_id: True / False
+          'versions': {}}  # table: dbio.table_versions when it was loaded
+
+
+def clear():
+    """
+    Empties the store.
+    """
+    invalidate()
+
+
+def invalidate(class_id=None):
+    """
+    Drops cached data after the classification tables were changed.
+
+    :param class_id: Only drop the items of this classification. The definitions are always dropped.
+    """
+    _drop_definitions()
+    if class_id is None:
+        _drop_items()
+        return
+    class_id = int(class_id)
+    for key in [k for k in _store['items'] if k[0] == class_id]:
+        del _store['items'][key]
+    _store['has_items'].pop(class_id, None)
+
+
+def get_definitions():
+    """
+    Returns the table `classification_definition`, indexed by id. Don't modify it, it is shared.
+    """
+    _check_version('classification_definition')
+    if _store['definitions'] is None:
+        db_classdef = dbio.get_sql_table_as_df('classification_definition')
+        db_classdef.index = db_classdef.index.astype('int32')
+        _store['definitions'] = db_classdef
+        # The first classification of a name counts, as in the old lookups
+        names = db_classdef['classification_name'].drop_duplicates()
+        _store['ids'] = dict(zip(names.values, names.index))
+    return _store['definitions']
+
+
+def get_class_id(name):
+    """
+    id of a classification in `classification_definition`.
+
+    :param name: classification_name
+    :return: id (int) or None if the classification doesn't exist
+    """
+    get_definitions()
+    class_id = _store['ids'].get(name)
+    return None if class_id is None else int(class_id)
+
+
+def get_class_name(class_id):
+    """
+    classification_name of a classification id.
+    """
+    return get_definitions().loc[class_id, 'classification_name']
+
+
+def attribute_column(attribute_no):
+    """
+    Column name in `classification_items` of an attribute number as used in the data templates, e.g. 2 ->
+    'attribute2_oto'. Custom classifications only have the first attribute.
+    """
+    if isinstance(attribute_no, str):
+        attribute_no = attribute_no.strip(' ')
+    if attribute_no == 'custom':
+        attribute_no = 1
+    return 'attribute%s_oto' % int(attribute_no)
+
+
+def has_items(class_id):
+    """
+    Checks if a classification has any items in `classification_items`.
+    """
+    class_id = int(class_id)
+    _check_version('classification_items')
+    if class_id not in _store['has_items']:
+        if 'classification_items' in dbio.reference_tables:
+            db_classitems = dbio.reference_tables['classification_items']
+            _store['has_items'][class_id] = bool((db_classitems['classification_id'] == class_id).any())
+        else:
+            db_classitems = dbio.get_sql_table_as_df('classification_items', columns=['id'],
+                                                     addSQL="WHERE classification_id = %s LIMIT 1" % class_id)
+            _store['has_items'][class_id] = len(db_classitems.index) > 0
+    return _store['has_items'][class_id]
+
+
+def get_items(class_id, attribute_no):
+    """
+    The items of a classification as compact dataframe: int32 column 'id' and the attribute as categorical column.
+
+    :param class_id: classification id
+    :param attribute_no: Attribute number, or 'custom'
+    :return: Dataframe with columns 'id' and 'attribute'. Don't modify it, it is shared.
+    """
+    return _load_items(int(class_id), attribute_column(attribute_no))['items']
+
+
+def lookup(class_id, attribute_no, values):
+    """
+    Resolves attribute values, e.g. from a data file, to the ids of the classification items.
+
+    :param class_id: classification id
+    :param attribute_no: Attribute number, or 'custom'
+    :param values: Iterable of values. Compared as strings.
+    :return: numpy array (int32) of ids, -1 where a value is not in the classification
+    """
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype) and not values.isna().any():
+        # e.g. the aspects of a LIST file, see file_io.LIST_SCHEMA. Look up each category once.
+        values = pd.Categorical(values)
+        return np.append(lookup(class_id, attribute_no, values.categories), -1)[values.codes]
+    column = attribute_column(attribute_no)
+    entry = _load_items(int(class_id), column)
+    values = pd.Index(pd.Series(values, dtype=object).astype(str))
+    if len(entry['duplicates']) and values.isin(entry['duplicates']).any():
+        raise AssertionError("The database classification table contains at least one conflicting duplicate entry "
+                             "for the unique attribute %s of classification %s. Data upload halted. Check "
+                             "classification for duplicate entries!" % (column, class_id))
+    # Unknown values get code -1, i.e. the last element of id_by_code
+    return entry['id_by_code'][entry['items']['attribute'].cat.categories.get_indexer(values)]
+
+
+def decode(class_id, attribute_no, ids):
+    """
+    The inverse of `lookup()`: item ids to attribute values.
+
+    :param class_id: classification id
+    :param attribute_no: Attribute number, or 'custom'
+    :param ids: Iterable of item ids
+    :return: Categorical of attribute values, NaN where an id is not in the classification
+    """
+    entry = _load_items(int(class_id), attribute_column(attribute_no))
+    if 'id_index' not in entry:
+        entry['id_index'] = pd.Index(entry['items']['id'])
+    positions = entry['id_index'].get_indexer(pd.Index(ids))
+    attribute = entry['items']['attribute'].cat
+    # Position -1, i.e. unknown ids, picks the appended code -1, i.e. NaN
+    codes = np.append(attribute.codes.values, -1)[positions]
+    return pd.Categorical.from_codes(codes, categories=attribute.categories)
+
+
+def _check_version(table):
+    """
+    Drops cached data of a table that was written to since it was loaded.
+    """
+    version = dbio.table_versions.get(table, 0)
+    if _store['versions'].get(table, version) != version:
+        if table == 'classification_definition':
+            _drop_definitions()
+        else:
+            _drop_items()
+    _store['versions'][table] = version
+
+
+def _drop_definitions():
+    _store['definitions'] = None
+    _store['ids'] = None
+
+
+def _drop_items():
+    _store['items'].clear()
+    _store['has_items'].clear()
+
+
+def _load_items(class_id, column):
+    _check_version('classification_items')
+    key = (class_id, column)
+    if key not in _store['items']:
+        if 'classification_items' in dbio.reference_tables:
+            db_classitems = dbio.reference_tables['classification_items']
+            db_classitems = db_classitems.loc[db_classitems['classification_id'] == class_id, [column]]
+        else:
+            db_classitems = dbio.get_sql_table_as_df('classification_items', columns=['id', column],
+                                                     addSQL="WHERE classification_id = %s" % class_id)
+        attributes = db_classitems[column].dropna().astype(str)
+        items = pd.DataFrame({'id': attributes.index.values.astype('int32'),
+                              'attribute': pd.Categorical(attributes.values)})
+        # Maps the category codes to item ids, so lookups don't need a merge. The extra last element is for code -1.
+        id_by_code = np.full(len(items['attribute'].cat.categories) + 1, -1, dtype='int32')
+        id_by_code[items['attribute'].cat.codes.values] = items['id'].values
+        _store['items'][key] = {'items': items,
+                                'id_by_code': id_by_code,
+                                'duplicates': pd.Index(attributes[attributes.duplicated()].unique())}
+        _store['has_items'][class_id] = len(db_classitems.index) > 0
+    return _store['items'][key]
@@ -0,0 +1,196 @@
+"""
+Resolved data as an Arrow table, the form in which they wait to be inserted into the `data` table.
+
+The resolved dataframes of `validate.resolve_data_list()` and `validate.resolve_data_table()` hold one Python object
+per cell. `to_arrow()` converts them once into typed columns: the dataset_id and the aspects as dictionary encoded ids,
+`value` and the stats array as float64, the units and stats_array_1 as nullable int64, and the comment as dictionary
+encoded string. From there,
+
+- `slices()` cuts the table into insert chunks without copying,
+- `to_rows()` builds the rows of one chunk for `executemany()`, column by column, and
+- `write_tsv()` writes the table in the format of MySQL's LOAD DATA INFILE, see `load_data_sql()`.
+
+For datasets bigger than the memory, `spill()` converts the data slice by slice into a file and maps it into memory,
+so the table is never held in memory as a whole.
+
+Usage example:
+    table = columnar.to_arrow(resolved['sql_columns'], resolved['data'])
+    for chunk in columnar.slices(table, 10000):
+        dbio.bulk_sql_insert('data', resolved['sql_columns'], columnar.to_rows(chunk))
+"""
+import os
+
+from IEDC_tools import lazy
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+pa = lazy.lazy_import('pyarrow')
+pc = lazy.lazy_import('pyarrow.compute')
+
+# Types of the columns of the `data` table that aren't aspects
+COLUMN_TYPES = {'dataset_id': 'dictionary',
+                'value': 'float64',
+                'unit_nominator': 'int64',
+                'unit_denominator': 'int64',
+                'stats_array_1': 'int64',
+                'stats_array_2': 'float64',
+                'stats_array_3': 'float64',
+                'stats_array_4': 'float64',
+                'comment': 'string'}
+# Escapes of LOAD DATA INFILE, for its defaults FIELDS TERMINATED BY '\t' ESCAPED BY '\\' LINES TERMINATED BY '\n'
+TSV_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+TSV_NULL = '\\N'
+
+
+def to_arrow(sql_columns, data):
+    """
+    Converts resolved data to an Arrow table.
+
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data, see `validate.resolve_data_list()`. Its columns are in the order of `sql_columns`.
+    :return: Arrow table with the columns `sql_columns`
+    """
+    arrays = []
+    for n, column in enumerate(sql_columns):
+        kind = 'dictionary' if column.startswith('aspect') else COLUMN_TYPES[column]
+        values = data.iloc[:, n]
+        if kind == 'string':
+            array = pa.array(values, type=pa.string(), from_pandas=True).dictionary_encode()
+        elif kind == 'float64':
+            array = _numbers(values, pa.float64())
+        else:
+            array = _numbers(values, pa.int64())
+            if kind == 'dictionary':
+                array = array.dictionary_encode()
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=list(sql_columns))
+
+
+def slices(table, rows):
+    """
+    Cuts a table into chunks. The chunks are views of the table, nothing is copied.
+
+    :param rows: Number of rows per chunk
+    :return: Generator of Arrow tables
+    """
+    for offset in range(0, table.num_rows, rows):
+        yield table.slice(offset, rows)
+
+
+def to_rows(table):
+    """
+    The rows of a table as Python values, e.g. for `executemany()`. NULLs are None.
+
+    :return: List of tuples
+    """
+    rows = []
+    for batch in table.to_batches():
+        rows.extend(zip(*[_python_values(c) for c in batch.columns]))
+    return rows
+
+
+def spill(sql_columns, data, file, rows=100000):
+    """
+    Converts resolved data to an Arrow table like to_arrow(), but one slice at a time, written to an Arrow IPC file
+    that is then opened as a memory map. The returned table reads its chunks from the file as they are used. The file
+    must exist as long as the table is used.
+
+    :param sql_columns: Column names of the `data` table
+    :param data: Resolved data, see `validate.resolve_data_list()`. Its columns are in the order of `sql_columns`.
+    :param file: Filename, e.g. in a temporary directory
+    :param rows: Number of rows converted at a time
+    :return: Arrow table backed by the file
+    """
+    schema = to_arrow(sql_columns, data.iloc[:0]).schema
+    with pa.OSFile(file, 'wb') as sink:
+        # The stream format, as every slice has dictionaries of its own
+        with pa.ipc.new_stream(sink, schema) as writer:
+            for offset in range(0, len(data.index), rows):
+                writer.write_table(to_arrow(sql_columns, data.iloc[offset:offset + rows]))
+    return open_spilled(file)
+
+
+def open_spilled(file):
+    """
+    Opens a table written by spill().
+    """
+    return pa.ipc.open_stream(pa.memory_map(file, 'r')).read_all()
+
+
+def write_tsv(table, file, rows=100000):
+    """
+    Writes a table as tab separated text, the default format of MySQL's LOAD DATA INFILE: no header, NULL as '\\N',
+    and backslash, tab, and line breaks escaped with a backslash.
+
+    :param file: Filename
+    :param rows: Number of rows converted at a time
+    :return: Number of rows written
+    """
+    with open(file, 'wb') as f:
+        for chunk in slices(table, rows):
+            lines = pc.binary_join_element_wise(*[_tsv_strings(c) for c in chunk.columns], '\t')
+            lines = pc.binary_join_element_wise(lines, '', '\n').combine_chunks()
+            if len(lines):
+                # The lines are stored one after the other, so the text is a slice of the array's data buffer
+                offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32)[lines.offset:lines.offset + len(lines) + 1]
+                f.write(lines.buffers()[2][offsets[0]:offsets[-1]])
+    return table.num_rows
+
+
+def load_data_sql(file, table, columns, local=True):
+    """
+    The statement that loads a file written by write_tsv(). LOCAL reads the file on the client and needs
+    `local_infile` to be allowed by the server and the connection.
+
+    :param file: Filename
+    :param table: Name of the table, e.g. 'data'
+    :param columns: Column names of the file, e.g. the `sql_columns` of the resolved data
+    :return: SQL statement
+    """
+    return "LOAD DATA %sINFILE '%s' INTO TABLE %s (%s);" % ('LOCAL ' if local else '',
+                                                              os.path.abspath(file).replace('\\', '/'), table,
+                                                              ', '.join(columns))
+
+
+def _numbers(values, arrow_type):
+    """
+    Arrow array of a column of numbers. Numbers given as text, e.g. the stats arrays of LIST type files, are parsed
+    once per distinct text.
+    """
+    try:
+        return pa.array(values, type=arrow_type, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        codes, distinct = pd.factorize(values)
+        numbers = np.append(pd.to_numeric(distinct).astype(float), np.nan)
+        return pa.array(numbers[codes], type=arrow_type, from_pandas=True)
+
+
+def _python_values(array):
+    """
+    Object array of the Python values of an Arrow array. Dictionary encoded arrays are converted by their distinct
+    values, which is much faster than converting every cell, unless a slice uses only few of them.
+    """
+    if pa.types.is_dictionary(array.type) and len(array.dictionary) > len(array):
+        return _python_values(array.dictionary_decode())
+    if pa.types.is_dictionary(array.type):
+        values = _python_values(array.dictionary)
+        out = values[array.indices.fill_null(0).to_numpy(zero_copy_only=False)] if len(values) else \
+            np.full(len(array), None, dtype=object)
+    elif pa.types.is_string(array.type):
+        return np.asarray(array.to_pylist(), dtype=object)
+    else:
+        out = array.fill_null(0).to_numpy(zero_copy_only=False).astype(object)
+    if array.null_count:
+        out[array.is_null().to_numpy(zero_copy_only=False)] = None
+    return out
+
+
+def _tsv_strings(array):
+    if pa.types.is_dictionary(array.type):
+        array = pc.cast(array, array.type.value_type)
+    if pa.types.is_string(array.type):
+        for char, escaped in TSV_ESCAPES:
+            array = pc.replace_substring(array, char, escaped)
+    else:
+        array = pc.cast(array, pa.string())
+    return pc.fill_null(array, TSV_NULL)
@@ -0,0 +1,393 @@
+"""
+Long-running worker that validates and uploads candidate files, see `IEDC_daemon.py`.
+
+A new process for every run pays for importing pandas and openpyxl, connecting to the database, and downloading the
+reference tables before the first file is even read. The daemon does all this once (`warm_up()`) and then takes jobs
+from a spool directory:
+
+    spool/incoming/          jobs waiting, one JSON file each, see `submit()`
+    spool/running/<daemon>/  jobs being processed by a daemon
+    spool/daemons/<daemon>   host and pid of a daemon. The time the file was last modified is the daemon's heartbeat.
+    spool/done/              results, one JSON file per job, see `get_status()`
+
+Several daemons can share a spool directory. The jobs of a daemon that died, i.e. whose heartbeat stopped or whose
+process is gone, start over when another daemon starts or is idle.
+
+A job is a dictionary with the 'action' ('validate' or 'upload'), the 'file', its 'path' (default:
+IEDC_paths.candidates), and for uploads the options 'replace', 'update', 'skip_identical', and 'bulk_load' of
+`batch.run()`. Validations run concurrently in a pool of threads, uploads one at a time and while no validation runs,
+as they change the tables and caches validations read from. The reference tables are kept
+in memory (`snapshot.activate_live()`) and refreshed whenever the daemon is idle and they changed in the database.
+"""
+import contextlib
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from IEDC_tools import batch, classifications, dbio, integrity, lazy, snapshot, validate
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+openpyxl = lazy.lazy_import('openpyxl')
+IEDC_paths = lazy.lazy_import('IEDC_paths')
+
+SPOOL_DIRS = ('incoming', 'running', 'daemons', 'done')
+ACTIONS = ('validate', 'upload')
+UPLOAD_OPTIONS = {'replace': False, 'update': False, 'skip_identical': True, 'bulk_load': False}
+# Seconds between heartbeats of a daemon, and without a heartbeat after which a daemon counts as dead
+HEARTBEAT_INTERVAL = 5.
+HEARTBEAT_TIMEOUT = 60.
+
+
+class _SharedLock(object):
+    """
+    Lock held by any number of threads in shared mode, or by one thread in exclusive mode. Threads waiting for
+    exclusive mode go first.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._waiting += 1
+            self._cond.wait_for(lambda: not self._exclusive and not self._shared)
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+# Validations share it. Uploads allocate catalog ids and invalidate the caches validations use, e.g. `classifications`
+# and the reference tables in `dbio`, so they hold it exclusively.
+_jobs_lock = _SharedLock()
+
+
+def submit(spool, action, file, path=None, **options):
+    """
+    Puts a job into the spool directory of a daemon.
+
+    :param spool: Spool directory
+    :param action: 'validate' or 'upload'
+    :param file: Filename of the candidate file
+    :param path: Directory of the file. Default: the daemon's IEDC_paths.candidates
+    :param options: Upload options, see UPLOAD_OPTIONS
+    :return: Job id
+    """
+    assert action in ACTIONS, "Unknown action '%s'. Must be one of %s" % (action, ACTIONS)
+    unknown = set(options) - set(UPLOAD_OPTIONS)
+    assert not unknown, "Unknown options %s. Must be in %s" % (sorted(unknown), list(UPLOAD_OPTIONS))
+    dirs = _spool_dirs(spool)
+    job_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+    job = dict(options, id=job_id, action=action, file=file, path=path, submitted=time.time())
+    # Written next to the folders and then moved, so the daemon never sees half a file
+    tmp = os.path.join(spool, job_id + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, os.path.join(dirs['incoming'], job_id + '.json'))
+    return job_id
+
+
+def get_status(spool, job_id):
+    """
+    Status of a job.
+
+    :return: Dictionary with the 'status': 'queued', 'running', or the result of a finished job, see run_job()
+    """
+    dirs = _spool_dirs(spool)
+    done = os.path.join(dirs['done'], job_id + '.json')
+    if os.path.exists(done):
+        with open(done) as f:
+            return json.load(f)
+    if glob.glob(os.path.join(dirs['running'], '*', job_id + '.json')):
+        return {'id': job_id, 'status': 'running'}
+    if os.path.exists(os.path.join(dirs['incoming'], job_id + '.json')):
+        return {'id': job_id, 'status': 'queued'}
+    raise AssertionError("Job '%s' not found in spool directory '%s'" % (job_id, spool))
+
+
+def wait_for(spool, job_id, timeout=None, poll=0.05):
+    """
+    Waits until a job is finished.
+
+    :param timeout: Seconds. None: wait forever.
+    :return: Result of the job, see run_job()
+    """
+    start = time.time()
+    while True:
+        status = get_status(spool, job_id)
+        if status['status'] not in ('queued', 'running'):
+            return status
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError("Job '%s' is still %s after %s s" % (job_id, status['status'], timeout))
+        time.sleep(poll)
+
+
+def warm_up(snapshot_path=None):
+    """
+    Loads what every job needs: pandas, numpy, openpyxl, a database connection that is kept open (see
+    `dbio.keep_connections()`), the reference tables, and the classification definitions.
+
+    :param snapshot_path: Serve the reference tables from this snapshot. Default: download them to memory.
+    """
+    start = time.time()
+    # Touching an attribute imports a lazy module
+    pd.DataFrame, np.ndarray, openpyxl.load_workbook
+    dbio.keep_connections()
+    if snapshot_path is not None:
+        snapshot.activate(snapshot_path)
+    else:
+        snapshot.activate_live()
+    classifications.clear()
+    classifications.get_definitions()
+    print("Warmed up in %.1f s" % (time.time() - start))
+
+
+def run_job(job):
+    """
+    Runs a validate or upload job.
+
+    :param job: see submit()
+    :return: Dictionary with the job, its 'status' ('valid', 'invalid', or 'failed' for validations, see `batch.run()`
+        for uploads), 'problems' or 'error', timings, and for uploads 'dataset_id' and 'rows'
+    """
+    result = dict(job, started=time.time())
+    path = job.get('path') or IEDC_paths.candidates
+    try:
+        if job['action'] == 'validate':
+            try:
+                parsed = batch.parse_file(job['file'], path)
+                with _jobs_lock.shared():
+                    problems = validate.dry_run_checks(job['file'], parsed['file_meta'], parsed['aspect_table'],
+                                                       parsed['file_data'], path)
+            except integrity.IntegrityError as e:
+                problems = [str(e)]
+            result.update(status='invalid' if problems else 'valid', problems=problems)
+        elif job['action'] == 'upload':
+            options = {o: job.get(o, default) for o, default in UPLOAD_OPTIONS.items()}
+            with _jobs_lock.exclusive():
+                summary = batch.run(path, files=[job['file']], workers=0, clear_cache=False, **options)
+            row = summary.iloc[0]
+            result.update({c: _plain(row[c]) for c in ('status', 'stage', 'dataset_id', 'rows', 'error')})
+        else:
+            raise AssertionError("Unknown action '%s'. Must be one of %s" % (job['action'], ACTIONS))
+    except Exception as e:
+        result.update(status='failed', error="%s: %s" % (type(e).__name__, e), traceback=traceback.format_exc())
+    result['finished'] = time.time()
+    result['seconds'] = result['finished'] - result['started']
+    return result
+
+
+def serve(spool, workers=1, snapshot_path=None, poll=0.1, refresh_interval=5., max_jobs=None):
+    """
+    Runs the daemon: warms up and then processes the jobs in the spool directory, oldest first, until interrupted.
+
+    :param spool: Spool directory. Created if it doesn't exist.
+    :param workers: Number of jobs processed at the same time. Uploads still run one at a time.
+    :param snapshot_path: see warm_up()
+    :param poll: Seconds between looks into the spool directory
+    :param refresh_interval: Seconds between checks if the reference tables changed in the database, and for jobs of
+        dead daemons
+    :param max_jobs: Stop after this many jobs. None: run until interrupted.
+    """
+    dirs = _spool_dirs(spool)
+    warm_up(snapshot_path)
+    daemon = _register(dirs)
+    _requeue_orphans(dirs)
+    print("Waiting for jobs in '%s'" % dirs['incoming'])
+    pool = ThreadPoolExecutor(max_workers=workers)
+    running = {}  # future: job file in `running`
+    taken = 0
+    refreshed_at = time.time()
+    try:
+        while max_jobs is None or taken < max_jobs or running:
+            _heartbeat(daemon)
+            if running:
+                finished, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    _finish(dirs, running.pop(future), future.result())
+            elif time.time() - refreshed_at > refresh_interval:
+                # Only while idle, so jobs don't see the tables change under their feet
+                if snapshot_path is None:
+                    refreshed = snapshot.refresh_live()
+                    if refreshed:
+                        print("Refreshed the reference tables %s" % refreshed)
+                _requeue_orphans(dirs)
+                refreshed_at = time.time()
+            while len(running) < workers and (max_jobs is None or taken < max_jobs):
+                job_file = _take_job(dirs, daemon)
+                if job_file is None:
+                    break
+                with open(job_file) as f:
+                    job = json.load(f)
+                print("Job %s: %s '%s'" % (job['id'], job['action'], job['file']))
+                running[pool.submit(run_job, job)] = job_file
+                taken += 1
+            if not running and (max_jobs is None or taken < max_jobs):
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        print("Stopping after the running jobs...")
+        while running:
+            _heartbeat(daemon)
+            finished, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+            for future in finished:
+                _finish(dirs, running.pop(future), future.result())
+    finally:
+        pool.shutdown()
+        if not running:
+            _unregister(daemon)
+
+
+def _spool_dirs(spool):
+    dirs = {d: os.path.join(spool, d) for d in SPOOL_DIRS}
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def _register(dirs):
+    """
+    Announces a daemon in the spool directory: writes its host and pid, and creates its folder in `running`.
+
+    :return: Dictionary with the daemon's 'id', its 'file' in `daemons`, its 'running' folder, and the time of the
+        last 'heartbeat'
+    """
+    daemon_id = uuid.uuid4().hex[:12]
+    daemon = {'id': daemon_id,
+              'file': os.path.join(dirs['daemons'], daemon_id + '.json'),
+              'running': os.path.join(dirs['running'], daemon_id),
+              'heartbeat': time.time()}
+    # The file first: a folder in `running` without it belongs to a dead daemon
+    tmp = daemon['file'] + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'started': time.time()}, f)
+    os.replace(tmp, daemon['file'])
+    os.makedirs(daemon['running'])
+    return daemon
+
+
+def _unregister(daemon):
+    with contextlib.suppress(OSError):
+        os.rmdir(daemon['running'])
+        os.remove(daemon['file'])
+
+
+def _heartbeat(daemon):
+    if time.time() - daemon['heartbeat'] > HEARTBEAT_INTERVAL:
+        os.utime(daemon['file'])
+        daemon['heartbeat'] = time.time()
+
+
+def _daemon_alive(dirs, daemon_id):
+    """
+    Checks if a daemon on the spool directory is alive: its heartbeat is recent and, if it runs on this host, its
+    process exists.
+    """
+    file = os.path.join(dirs['daemons'], daemon_id + '.json')
+    try:
+        heartbeat = os.path.getmtime(file)
+        with open(file) as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if time.time() - heartbeat > HEARTBEAT_TIMEOUT:
+        return False
+    # os.kill() would terminate the process on Windows
+    if owner['host'] == socket.gethostname() and os.name != 'nt':
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Exists, but belongs to another user
+            pass
+    return True
+
+
+def _requeue_orphans(dirs):
+    """
+    Moves the jobs of dead daemons back to `incoming`, so they start over. Jobs of daemons that are alive, e.g. of
+    other daemons on the same spool directory, are left alone.
+
+    :return: Number of jobs moved
+    """
+    moved = 0
+    for folder in glob.glob(os.path.join(dirs['running'], '*', '')):
+        daemon_id = os.path.basename(os.path.dirname(folder))
+        if _daemon_alive(dirs, daemon_id):
+            continue
+        for job_file in glob.glob(os.path.join(folder, '*.json')):
+            try:
+                os.replace(job_file, os.path.join(dirs['incoming'], os.path.basename(job_file)))
+                moved += 1
+                print("Job %s of dead daemon %s starts over" % (os.path.basename(job_file)[:-5], daemon_id))
+            except FileNotFoundError:
+                # Moved by another daemon
+                continue
+        with contextlib.suppress(OSError):
+            os.rmdir(folder)
+            os.remove(os.path.join(dirs['daemons'], daemon_id + '.json'))
+    return moved
+
+
+def _take_job(dirs, daemon):
+    """
+    Moves the oldest waiting job to the daemon's folder in `running`.
+
+    :return: Path of the job file in `running`, or None if there is no job
+    """
+    jobs = sorted(glob.glob(os.path.join(dirs['incoming'], '*.json')), key=os.path.getmtime)
+    for job_file in jobs:
+        target = os.path.join(daemon['running'], os.path.basename(job_file))
+        try:
+            os.replace(job_file, target)
+        except FileNotFoundError:
+            # Taken by another daemon on the same spool directory
+            continue
+        return target
+    return None
+
+
+def _finish(dirs, job_file, result):
+    tmp = os.path.join(dirs['done'], result['id'] + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(result, f, indent=1)
+    os.replace(tmp, os.path.join(dirs['done'], result['id'] + '.json'))
+    os.remove(job_file)
+    print("Job %s: %s (%.2f s)%s" % (result['id'], result['status'], result['seconds'],
+                                     ' ' + str(result['error']) if result.get('error') else ''))
+
+
+def _plain(value):
+    """
+    JSON compatible version of a value from a dataframe.
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else value
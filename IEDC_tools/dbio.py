@@ -2,10 +2,99 @@
 Database Input / Output functions
 """
 
-import pandas as pd
-import pymysql
+import contextlib
+import sqlite3
+import threading
 
-import IEDC_pass
+from IEDC_tools import lazy
+
+pd = lazy.lazy_import('pandas')
+pymysql = lazy.lazy_import('pymysql')
+IEDC_pass = lazy.lazy_import('IEDC_pass')
+
+
+# Function returning a new connection to a database other than the one in IEDC_pass, e.g. `standin.connect` for a
+# local stand-in database. None: use the MySQL server in IEDC_pass.
+connection_factory = None
+# Name of the database `connection_factory` connects to, e.g. `standin.DATABASE`. None: IEDC_pass.IEDC_database
+database_name = None
+# Thread-local storage of the connections kept open by keep_connections(). None: every connect() opens a new one.
+_kept = None
+
+
+def connect():
+    """
+    Opens a new database connection. After keep_connections(), returns the open connection of the current thread
+    instead, if it is still alive.
+    """
+    if _kept is not None:
+        conn = getattr(_kept, 'conn', None)
+        if conn is None or not _alive(conn):
+            conn = _kept.conn = _open()
+        return conn
+    return _open()
+
+
+def database():
+    """
+    Name of the database the library works with, used to prefix table names.
+    """
+    if database_name is not None:
+        return database_name
+    return IEDC_pass.IEDC_database
+
+
+def _open(local_infile=False):
+    if connection_factory is not None:
+        return connection_factory()
+    return pymysql.connect(host=IEDC_pass.IEDC_server,
+                           port=int(IEDC_pass.IEDC_port),
+                           user=IEDC_pass.IEDC_user,
+                           passwd=IEDC_pass.IEDC_pass,
+                           db=IEDC_pass.IEDC_database,
+                           charset='utf8',
+                           local_infile=local_infile)
+
+
+def _alive(conn):
+    if isinstance(conn, sqlite3.Connection):
+        return True
+    try:
+        conn.ping(reconnect=False)
+        return True
+    except Exception:
+        return False
+
+
+def keep_connections(keep=True):
+    """
+    Keeps one database connection per thread open and reuses it, instead of connecting for every query. For
+    long-running processes, see `daemon`. Streaming queries and bulk load sessions still get their own connection.
+
+    :param keep: False: close the connection of the current thread and connect for every query again
+    """
+    global _kept
+    if keep:
+        if _kept is None:
+            _kept = threading.local()
+        return
+    if _kept is not None and getattr(_kept, 'conn', None) is not None:
+        _kept.conn.close()
+    _kept = None
+
+
+def release(conn):
+    """
+    Closes a connection from connect(), unless it is kept open for reuse, see keep_connections().
+    """
+    if _kept is not None and getattr(_kept, 'conn', None) is conn:
+        try:
+            # Ends the transaction, so the next query sees what others have written meanwhile
+            conn.rollback()
+            return
+        except Exception:
+            _kept.conn = None
+    conn.close()
 
 
 def db_conn(fn):
@@ -20,12 +109,7 @@ def db_conn(fn):
     """
 
     def db_conn_(*args, **kwargs):
-        conn = pymysql.connect(host=IEDC_pass.IEDC_server,
-                                port=int(IEDC_pass.IEDC_port),
-                                user=IEDC_pass.IEDC_user,
-                                passwd=IEDC_pass.IEDC_pass,
-                                db=IEDC_pass.IEDC_database,
-                                charset='utf8')
+        conn = connect()
         try:
             rv = fn(conn, *args, **kwargs)
         except (KeyboardInterrupt, SystemExit):
@@ -40,8 +124,7 @@ def db_conn(fn):
             print("Something went wrong! But I was smart and closed the connection!")
             raise
         finally:
-            pass
-            conn.close()
+            release(conn)
         return rv
     return db_conn_
 
@@ -53,12 +136,7 @@ def db_cursor_write(fn):
     """
 
     def db_cursor_write_(*args, **kwargs):
-        conn = pymysql.connect(host=IEDC_pass.IEDC_server,
-                               port=int(IEDC_pass.IEDC_port),
-                               user=IEDC_pass.IEDC_user,
-                               passwd=IEDC_pass.IEDC_pass,
-                               db=IEDC_pass.IEDC_database,
-                               charset='utf8')
+        conn = connect()
         curs = conn.cursor()
         try:
             #print curs, args, kwargs
@@ -66,37 +144,64 @@ def db_cursor_write(fn):
         except (KeyboardInterrupt, SystemExit):
             #print args, kwargs
             conn.rollback()
-            conn.close()
+            release(conn)
             print("Keyboard interupt - don't worry connection was closed")
             raise
         except BaseException as error:
             #print args, kwargs
             conn.rollback()
-            conn.close()
+            release(conn)
             print("Exception: %s" % error)
             print ("But I was smart and closed the connection!")
             raise
         else:
             conn.commit()
             curs.close()
+            release(conn)
         return rv
     return db_cursor_write_
 
 
-@db_conn
-def get_sql_table_as_df(conn, table, columns=['*'], db=IEDC_pass.IEDC_database,
-                        index='id', addSQL=''):
+# Reference tables served from a local snapshot instead of the database. Filled by `snapshot.activate()`.
+reference_tables = {}
+# Number of writes to each table through this module. Lets caches, e.g. `classifications`, tell they are outdated.
+table_versions = {}
+
+
+def table_changed(table):
+    """
+    To be called by every function that writes to a table.
+    """
+    # The snapshot does not know about the new rows anymore, fall back to the database for this table
+    reference_tables.pop(table, None)
+    table_versions[table] = table_versions.get(table, 0) + 1
+
+
+def get_sql_table_as_df(table, columns=['*'], db=None, index='id', addSQL='',
+                        use_snapshot=True):
     """
     Download a table from the SQL database and return it as a nice dataframe.
 
-    :param conn: Database connection. No need to worry. The decorator takes care of this.
+    If a snapshot of the reference tables is active (see `snapshot.activate()`), plain reads of a snapshotted table,
+    i.e. without `addSQL`, are served from the local snapshot instead of the database.
+
     :param table: table name
     :param columns: List of columns to get from the SQL table
-    :param db: database name
+    :param db: database name. Default: database()
     :param index: Column name to be used as dataframe index. String.
     :param addSQL: Add more arguments to the SQL query, e.g. "WHERE classification_id = 1"
+    :param use_snapshot: If False, always query the database even if a snapshot is active
     :return: Dataframe of SQL table
     """
+    if db is None:
+        db = database()
+    if use_snapshot and table in reference_tables and not addSQL and db == database():
+        return get_snapshot_table_as_df(table, columns, index)
+    return _get_sql_table_as_df(table, columns, db, index, addSQL)
+
+
+@db_conn
+def _get_sql_table_as_df(conn, table, columns, db, index, addSQL):
     # Don't show this to anybody, please. SQL injections are a big nono...
     # https://www.w3schools.com/sql/sql_injection.asp
     columns = ', '.join(c for c in columns if c not in "'[]")
@@ -105,6 +210,125 @@ def get_sql_table_as_df(conn, table, columns=['*'], db=IEDC_pass.IEDC_database,
     return df
 
 
+def get_snapshot_table_as_df(table, columns=['*'], index='id'):
+    """
+    Same as `get_sql_table_as_df()`, but reads from the active snapshot of the reference tables.
+
+    :param table: table name
+    :param columns: List of columns to get from the table
+    :param index: Column name to be used as dataframe index. String.
+    :return: Dataframe of the snapshot table. A copy, so callers may modify it.
+    """
+    df = reference_tables[table]
+    if index != df.index.name:
+        df = df.reset_index()
+        if index is not None:
+            df = df.set_index(index)
+    if columns != ['*']:
+        df = df[[c for c in columns if c != index]]
+    return df.copy()
+
+
+@db_conn
+def get_sql_table_state(conn, table, db=None):
+    """
+    Returns row count and highest id of a table. A cheap way to tell if a table has changed.
+
+    :param conn: Database connection. No need to worry. The decorator takes care of this.
+    :param table: table name
+    :param db: database name. Default: database()
+    :return: Dictionary with 'rows' and 'max_id'
+    """
+    if db is None:
+        db = database()
+    curs = conn.cursor()
+    curs.execute("SELECT COUNT(*), MAX(id) FROM %s.%s;" % (db, table))
+    rows, max_id = curs.fetchone()
+    curs.close()
+    return {'rows': int(rows), 'max_id': None if max_id is None else int(max_id)}
+
+
+def stream_sql_query(sql, args=None, chunk_size=100000):
+    """
+    Runs a query with a server-side cursor, i.e. without loading the whole result into memory, and yields it in
+    chunks. The connection stays open until the generator is exhausted or closed.
+
+    :param sql: SQL query, with `%s` placeholders for `args`
+    :param args: Query parameters
+    :param chunk_size: Number of rows per chunk
+    :return: Generator of dataframes
+    """
+    conn = _open()
+    try:
+        if connection_factory is None:
+            curs = conn.cursor(pymysql.cursors.SSCursor)
+        else:
+            # e.g. SQLite cursors fetch lazily anyway
+            curs = conn.cursor()
+        if args is None:
+            curs.execute(sql)
+        else:
+            curs.execute(sql, args)
+        columns = [d[0] for d in curs.description]
+        while True:
+            rows = curs.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield pd.DataFrame(list(rows), columns=columns)
+        curs.close()
+    finally:
+        conn.close()
+
+
+# MySQL session variables of bulk_load_session()
+BULK_LOAD_SETTINGS = {'unique_checks': 0, 'foreign_key_checks': 0, 'autocommit': 0}
+
+
+@contextlib.contextmanager
+def bulk_load_session(local_infile=False):
+    """
+    A database connection for loading many rows: InnoDB's unique and foreign key checks are switched off for the
+    session, and so is autocommit, i.e. the caller commits. The rows written in the session are not checked, so
+    check them afterwards, see `checkpoint.verify_load()`. On exit, also after an error, uncommitted rows are rolled
+    back, the session settings restored, and the connection closed. In SQLite, e.g. a stand-in database, only the
+    foreign key checks can be switched off.
+
+    :param local_infile: Allow LOAD DATA LOCAL INFILE on the connection, see `columnar.load_data_sql()`. The server
+        must allow it as well (`local_infile`). MySQL only.
+
+    Usage:
+        with dbio.bulk_load_session() as conn:
+            ...
+    """
+    conn = _open(local_infile)
+    curs = conn.cursor()
+    saved = None
+    try:
+        if _is_sqlite(conn):
+            curs.execute("PRAGMA foreign_keys;")
+            saved = curs.fetchone()[0]
+            curs.execute("PRAGMA foreign_keys = OFF;")
+        else:
+            curs.execute("SELECT %s;" % ', '.join('@@SESSION.%s' % v for v in BULK_LOAD_SETTINGS))
+            saved = dict(zip(BULK_LOAD_SETTINGS, curs.fetchone()))
+            curs.execute("SET SESSION %s;" % ', '.join('%s = %s' % v for v in BULK_LOAD_SETTINGS.items()))
+        yield conn
+    finally:
+        # The connection may be dead, e.g. after the error that ended the session. Errors of the clean-up must not hide
+        # that error, and the session settings end with the connection anyway.
+        with contextlib.suppress(Exception):
+            # Before autocommit is switched back on, which would commit them
+            conn.rollback()
+            if saved is not None and _is_sqlite(conn):
+                curs.execute("PRAGMA foreign_keys = %s;" % int(saved))
+            elif saved is not None:
+                curs.execute("SET SESSION %s;" % ', '.join('%s = %s' % (v, int(saved[v])) for v in saved))
+        with contextlib.suppress(Exception):
+            curs.close()
+        with contextlib.suppress(Exception):
+            conn.close()
+
+
 @db_cursor_write
 def run_this_command(curs, sql_cmd):
     curs.execute(sql_cmd)
@@ -112,6 +336,7 @@ def run_this_command(curs, sql_cmd):
 
 @db_cursor_write
 def dict_sql_insert(curs, table, d):
+    table_changed(table)
     # https://stackoverflow.com/a/14834646/2075003
     placeholder = ", ".join(["%s"] * len(d))
     sql = "INSERT INTO `{table}` ({columns}) VALUES ({values});".format(table=table, columns=",".join(d.keys()),
@@ -128,6 +353,7 @@ def bulk_sql_insert(curs, table, cols, data):
     :param data: data as list
     :return:
     """
+    table_changed(table)
     sql = """
           INSERT INTO %s
           (%s)
@@ -135,3 +361,241 @@ def bulk_sql_insert(curs, table, cols, data):
           """ % (table, ', '.join(cols), ','.join([' %s' for _ in cols]))
     curs.executemany(sql, data)
 
+
+def insert_ids(curs, table, cols, data, key):
+    """
+    Inserts rows like bulk_sql_insert() and returns their ids. The ids are selected by a column that identifies the
+    new rows, in the same transaction, as ids of multi-row inserts need not be consecutive. Takes the cursor of the
+    caller's transaction, e.g. of a function decorated with db_cursor_write, so more rows can be written with it.
+
+    :param curs: Cursor
+    :param table: table name
+    :param cols: Column names
+    :param data: data as list of lists
+    :param key: Column with a distinct value for each new row, e.g. 'classification_name'
+    :return: Dictionary of key value: id
+    """
+    table_changed(table)
+    sql = "INSERT INTO %s (%s) VALUES (%s);" % (table, ', '.join(cols), ', '.join(['%s'] * len(cols)))
+    curs.executemany(sql, data)
+    keys = [row[list(cols).index(key)] for row in data]
+    ids = {}
+    for start in range(0, len(keys), 1000):
+        chunk = keys[start:start + 1000]
+        # Newest last, i.e. it wins if a value was in the table before
+        curs.execute("SELECT %s, id FROM %s WHERE %s IN (%s) ORDER BY id;" %
+                     (key, table, key, ', '.join(['%s'] * len(chunk))), chunk)
+        ids.update((k, int(i)) for k, i in curs.fetchall())
+    return ids
+
+
+@db_cursor_write
+def dict_sql_update(curs, table, d, row_id):
+    """
+    Updates one row of a table in place.
+
+    :param table: table name
+    :param d: Dictionary of column: new value
+    :param row_id: id of the row to update
+    """
+    table_changed(table)
+    assignments = ", ".join(["`%s` = %%s" % c for c in d.keys()])
+    sql = "UPDATE `{table}` SET {assignments} WHERE id = %s;".format(table=table, assignments=assignments)
+    curs.execute(sql, list(d.values()) + [row_id])
+
+
+@db_cursor_write
+def bulk_sql_delete(curs, table, ids):
+    """
+    Deletes rows of a table by their id.
+
+    :param table: table name
+    :param ids: List of ids
+    """
+    if not ids:
+        return
+    table_changed(table)
+    curs.execute("DELETE FROM %s WHERE id IN (%s);" % (table, ', '.join(['%s'] * len(ids))), ids)
+
+
+# Indexes the queries of the library rely on: table, columns, and a typical statement filtering on them. An index
+# whose first columns are these columns serves as well.
+QUERY_INDEXES = [
+    ('classification_items', ['classification_id', 'attribute1_oto'],
+     "SELECT id, attribute1_oto FROM classification_items WHERE classification_id = 1"),
+    ('data', ['dataset_id'],
+     "SELECT id FROM data WHERE dataset_id = 1 ORDER BY id LIMIT 10000"),
+    ('datasets', ['dataset_name', 'dataset_version'],
+     "SELECT id FROM datasets WHERE dataset_name = 'name' AND dataset_version = 'v1.0'"),
+    ('dataset_fingerprints', ['fingerprint'],
+     "SELECT dataset_id FROM dataset_fingerprints WHERE fingerprint = 'hash'"),
+]
+# MySQL can only index the first characters of TEXT columns
+INDEX_PREFIX_LENGTH = 191
+
+
+def _is_sqlite(conn):
+    return isinstance(conn, sqlite3.Connection)
+
+
+@db_conn
+def get_indexes(conn, db=None):
+    """
+    Lists the tables of the database and their indexes. Works with MySQL and the SQLite stand-in (see `standin`).
+
+    :param conn: Database connection. No need to worry. The decorator takes care of this.
+    :param db: database name. Default: database()
+    :return: Dataframe with columns table, index, columns (tuple), unique, primary. Tables without index have one row
+        with index None.
+    """
+    if db is None:
+        db = database()
+    curs = conn.cursor()
+    rows = []
+    if _is_sqlite(conn):
+        curs.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';")
+        for (table,) in curs.fetchall():
+            curs.execute("PRAGMA index_list('%s');" % table)
+            indexes = curs.fetchall()
+            for index in indexes:
+                curs.execute("PRAGMA index_info('%s');" % index[1])
+                columns = tuple(c[2] for c in sorted(curs.fetchall()))
+                rows.append((table, index[1], columns, bool(index[2]), index[3] == 'pk'))
+            if not indexes:
+                rows.append((table, None, (), False, False))
+    else:
+        curs.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s;", (db,))
+        tables = [t for (t,) in curs.fetchall()]
+        curs.execute("SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS "
+                     "WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;", (db,))
+        columns = {}
+        for table, index, non_unique, column in curs.fetchall():
+            columns.setdefault((table, index, not non_unique), []).append(column)
+        rows = [(t, i, tuple(c), u, i == 'PRIMARY') for (t, i, u), c in columns.items()]
+        rows += [(t, None, (), False, False) for t in tables if t not in {r[0] for r in rows}]
+    curs.close()
+    return pd.DataFrame(rows, columns=['table', 'index', 'columns', 'unique', 'primary'])
+
+
+@db_conn
+def get_index_usage(conn, db=None):
+    """
+    How often each index was used since the MySQL server started, from `performance_schema`.
+
+    :param conn: Database connection. No need to worry. The decorator takes care of this.
+    :param db: database name. Default: database()
+    :return: Dictionary of (table, index): count. None if the statistics are not available, e.g. for SQLite.
+    """
+    if db is None:
+        db = database()
+    if _is_sqlite(conn):
+        return None
+    curs = conn.cursor()
+    try:
+        curs.execute("SELECT OBJECT_NAME, INDEX_NAME, COUNT_STAR FROM "
+                     "performance_schema.table_io_waits_summary_by_index_usage "
+                     "WHERE OBJECT_SCHEMA = %s AND INDEX_NAME IS NOT NULL;", (db,))
+    except pymysql.err.MySQLError as e:
+        print("Index usage statistics not available: %s" % e)
+        return None
+    usage = {(table, index): int(count) for table, index, count in curs.fetchall()}
+    curs.close()
+    return usage
+
+
+@db_conn
+def explain(conn, sql):
+    """
+    Returns the query plan of a statement, from `EXPLAIN` (MySQL) or `EXPLAIN QUERY PLAN` (SQLite).
+
+    :param conn: Database connection. No need to worry. The decorator takes care of this.
+    :param sql: SQL statement
+    :return: Dataframe, one row per step of the plan
+    """
+    curs = conn.cursor()
+    curs.execute(("EXPLAIN QUERY PLAN " if _is_sqlite(conn) else "EXPLAIN ") + sql)
+    columns = [d[0] for d in curs.description]
+    plan = pd.DataFrame(list(curs.fetchall()), columns=columns)
+    curs.close()
+    return plan
+
+
+def _plan_summary(plan):
+    """
+    One line per step of a query plan, e.g. 'SEARCH data USING INDEX ix_data_dataset_id (dataset_id=?)'.
+    """
+    if 'detail' in plan.columns:
+        return '; '.join(plan['detail'])
+    return '; '.join("%s: type=%s key=%s rows=%s" % (r['table'], r['type'], r['key'], r['rows'])
+                     for _, r in plan.iterrows())
+
+
+@db_cursor_write
+def create_index(curs, table, columns, name=None):
+    """
+    Creates an index. TEXT columns are indexed by their first INDEX_PREFIX_LENGTH characters on MySQL.
+
+    :param table: table name
+    :param columns: List of column names
+    :param name: Name of the index. Default: ix_<table>_<columns>
+    """
+    if name is None:
+        name = 'ix_%s_%s' % (table, '_'.join(columns))
+    keys = list(columns)
+    if not _is_sqlite(curs.connection):
+        curs.execute("SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                     "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s;", (table,))
+        types = dict(curs.fetchall())
+        keys = ['%s(%s)' % (c, INDEX_PREFIX_LENGTH) if types.get(c, '').endswith(('text', 'blob')) else c
+                for c in columns]
+    curs.execute("CREATE INDEX %s ON %s (%s);" % (name, table, ', '.join(keys)))
+
+
+def check_indexes(create=False, db=None, verbose=True):
+    """
+    Compares the indexes of the database with the ones the queries of the library rely on (QUERY_INDEXES), shows the
+    query plans of these queries, and lists indexes the library doesn't need. Works with MySQL and the SQLite
+    stand-in.
+
+    :param create: Create the missing indexes
+    :param db: database name. Default: database()
+    :param verbose: Print the report
+    :return: Dictionary with two dataframes: 'needed', i.e. QUERY_INDEXES with their status ('ok', 'missing',
+        'created', 'no table', or the error of the create statement) and query plan, and 'other', the other
+        indexes of these tables with their use count, if the server keeps statistics
+    """
+    indexes = get_indexes(db)
+    needed = []
+    serving = set()
+    for table, columns, sql in QUERY_INDEXES:
+        existing = indexes[(indexes['table'] == table) & indexes['index'].notna()]
+        if table not in indexes['table'].values:
+            needed.append((table, tuple(columns), None, 'no table', None))
+            continue
+        match = existing.loc[[list(c[:len(columns)]) == columns for c in existing['columns']]]
+        if len(match.index):
+            status, name = 'ok', match['index'].iloc[0]
+            serving.update(zip(match['table'], match['index']))
+        elif create:
+            name = 'ix_%s_%s' % (table, '_'.join(columns))
+            try:
+                create_index(table, columns, name)
+                status = 'created'
+            except Exception as e:
+                status, name = 'failed: %s' % e, None
+        else:
+            status, name = 'missing', None
+        needed.append((table, tuple(columns), name, status, _plan_summary(explain(sql))))
+    needed = pd.DataFrame(needed, columns=['table', 'columns', 'index', 'status', 'plan'])
+    usage = get_index_usage(db)
+    tables = [t for t, _, _ in QUERY_INDEXES]
+    other = indexes[indexes['table'].isin(tables) & indexes['index'].notna() & ~indexes['primary']].copy()
+    other = other.loc[[(t, i) not in serving for t, i in zip(other['table'], other['index'])]]
+    other['uses'] = [None if usage is None else usage.get((t, i), 0) for t, i in zip(other['table'], other['index'])]
+    if verbose:
+        print("Indexes needed by IEDC_tools:")
+        print(needed.to_string(index=False))
+        print("Other indexes of these tables (not used by IEDC_tools, 'uses' since server start if available):")
+        print(other[['table', 'index', 'columns', 'uses']].to_string(index=False) if len(other.index) else "None")
+    return {'needed': needed,
+            'other': other}
@@ -0,0 +1,102 @@
+"""
+Functions to (chain-) delete datasets and their custom classifications from the database.
+
+Large tables are deleted in batches of primary key ranges. Every batch is a transaction of its own, so deleting a
+multi-million row dataset does not lock the tables for long or produce one huge binlog event.
+"""
+import time
+
+from IEDC_tools import catalog, checkpoint, dbio, fingerprint
+
+
+def delete_dataset(dataset_id, classifications=True, batch_size=10000, verbose=True):
+    """
+    Deletes a dataset's rows in the `data` table, its entry in the `datasets` table, and its custom classifications in
+    `classification_items` and `classification_definition`.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param classifications: Also delete the dataset's custom classifications. They are kept if another dataset uses
+        them, e.g. another version of the same dataset.
+    :param batch_size: Number of rows deleted per transaction
+    :param verbose: Print progress
+    :return: Dictionary of table: number of rows deleted
+    """
+    dataset_id = int(dataset_id)
+    db_datasets = dbio.get_sql_table_as_df('datasets', use_snapshot=False)
+    assert dataset_id in db_datasets.index, "dataset_id '%s' not found in table 'datasets'" % dataset_id
+    # Foreign keys: data -> datasets -> classification_definition, data -> classification_items
+    custom = get_custom_classifications(dataset_id, db_datasets) if classifications else []
+    res = {'data': delete_in_batches('data', 'dataset_id', dataset_id, batch_size, verbose)}
+    checkpoint.clear_checkpoints(dataset_id)
+    fingerprint.clear(dataset_id)
+    catalog.clear(dataset_id)
+    dbio.bulk_sql_delete('datasets', [dataset_id])
+    res['datasets'] = 1
+    if classifications:
+        res['classification_items'] = 0
+        for class_id in custom:
+            res['classification_items'] += delete_in_batches('classification_items', 'classification_id', class_id,
+                                                             batch_size, verbose)
+        dbio.bulk_sql_delete('classification_definition', custom)
+        res['classification_definition'] = len(custom)
+    if verbose:
+        print("Deleted dataset_id %s: %s" % (dataset_id, ', '.join('%s rows from %s' % (n, t) for t, n in res.items())))
+    return res
+
+
+def get_custom_classifications(dataset_id, db_datasets=None):
+    """
+    Returns the ids of the custom classifications that were created for a dataset and are not used by any other
+    dataset.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param db_datasets: `datasets` table, will be downloaded if not given
+    :return: List of classification ids
+    """
+    if db_datasets is None:
+        db_datasets = dbio.get_sql_table_as_df('datasets', use_snapshot=False)
+    class_cols = [c for c in db_datasets.columns if c.startswith('aspect_') and c.endswith('_classification')]
+    used = db_datasets[class_cols]
+    own = set(used.loc[dataset_id].dropna().astype(int))
+    others = set(used.drop(dataset_id).stack().dropna().astype(int))
+    db_classdef = dbio.get_sql_table_as_df('classification_definition', use_snapshot=False)
+    custom = db_classdef[(db_classdef['created_from_dataset'] == 1) &
+                         db_classdef['classification_name'].str.endswith('__' + db_datasets.loc[dataset_id,
+                                                                                               'dataset_name'])]
+    return sorted(i for i in own.difference(others) if i in custom.index)
+
+
+def delete_in_batches(table, column, value, batch_size=10000, verbose=True):
+    """
+    Deletes all rows of a table where `column` = `value`, in batches of ascending primary key ranges.
+
+    :param table: table name
+    :param column: column name, e.g. 'dataset_id'
+    :param value: value of the column
+    :param batch_size: Number of rows deleted per transaction
+    :param verbose: Print progress
+    :return: Number of rows deleted
+    """
+    total = dbio.get_sql_table_as_df(table, ['COUNT(*) AS n'], index=None, use_snapshot=False,
+                                     addSQL="WHERE %s = %s" % (column, int(value)))['n'][0]
+    deleted = 0
+    start = time.time()
+    while True:
+        ids = dbio.get_sql_table_as_df(table, ['id'], index=None, use_snapshot=False,
+                                       addSQL="WHERE %s = %s ORDER BY id LIMIT %s" %
+                                              (column, int(value), int(batch_size)))['id']
+        if ids.empty:
+            break
+        deleted += _delete_range(table, column, int(value), int(ids.iloc[0]), int(ids.iloc[-1]))
+        if verbose:
+            print("Deleting from %s where %s = %s: %s of %s rows (%.0f rows/s)" %
+                  (table, column, value, deleted, total, deleted / max(time.time() - start, 1e-9)))
+    return deleted
+
+
+@dbio.db_cursor_write
+def _delete_range(curs, table, column, value, id_from, id_to):
+    dbio.table_changed(table)
+    curs.execute("DELETE FROM %s.%s WHERE %s = %%s AND id BETWEEN %%s AND %%s;" %
+                 (dbio.database(), table, column), (value, id_from, id_to))
+    return curs.rowcount
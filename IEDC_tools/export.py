@@ -0,0 +1,282 @@
+"""
+Export of uploaded datasets, i.e. the way back from the `data` table to a data template. Rows are streamed from the
+database with a server-side cursor and the ids of classification items and units are translated back to names, so even
+datasets with millions of rows can be written to Parquet or CSV in bounded memory.
+
+`get_dataset()` returns a dataset ready for analysis and keeps a copy in a local cache, which is used as long as the
+dataset's catalog entry and data don't change.
+
+Usage example:
+    export.export_dataset(42, 'dataset_42.parquet')
+    table = export.get_table(42, col_aspects=['time'])
+    df = export.get_dataset('1_F_steel_SankeyFlows_2008_Global', version='v1.0')
+"""
+import glob
+import hashlib
+import json
+import os
+
+from IEDC_tools import classifications, dbio, fingerprint, lazy
+
+pd = lazy.lazy_import('pandas')
+pa = lazy.lazy_import('pyarrow')
+pq = lazy.lazy_import('pyarrow.parquet')
+
+# Columns of the `data` table next to the aspects, and what they are called in the export. Same as in the LIST template,
+# except for the stats array, which is exported as its four numbers instead of the string.
+VALUE_COLUMNS = {'value': 'value',
+                 'unit_nominator': 'unit nominator',
+                 'unit_denominator': 'unit denominator',
+                 'stats_array_1': 'stats_array_1',
+                 'stats_array_2': 'stats_array_2',
+                 'stats_array_3': 'stats_array_3',
+                 'stats_array_4': 'stats_array_4',
+                 'comment': 'comment'}
+# Local cache of get_dataset(). Bump CACHE_FORMAT when the cached frames change shape.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'IEDC_tools')
+CACHE_FORMAT = 1
+
+
+def get_dataset_aspects(dataset_id, db_datasets=None, db_aspects=None):
+    """
+    The aspects of a dataset according to its entry in the `datasets` table.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param db_datasets: The `datasets` table, or a part of it with this dataset, if it was read already
+    :param db_aspects: The `aspects` table, if it was read already
+    :return: Dataframe indexed by the column name in the `data` table, e.g. 'aspect1', with the aspect name ('aspect')
+        and the id of its classification ('classification_id')
+    """
+    if db_datasets is None:
+        db_datasets = dbio.get_sql_table_as_df('datasets', addSQL="WHERE id = %s" % int(dataset_id))
+    assert int(dataset_id) in db_datasets.index, "dataset_id '%s' not found in table 'datasets'" % dataset_id
+    entry = db_datasets.loc[int(dataset_id)]
+    if db_aspects is None:
+        db_aspects = dbio.get_sql_table_as_df('aspects')
+    aspects = []
+    n = 1
+    while 'aspect_%s' % n in entry.index:
+        if not pd.isna(entry['aspect_%s' % n]):
+            aspects.append({'column': 'aspect%s' % n,
+                            'aspect': db_aspects.loc[int(entry['aspect_%s' % n]), 'aspect'],
+                            'classification_id': int(entry['aspect_%s_classification' % n])})
+        n += 1
+    return pd.DataFrame(aspects, columns=['column', 'aspect', 'classification_id']).set_index('column')
+
+
+def stream_dataset(dataset_id, attributes=None, chunk_size=100000):
+    """
+    Reads a dataset from the `data` table chunk by chunk, with names instead of ids.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param attributes: Dictionary of aspect: attribute number used for the names. Default: 1, i.e. `attribute1_oto`.
+        The attribute numbers of the original file are not stored in the database.
+    :param chunk_size: Number of rows per chunk
+    :return: Generator of dataframes with one column per aspect (categorical) and the columns in VALUE_COLUMNS
+    """
+    aspects = get_dataset_aspects(dataset_id)
+    attributes = attributes or {}
+    units = dbio.get_sql_table_as_df('units')['unitcode']
+    sql = "SELECT %s FROM %s.data WHERE dataset_id = %%s ORDER BY id;" % \
+          (', '.join(list(aspects.index) + list(VALUE_COLUMNS)), dbio.database())
+    for chunk in dbio.stream_sql_query(sql, (int(dataset_id),), chunk_size):
+        df = pd.DataFrame(index=chunk.index)
+        for column in aspects.index:
+            aspect = aspects.loc[column, 'aspect']
+            df[aspect] = classifications.decode(aspects.loc[column, 'classification_id'], attributes.get(aspect, 1),
+                                                chunk[column])
+        for column, name in VALUE_COLUMNS.items():
+            if column.startswith('unit'):
+                df[name] = chunk[column].map(units)
+            elif column == 'stats_array_1':
+                df[name] = pd.to_numeric(chunk[column]).astype('Int64')  # distribution type
+            elif column == 'comment':
+                df[name] = chunk[column]
+            else:
+                df[name] = pd.to_numeric(chunk[column]).astype(float)
+        yield df
+
+
+def export_dataset(dataset_id, file, attributes=None, chunk_size=100000):
+    """
+    Writes a dataset in long format, i.e. like the Data sheet of the LIST template, to a Parquet or CSV file.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param file: Filename. The extension ('.parquet' or '.csv') determines the format.
+    :param attributes: Dictionary of aspect: attribute number used for the names, see stream_dataset()
+    :param chunk_size: Number of rows held in memory at a time
+    :return: Number of rows written
+    """
+    ext = os.path.splitext(file)[1].lower()
+    assert ext in ('.parquet', '.csv'), "Can only export to '.parquet' or '.csv', not '%s'" % ext
+    aspects = get_dataset_aspects(dataset_id)
+    rows = 0
+    writer = None
+    try:
+        for chunk in stream_dataset(dataset_id, attributes, chunk_size):
+            if ext == '.csv':
+                chunk.to_csv(file, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=_parquet_schema(aspects), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(file, table.schema, compression='zstd')
+                writer.write_table(table)
+            rows += len(chunk.index)
+    finally:
+        if writer is not None:
+            writer.close()
+    if rows == 0:
+        # Still write the header, so an empty dataset gives an empty file rather than none
+        empty = pd.DataFrame(columns=list(aspects['aspect']) + list(VALUE_COLUMNS.values()))
+        if ext == '.csv':
+            empty.to_csv(file, index=False)
+        else:
+            pq.write_table(pa.Table.from_pandas(empty, schema=_parquet_schema(aspects), preserve_index=False), file)
+    print("Exported %s rows of dataset_id %s to '%s'" % (rows, dataset_id, file))
+    return rows
+
+
+def get_table(dataset_id, col_aspects=None, values='value', attributes=None, chunk_size=100000):
+    """
+    Reads a dataset in wide format, i.e. like the Data sheet of the TABLE template: row aspects as (Multi)Index and
+    column aspects as (Multi)Index of the columns. The result is held in memory, of course.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param col_aspects: List of the aspects in the columns. Default: the last aspect
+    :param values: Column to put in the cells, e.g. 'unit nominator' for the Unit_nominator sheet
+    :param attributes: Dictionary of aspect: attribute number used for the names, see stream_dataset()
+    :param chunk_size: Number of rows read at a time
+    :return: Dataframe
+    """
+    names = list(get_dataset_aspects(dataset_id)['aspect'])
+    if col_aspects is None:
+        col_aspects = names[-1:]
+    row_aspects = [a for a in names if a not in col_aspects]
+    assert row_aspects and col_aspects, "A table needs at least one row and one column aspect"
+    # Only keep the columns needed. The aspects stay categorical until all chunks are together.
+    chunks = [chunk[names + [values]] for chunk in stream_dataset(dataset_id, attributes, chunk_size)]
+    if not chunks:
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[]] * len(row_aspects), names=row_aspects),
+                            columns=pd.MultiIndex.from_arrays([[]] * len(col_aspects), names=col_aspects))
+    data = pd.concat(chunks, ignore_index=True)
+    for aspect in names:
+        data[aspect] = data[aspect].astype(str)
+    table = data.set_index(names)[values].unstack(col_aspects)
+    table.columns.names = col_aspects
+    return table
+
+
+def get_dataset(dataset, version=None, attributes=None, use_cache=True, cache_dir=None):
+    """
+    Reads a dataset as dataframe indexed by its aspects, like `file_io.read_candidate_data_table()` does for a file,
+    with the value, units, stats array, and comment as columns.
+
+    The result is cached on local disk. The cached copy is used as long as the dataset's entry in the `datasets` table
+    and its rows in the `data` table are unchanged, see dataset_version().
+
+    :param dataset: dataset_id, or dataset_name
+    :param version: dataset_version, if `dataset` is a name
+    :param attributes: Dictionary of aspect: attribute number used for the names, see stream_dataset()
+    :param use_cache: If False, always read from the database and don't touch the cache
+    :param cache_dir: Default: CACHE_DIR
+    :return: Dataframe
+    """
+    dataset_id = find_dataset_id(dataset, version)
+    if not use_cache:
+        return _read_dataset(dataset_id, attributes)
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    file = os.path.join(cache_dir, 'dataset_%s_%s.parquet' % (dataset_id, dataset_version(dataset_id, attributes)))
+    if os.path.exists(file):
+        return pd.read_parquet(file)
+    df = _read_dataset(dataset_id, attributes)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Outdated copies of the dataset
+    for old in glob.glob(os.path.join(cache_dir, 'dataset_%s_*.parquet' % dataset_id)):
+        os.remove(old)
+    # Write to a temporary file first, so an interrupted write does not leave a broken cache file
+    df.to_parquet(file + '.tmp', compression='zstd')
+    os.replace(file + '.tmp', file)
+    return df
+
+
+def find_dataset_id(dataset, version=None):
+    """
+    Looks up a dataset in the `datasets` catalog.
+
+    :param dataset: dataset_id, or dataset_name
+    :param version: dataset_version, if `dataset` is a name. May be omitted if there is only one version.
+    :return: dataset_id
+    """
+    db_datasets = dbio.get_sql_table_as_df('datasets', columns=['id', 'dataset_name', 'dataset_version'])
+    if not isinstance(dataset, str):
+        assert int(dataset) in db_datasets.index, "dataset_id '%s' not found in table 'datasets'" % dataset
+        return int(dataset)
+    candidates = db_datasets[db_datasets['dataset_name'] == dataset]
+    if version is not None:
+        candidates = candidates[candidates['dataset_version'] == version]
+    assert len(candidates.index) > 0, "Dataset '%s' (version %s) not found in table 'datasets'" % (dataset, version)
+    assert len(candidates.index) == 1, "Dataset '%s' has several versions, please choose one: %s" % \
+        (dataset, candidates['dataset_version'].tolist())
+    return int(candidates.index[0])
+
+
+def dataset_version(dataset_id, attributes=None):
+    """
+    A hash of a dataset's entry in the `datasets` table and the version of its rows in the `data` table, i.e. changes
+    whenever the dataset is changed, see `validate.update_data()`, replaced, or its catalog entry is updated.
+
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param attributes: Dictionary of aspect: attribute number used for the names, see stream_dataset()
+    :return: Hex string
+    """
+    dataset_id = int(dataset_id)
+    entry = dbio.get_sql_table_as_df('datasets', addSQL="WHERE id = %s" % dataset_id)
+    h = hashlib.sha1()
+    h.update(json.dumps([CACHE_FORMAT, attributes or {}], sort_keys=True).encode())
+    h.update(entry.to_json().encode())
+    h.update(_data_version(dataset_id).encode())
+    return h.hexdigest()[:16]
+
+
+def _data_version(dataset_id):
+    """
+    The exact version of a dataset's rows: the fingerprint recorded by the upload, which is cleared before and recorded
+    again after any change of the rows. Without a fingerprint, e.g. for datasets uploaded before fingerprints existed,
+    a checksum of every row is computed by the database.
+    """
+    fp = fingerprint.get(dataset_id)
+    if fp is not None:
+        return 'fingerprint %s' % fp
+    columns = ['id'] + list(get_dataset_aspects(dataset_id).index) + list(VALUE_COLUMNS)
+    # CONCAT_WS skips NULLs, so they get a value of their own. XOR of the rows' hashes doesn't depend on the order.
+    # Not CRC32: it is linear, so XOR of the CRCs stays the same if two rows of equal length swap a value.
+    row = "CONV(SUBSTR(MD5(CONCAT_WS('|', %s)), 1, 15), 16, 10)" % \
+        ', '.join("IFNULL(%s, '\\\\N')" % c for c in columns)
+    state = dbio.get_sql_table_as_df('data', ['COUNT(*)', 'BIT_XOR(%s)' % row], index=None,
+                                     addSQL="WHERE dataset_id = %s" % dataset_id)
+    return 'checksum %s' % ' '.join(str(v) for v in state.iloc[0])
+
+
+def _read_dataset(dataset_id, attributes):
+    aspects = list(get_dataset_aspects(dataset_id)['aspect'])
+    chunks = list(stream_dataset(dataset_id, attributes))
+    if not chunks:
+        return pd.DataFrame(columns=list(VALUE_COLUMNS.values()),
+                            index=pd.MultiIndex.from_arrays([[]] * len(aspects), names=aspects))
+    df = pd.concat(chunks, ignore_index=True)
+    for aspect in aspects:
+        df[aspect] = df[aspect].astype(str)
+    return df.set_index(aspects)
+
+
+def _parquet_schema(aspects):
+    fields = [(a, pa.string()) for a in aspects['aspect']]
+    for column, name in VALUE_COLUMNS.items():
+        if column in ('unit_nominator', 'unit_denominator', 'comment'):
+            fields.append((name, pa.string()))
+        elif column == 'stats_array_1':
+            fields.append((name, pa.int64()))
+        else:
+            fields.append((name, pa.float64()))
+    return pa.schema(fields)
@@ -4,12 +4,30 @@ Functions for file input-output operations.
 
 import os
 
-import openpyxl
-import numpy as np
-import pandas as pd
+from IEDC_tools import dbio, integrity, lazy, profiling
 
-import IEDC_paths
-from IEDC_tools import dbio
+openpyxl = lazy.lazy_import('openpyxl')
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+IEDC_paths = lazy.lazy_import('IEDC_paths')
+
+# Types of the columns of the Data sheet of LIST templates, applied when a file is read. All other columns are aspects,
+# see ASPECT_DTYPE. 'float64': numbers, where empty cells and NULL_MARKERS are NaN. 'category' and 'str': strings,
+# categorical for columns with few distinct values. Empty cells stay NaN.
+LIST_SCHEMA = {'value': 'float64',
+               'unit nominator': 'category',
+               'unit denominator': 'category',
+               'stats_array string': 'str',
+               'comment': 'str'}
+# Types of the cells of the sheets of TABLE templates. Row and column labels, i.e. the aspects, are read as strings.
+TABLE_SCHEMA = {'Data': 'float64',
+                'Unit_nominator': 'str',
+                'Unit_denominator': 'str',
+                'stats_array_string': 'str',
+                'Comment': 'str'}
+ASPECT_DTYPE = 'category'
+# Cell values that mean "no value" in number columns, on top of the empty cells and pandas' defaults, e.g. 'NULL'
+NULL_MARKERS = ['none', 'na', 'nan']
 
 
 def read_input_file(file):
@@ -24,14 +42,16 @@ def read_input_file(file):
     return df
 
 
-def get_candidate_filenames(path=IEDC_paths.candidates, verbose=False):
+def get_candidate_filenames(path=None, verbose=False):
     """
     Browses a directory and returns the filenames as a list.
 
-    :param path: The directory of the files to be scanned
+    :param path: The directory of the files to be scanned. Default: IEDC_paths.candidates
     :param verbose: Print some info. Options are 1 (count) and 2 (all names)
     :return: List of filenames
     """
+    if path is None:
+        path = IEDC_paths.candidates
     # Let's exclude temporary and hidden files
     # TODO: Will probably need more love for Windows...
     exclude_first_letter = ['.', '~']
@@ -47,7 +67,8 @@ def get_candidate_filenames(path=IEDC_paths.candidates, verbose=False):
     return files
 
 
-def read_candidate_meta(file, path=IEDC_paths.candidates):
+@profiling.stage('read_candidate_meta')
+def read_candidate_meta(file, path=None):
     """
     Will read a candidate file and return its metadata.
 
@@ -55,9 +76,11 @@ def read_candidate_meta(file, path=IEDC_paths.candidates):
     consider for the next template.
 
     :param file: Filename of the file to process
-    :param path: Path of the file
+    :param path: Path of the file. Default: IEDC_paths.candidates
     :return: Dictionary of dataframes for metadata, row_classifications, and data
     """
+    if path is None:
+        path = IEDC_paths.candidates
     # make it a proper path
     file = os.path.join(path, file)
     # Check what type of file this is, i.e. LIST or TABLE formatted data
@@ -110,86 +133,144 @@ def read_candidate_meta(file, path=IEDC_paths.candidates):
             'u_denominator': u_denominator}
 
 
-def read_candidate_data_list(file, path=IEDC_paths.candidates):
+@profiling.stage('read_candidate_data_list')
+def read_candidate_data_list(file, path=None):
     """
     Will read a candidate file and return its data.
 
     :param file: Filename of the file to process
-    :param path: Path of the file
+    :param path: Path of the file. Default: IEDC_paths.candidates
     :return: Dictionary of dataframes for metadata, classifications, and data
     """
+    if path is None:
+        path = IEDC_paths.candidates
     # make it a proper path
     file = os.path.join(path, file)
     data = pd.read_excel(file, sheet_name='Data')
+    text = {}
+    for column in data.columns:
+        data[column], text[column] = _as_dtype(data[column], LIST_SCHEMA.get(column, ASPECT_DTYPE))
+    aspects = [c for c in data.columns if c not in LIST_SCHEMA]
+    integrity.assert_integrity(os.path.basename(file), integrity.check_list(data, aspects, text))
     return data
 
 
-def read_candidate_data_table(file, aspects_table, path=IEDC_paths.candidates):
+@profiling.stage('read_candidate_data_table')
+def read_candidate_data_table(file, aspects_table, path=None):
     """
     Will read a candidate file and return its data.
 
     :param file: Filename of the file to process
-    :param path: Path of the file
+    :param path: Path of the file. Default: IEDC_paths.candidates
     :return: Dictionary of dataframes for metadata, classifications, and data
     """
+    if path is None:
+        path = IEDC_paths.candidates
     row_indices = aspects_table[aspects_table['position'].str.startswith('row')].sort_values('position')['name']
     col_indices = aspects_table[aspects_table['position'].str.startswith('col')].sort_values('position')['name']
     # make it a proper path
     file = os.path.join(path, file)
-    data = pd.read_excel(file, sheet_name='Data', header=[i for i in range(len(col_indices))],
-                         index_col=[i for i in range(len(row_indices))])
-    # Check that same column names are not interpreted once as int and once as str
-    # https://stackoverflow.com/a/54393368/2075003
-    if hasattr(data.columns, 'levels'):
-        # Weird workaroud required https://stackoverflow.com/questions/54393343/harmonise-pandas-multiindex-to-string-when-reading-excel-files/54393368#comment98729305_54393368
-        old_df_codes = data.columns.codes
-        data.columns = pd.MultiIndex.from_product([clevel.astype(str).unique() for clevel in data.columns.levels])
-        data.columns.set_codes(old_df_codes, inplace=True)
-    else:
-        data.columns = data.columns.astype(str).unique()
-    data.columns.names = col_indices
-    data.index.names = row_indices
-    return data
+    return _read_table_sheet(file, 'Data', row_indices, col_indices)
 
 
-def read_units_table(file, row_indices, col_indices, path=IEDC_paths.candidates):
-    # file = os.path.join(path, 'TABLE', file)
-    file = os.path.join(path, file)
-    units = {}
-    for u in ['Unit_nominator', 'Unit_denominator']:
-        units[u] = pd.read_excel(file, sheet_name=u, header=[i for i in range(len(col_indices))],
-                                 index_col=[i for i in range(len(row_indices))])
-        units[u].columns.names = col_indices
-        units[u].index.names = row_indices
-    return units
+def read_units_table(file, row_indices, col_indices, path=None):
+    """
+    Reads the unit sheets of a TABLE template, see read_table_sheets().
+    """
+    return read_table_sheets(file, ['Unit_nominator', 'Unit_denominator'], row_indices, col_indices, path)
 
 
-def read_stats_array_table(file, row_indices, col_indices, path=IEDC_paths.candidates):
-    # file = os.path.join(path, 'TABLE', file)
-    file = os.path.join(path, file)
-    sa_df = pd.read_excel(file, sheet_name='stats_array_string', header=[i for i in range(len(col_indices))],
-                          index_col=[i for i in range(len(row_indices))])
-    sa_df.columns.names = col_indices
-    sa_df.index.names = row_indices
-    return sa_df
+def read_stats_array_table(file, row_indices, col_indices, path=None):
+    """
+    Reads the stats array sheet of a TABLE template, see read_table_sheets().
+    """
+    return read_table_sheets(file, ['stats_array_string'], row_indices, col_indices, path)['stats_array_string']
+
 
+def read_comment_table(file, row_indices, col_indices, path=None):
+    """
+    Reads the comment sheet of a TABLE template, see read_table_sheets().
+    """
+    return read_table_sheets(file, ['Comment'], row_indices, col_indices, path)['Comment']
+
+
+@profiling.stage('read_table_sheets')
+def read_table_sheets(file, sheets, row_indices, col_indices, path=None):
+    """
+    Reads several sheets of a TABLE template in one go, e.g. the unit, stats array and comment sheets.
 
-def read_comment_table(file, row_indices, col_indices, path=IEDC_paths.candidates):
-    # file = os.path.join(path, 'TABLE', file)
+    :param file: Filename of the file to process
+    :param sheets: Sheet names, see TABLE_SCHEMA
+    :param path: Path of the file. Default: IEDC_paths.candidates
+    :return: Dictionary of sheet name: dataframe
+    """
+    if path is None:
+        path = IEDC_paths.candidates
     file = os.path.join(path, file)
-    sa_df = pd.read_excel(file, sheet_name='Comment', header=[i for i in range(len(col_indices))],
-                          index_col=[i for i in range(len(row_indices))])
-    sa_df.columns.names = col_indices
-    sa_df.index.names = row_indices
-    return sa_df
+    return _read_table_sheets(file, sheets, row_indices, col_indices)
+
+
+def _read_table_sheet(file, sheet, row_indices, col_indices):
+    return _read_table_sheets(file, [sheet], row_indices, col_indices)[sheet]
+
+
+def _read_table_sheets(file, sheets, row_indices, col_indices):
+    """
+    Reads sheets of a TABLE template with the aspects in the row and column labels, applies TABLE_SCHEMA, and checks
+    them, see `integrity.check_table()`. The workbook is opened only once.
+    """
+    if not sheets:
+        return {}
+    dfs = pd.read_excel(file, sheet_name=list(sheets), header=[i for i in range(len(col_indices))],
+                        index_col=[i for i in range(len(row_indices))])
+    text = {}
+    for sheet, df in dfs.items():
+        # Excel returns numbers for e.g. years, so the same label could be an int in one place and a str in another
+        df.index = _labels_as_str(df.index, row_indices)
+        df.columns = _labels_as_str(df.columns, col_indices)
+        dfs[sheet], text[sheet] = _as_dtype(df, TABLE_SCHEMA[sheet])
+    integrity.assert_integrity(os.path.basename(file), integrity.check_table(dfs, text))
+    return dfs
+
+
+def _labels_as_str(index, names):
+    if isinstance(index, pd.MultiIndex):
+        return pd.MultiIndex.from_arrays([index.get_level_values(i).astype(str) for i in range(index.nlevels)],
+                                         names=list(names))
+    return pd.Index(index.astype(str), name=list(names)[0])
+
+
+def _as_dtype(values, dtype):
+    """
+    Converts a column or sheet to a type of LIST_SCHEMA / TABLE_SCHEMA.
+
+    :param values: Series or dataframe
+    :param dtype: 'float64', 'category', or 'str'
+    :return: Tuple of the converted values and, for 'float64', a boolean array of the cells with text instead of a
+        number, which are NaN in the converted values. None for the other types.
+    """
+    if dtype == 'float64':
+        values = values.replace(NULL_MARKERS, np.nan)
+        if isinstance(values, pd.Series):
+            numbers = pd.to_numeric(values, errors='coerce')
+        else:
+            numbers = values.apply(pd.to_numeric, errors='coerce')
+        return numbers.astype('float64'), (numbers.isna() & values.notna()).values
+    # Keep empty cells NaN instead of 'nan'
+    values = values.where(values.isna(), values.astype(str))
+    if dtype == 'category':
+        values = values.astype('category')
+    return values, None
 
 
-def read_candidate_files(path=IEDC_paths.candidates):
+def read_candidate_files(path=None):
     """
     Runs read_candidate_file() for all files in a directory
-    :param path: directory of files to run the function for
+    :param path: directory of files to run the function for. Default: IEDC_paths.candidates
     :return: TODO: List of dataframes?
     """
+    if path is None:
+        path = IEDC_paths.candidates
     for file in get_candidate_filenames(path):
         read_candidate_data_list(file, path)
     # TODO
@@ -0,0 +1,113 @@
+"""
+Content fingerprints of datasets, to recognise data that is already in the database, e.g. the same dataset submitted
+again under a new filename or with cosmetic edits on the Cover sheet.
+
+The fingerprint is a hash of a dataset's rows as they are uploaded: the aspects, value, units, stats arrays, and
+comment. Aspects are taken as classification, attribute and item name instead of item ids, so the fingerprint of a
+candidate file can be computed before its custom classifications are created. The order of the rows does not matter.
+Fingerprints of uploaded datasets are kept in the table `dataset_fingerprints`, keyed by dataset_id.
+"""
+import hashlib
+import json
+import time
+
+from IEDC_tools import dbio, lazy
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+
+FINGERPRINT_TABLE = 'dataset_fingerprints'
+NUMERIC_COLUMNS = ['value', 'unit_nominator', 'unit_denominator', 'stats_array_1', 'stats_array_2', 'stats_array_3',
+                   'stats_array_4']
+
+
+def create_fingerprint_table():
+    """
+    Creates the table `dataset_fingerprints` if it doesn't exist yet.
+    """
+    dbio.run_this_command("""
+        CREATE TABLE IF NOT EXISTS %s (
+          dataset_id INT NOT NULL,
+          fingerprint CHAR(40) NOT NULL,
+          n_rows INT NOT NULL,
+          created DATETIME NOT NULL,
+          PRIMARY KEY (dataset_id)
+        );""" % FINGERPRINT_TABLE)
+
+
+def compute(class_names, resolved):
+    """
+    Fingerprint of a dataset.
+
+    :param class_names: Classifications of the aspects, see `validate.get_class_names()`
+    :param resolved: Data resolved without looking up the aspects, see `validate.resolve_data_list(lookup=False)`
+    :return: SHA-1 hex digest
+    """
+    data = resolved['data'].copy()
+    data.columns = resolved['sql_columns']
+    data = data.drop('dataset_id', axis=1)
+    aspects = [a.replace('_', '') for a in class_names.index]
+    # The classification of each aspect column. Custom classifications are named after the dataset, so leave that out.
+    header = [[str(class_names.loc[a, 'classification_id']), str(class_names.loc[a, 'attribute_no']).strip()]
+              for a in class_names.index] + list(data.columns[len(aspects):])
+    for c in data.columns:
+        if c in NUMERIC_COLUMNS:
+            # LIST files have the stats arrays as strings, TABLE files as numbers
+            data[c] = pd.to_numeric(data[c], errors='coerce').astype('float64')
+        else:
+            data[c] = data[c].astype(object).where(data[c].notna(), None).astype(str)
+    row_hashes = np.sort(pd.util.hash_pandas_object(data, index=False).values)
+    h = hashlib.sha1()
+    h.update(json.dumps(header).encode())
+    h.update(row_hashes.tobytes())
+    return h.hexdigest()
+
+
+def find(fingerprint, exclude=None):
+    """
+    Looks up datasets with the given fingerprint.
+
+    :param fingerprint: see compute()
+    :param exclude: dataset_id to leave out, e.g. the dataset that is about to be replaced
+    :return: List of dataset_ids
+    """
+    create_fingerprint_table()
+    found = dbio.get_sql_table_as_df(FINGERPRINT_TABLE, ['dataset_id'], index=None,
+                                     addSQL="WHERE fingerprint = '%s'" % str(fingerprint))
+    return [int(i) for i in found['dataset_id'] if exclude is None or int(i) != int(exclude)]
+
+
+def get(dataset_id):
+    """
+    Fingerprint of an uploaded dataset.
+
+    :return: The fingerprint, or None if none was recorded, e.g. because the upload did not finish
+    """
+    create_fingerprint_table()
+    found = dbio.get_sql_table_as_df(FINGERPRINT_TABLE, ['fingerprint'], index=None,
+                                     addSQL="WHERE dataset_id = %s" % int(dataset_id))
+    return found['fingerprint'].iloc[0] if len(found.index) else None
+
+
+def record(dataset_id, fingerprint, n_rows):
+    """
+    Stores the fingerprint of an uploaded dataset. Replaces an older fingerprint of the same dataset.
+    """
+    create_fingerprint_table()
+    _store(int(dataset_id), fingerprint, int(n_rows))
+
+
+def clear(dataset_id):
+    """
+    Forgets the fingerprint of a dataset, e.g. once it was deleted.
+    """
+    create_fingerprint_table()
+    dbio.run_this_command("DELETE FROM %s WHERE dataset_id = %s;" % (FINGERPRINT_TABLE, int(dataset_id)))
+
+
+@dbio.db_cursor_write
+def _store(curs, dataset_id, fingerprint, n_rows):
+    dbio.table_changed(FINGERPRINT_TABLE)
+    curs.execute("DELETE FROM %s WHERE dataset_id = %%s;" % FINGERPRINT_TABLE, (dataset_id,))
+    curs.execute("INSERT INTO %s (dataset_id, fingerprint, n_rows, created) VALUES (%%s, %%s, %%s, %%s);"
+                 % FINGERPRINT_TABLE, (dataset_id, fingerprint, n_rows, time.strftime('%Y-%m-%d %H:%M:%S')))
@@ -0,0 +1,178 @@
+"""
+Checks of a candidate file on its own, run while it is read and before anything is looked up in the database: numbers
+where numbers are expected, no two rows with the same aspects, and the sheets of TABLE files aligned with the sheet
+`Data`. The checks work on whole columns and sheets at once and report all problems of a file together, with the cells
+in Excel notation, e.g. "Data!C7".
+"""
+from IEDC_tools import lazy
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+
+# Cells or rows listed per problem
+MAX_CELLS = 10
+
+
+class IntegrityError(AssertionError):
+    """
+    A candidate file failed the checks of this module. The message lists all problems found.
+    """
+
+
+def assert_integrity(file, problems):
+    """
+    :param file: Name of the file, for the message
+    :param problems: List of problems, see check_list(), check_table(), check_alignment()
+    :raises IntegrityError: if there are problems
+    """
+    if problems:
+        raise IntegrityError("Found %s problem(s) in '%s':\n - %s" % (len(problems), file, '\n - '.join(problems)))
+
+
+def check_list(data, aspects, text=None):
+    """
+    Checks the sheet `Data` of a LIST type file: text in number columns, empty aspect cells, and rows with the same
+    aspects.
+
+    :param data: Dataframe of the sheet, header in the first row
+    :param aspects: Columns with the aspects
+    :param text: Dictionary of column: boolean array of the cells with text instead of a number
+    :return: List of problems
+    """
+    problems = []
+    for column, mask in (text or {}).items():
+        if mask is not None and mask.any():
+            problems.append("%s: text instead of a number in column '%s'" %
+                            (_cell_names('Data', np.nonzero(mask)[0], data.columns.get_loc(column), 1, 0), column))
+    for column in aspects:
+        empty = data[column].isna().values
+        if empty.any():
+            problems.append("%s: no %s" %
+                            (_cell_names('Data', np.nonzero(empty)[0], data.columns.get_loc(column), 1, 0), column))
+    if len(aspects):
+        groups = duplicate_rows(data[list(aspects)])
+        if groups:
+            problems.append("Data: %s rows with the same aspects, e.g. rows %s" %
+                            (sum(len(g) for g in groups), _row_groups(groups, 1)))
+    return problems
+
+
+def check_table(sheets, text=None):
+    """
+    Checks sheets of a TABLE type file: text in number sheets, and in sheet `Data` rows or columns with the same
+    labels.
+
+    :param sheets: Dictionary of sheet name: dataframe with the row aspects as index and the column aspects as columns
+    :param text: Dictionary of sheet name: boolean array of the cells with text instead of a number
+    :return: List of problems
+    """
+    problems = []
+    for sheet, mask in (text or {}).items():
+        if mask is not None and mask.any():
+            first_row, first_col = _table_origin(sheets[sheet])
+            rows, cols = np.nonzero(mask)
+            problems.append("%s: text instead of a number" % _cell_names(sheet, rows, cols, first_row, first_col))
+    if 'Data' in sheets:
+        first_row, first_col = _table_origin(sheets['Data'])
+        groups = duplicate_rows(sheets['Data'].index.to_frame(index=False))
+        if groups:
+            problems.append("Data: %s rows with the same row labels, e.g. rows %s" %
+                            (sum(len(g) for g in groups), _row_groups(groups, first_row)))
+        groups = duplicate_rows(sheets['Data'].columns.to_frame(index=False))
+        if groups:
+            columns = '; '.join(', '.join(_column_letter(first_col + c) for c in g) for g in groups[:MAX_CELLS])
+            problems.append("Data: %s columns with the same column labels, e.g. columns %s" %
+                            (sum(len(g) for g in groups), columns))
+    return problems
+
+
+def check_alignment(data, sheets):
+    """
+    Checks that further sheets of a TABLE type file, e.g. the units, have the same rows and columns as sheet `Data`.
+
+    :param data: Dataframe of sheet `Data`
+    :param sheets: Dictionary of sheet name: dataframe
+    :return: List of problems
+    """
+    problems = []
+    first_row, first_col = _table_origin(data)
+    for sheet, table in sheets.items():
+        if table.shape != data.shape:
+            problems.append("%s: %s rows and %s columns, but sheet 'Data' has %s and %s" %
+                            ((sheet,) + table.shape + data.shape))
+            continue
+        rows, levels = _other_labels(table.index, data.index)
+        if len(rows):
+            problems.append("%s: other row labels than in sheet 'Data'" %
+                            _cell_names(sheet, rows, levels, first_row, 0))
+        cols, levels = _other_labels(table.columns, data.columns)
+        if len(cols):
+            problems.append("%s: other column labels than in sheet 'Data'" %
+                            _cell_names(sheet, levels, cols, 0, first_col))
+    return problems
+
+
+def duplicate_rows(keys):
+    """
+    Finds rows that occur more than once. The rows are compared by a 64 bit hash, and only the rows with a repeated
+    hash are compared by their values.
+
+    :param keys: Dataframe
+    :return: List of arrays of row positions, one per group of equal rows
+    """
+    hashes = pd.util.hash_pandas_object(keys, index=False).values
+    candidates = np.nonzero(pd.Series(hashes).duplicated(keep=False).values)[0]
+    if not len(candidates):
+        return []
+    candidates = candidates[keys.iloc[candidates].duplicated(keep=False).values]
+    # Sorted by hash, the rows of a group are next to each other
+    order = candidates[np.argsort(hashes[candidates], kind='stable')]
+    groups = np.split(order, np.nonzero(np.diff(hashes[order]))[0] + 1)
+    return sorted(groups, key=lambda g: g[0])
+
+
+def _other_labels(labels, expected):
+    """
+    Positions and levels of the labels that differ, e.g. of the rows of two sheets of the same shape.
+
+    :return: Tuple of arrays (positions, levels)
+    """
+    differ = np.column_stack([labels.get_level_values(i) != expected.get_level_values(i)
+                              for i in range(expected.nlevels)])
+    return np.nonzero(differ)
+
+
+def _table_origin(table):
+    """
+    Position (row, column) of the first value of a TABLE sheet. With several column aspects, the names of the row
+    aspects are in a row of their own below the column labels.
+    """
+    n_col = table.columns.nlevels
+    return n_col + (1 if n_col > 1 else 0), table.index.nlevels
+
+
+def _cell_names(sheet, rows, cols, first_row, first_col):
+    """
+    Excel names of cells, e.g. 'Data!C7, C9 and 3 more'. Positions are relative to the first value of the sheet.
+    """
+    rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+    names = ['%s%s' % (_column_letter(first_col + c), first_row + r + 1)
+             for r, c in zip(rows[:MAX_CELLS], cols[:MAX_CELLS])]
+    more = len(rows) - len(names)
+    return '%s!%s%s' % (sheet, ', '.join(names), ' and %s more' % more if more > 0 else '')
+
+
+def _row_groups(groups, first_row):
+    return '; '.join(', '.join(str(first_row + r + 1) for r in g) for g in groups[:MAX_CELLS])
+
+
+def _column_letter(col):
+    """
+    Excel name of a column, e.g. 'AB'. Zero-based.
+    """
+    letters = ''
+    col += 1
+    while col:
+        col, rest = divmod(col - 1, 26)
+        letters = chr(65 + rest) + letters
+    return letters
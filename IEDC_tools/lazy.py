@@ -0,0 +1,33 @@
+"""
+Deferred imports. pandas, numpy, openpyxl, and pymysql take a while to import and the configuration modules IEDC_pass
+and IEDC_paths may not exist on every machine. Modules of IEDC_tools import them with `lazy_import()`, so they are only
+loaded by the first function that actually uses them. E.g. `python IEDC_upload_batch.py --help` needs none of them.
+"""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module, which is imported on first attribute access.
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # Later lookups are served from the placeholder's own namespace, without another detour through here
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Returns the module if it is already imported, a placeholder that imports it on first use otherwise.
+
+    :param name: Module name, e.g. 'pandas'
+    :return: Module or LazyModule
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
@@ -0,0 +1,248 @@
+"""
+Instrumentation of the upload pipeline. Records wall time, CPU time, memory, and row counts for each stage, i.e. each
+call of a function decorated with `@profiling.stage`, and writes one JSON report per file. Memory is recorded as the
+change of the resident set size during the stage (`rss_delta_mb`, Linux only), the peak resident set size of the
+process so far (`process_peak_rss_mb`), and optionally the peak of the memory allocated by Python during the stage.
+
+Profiling is off by default, the decorated functions then only pay for one dictionary lookup. Usage:
+
+    profiling.enable(tracemalloc=True, cprofile=['resolve_data_table'], outdir='profiles')
+    profiling.start_file('my_file.xlsx')
+    ...  # parse, validate, upload
+    profiling.write_report()
+    profiling.aggregate_reports('profiles')
+"""
+import contextlib
+import cProfile
+import functools
+import glob
+import json
+import os
+import threading
+import time
+import tracemalloc as _tracemalloc
+
+from IEDC_tools import lazy
+
+pd = lazy.lazy_import('pandas')
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_settings = {'enabled': False, 'tracemalloc': False, 'cprofile': (), 'outdir': '.'}
+_report = {'file': None, 'started': None, 'stages': []}
+# per thread: `stack` of open stages, for nesting depth and tracemalloc peaks, and the `records` and `file` of
+# recording()
+_local = threading.local()
+
+
+def enable(tracemalloc=False, cprofile=(), outdir='.'):
+    """
+    Switches profiling on.
+
+    :param tracemalloc: Also record the peak of memory allocated by Python during each stage. Slows things down.
+    :param cprofile: Stage names to run under cProfile. The profiles are dumped to `outdir`, see `pstats`.
+    :param outdir: Directory for reports and cProfile dumps
+    """
+    _settings.update({'enabled': True, 'tracemalloc': tracemalloc, 'cprofile': tuple(cprofile), 'outdir': outdir})
+    os.makedirs(outdir, exist_ok=True)
+    if tracemalloc and not _tracemalloc.is_tracing():
+        _tracemalloc.start()
+
+
+def disable():
+    """
+    Switches profiling off.
+    """
+    if _settings['tracemalloc'] and _tracemalloc.is_tracing():
+        _tracemalloc.stop()
+    _settings.update({'enabled': False, 'tracemalloc': False, 'cprofile': ()})
+
+
+def settings():
+    """
+    Current settings, e.g. to enable profiling with the same settings in another process.
+    """
+    return {k: v for k, v in _settings.items() if k != 'enabled'}
+
+
+def start_file(file, stages=None):
+    """
+    Starts a new report, e.g. for the next file of a directory.
+
+    :param file: Name of the file
+    :param stages: Stage records to start with, e.g. ones recorded in a worker process
+    """
+    _report.update({'file': file, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': list(stages or [])})
+
+
+def get_report():
+    """
+    Returns the current report (dictionary).
+    """
+    return {'file': _report['file'],
+            'started': _report['started'],
+            'total_wall_s': sum(s['wall_s'] for s in _report['stages'] if s['depth'] == 0),
+            'stages': list(_report['stages'])}
+
+
+@contextlib.contextmanager
+def recording(records, file=None):
+    """
+    Records the stages the current thread runs into a list instead of the current report, e.g. for work done for
+    several files at once, or in a thread pool. See start_file() to write them to a report later.
+
+    :param records: List the stage records are appended to
+    :param file: Name of the file, for the names of the cProfile dumps. Default: the file of the current report
+    """
+    previous = getattr(_local, 'records', None), getattr(_local, 'file', None)
+    _local.records, _local.file = records, file
+    try:
+        yield records
+    finally:
+        _local.records, _local.file = previous
+
+
+def split(records, n):
+    """
+    Stage records of work done for `n` files at once, with wall time and CPU time divided evenly between the files.
+    """
+    if n == 1:
+        return list(records)
+    return [dict(r, wall_s=r['wall_s'] / n, cpu_s=r['cpu_s'] / n, shared_by=n) for r in records]
+
+
+def write_report(path=None):
+    """
+    Writes the current report as JSON.
+
+    :param path: Default: '<outdir>/<file>.profile.json'
+    :return: path
+    """
+    if path is None:
+        path = os.path.join(_settings['outdir'], '%s.profile.json' % os.path.basename(str(_report['file'])))
+    with open(path, 'w') as f:
+        json.dump(get_report(), f, indent=1)
+    return path
+
+
+def aggregate_reports(directory, summary=True):
+    """
+    Reads all reports in a directory.
+
+    :param directory: Directory with '*.profile.json' files
+    :param summary: Aggregate by stage. Otherwise return every stage record.
+    :return: Dataframe
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.profile.json'))):
+        with open(path) as f:
+            report = json.load(f)
+        records += [dict(s, file=report['file']) for s in report['stages']]
+    df = pd.DataFrame(records)
+    if not summary or df.empty:
+        return df
+    # A call shared by several files, see split(), counts once
+    df['call'] = 1. / df['shared_by'].fillna(1) if 'shared_by' in df else 1.
+    return df.groupby('stage').agg(calls=('call', 'sum'), files=('file', 'nunique'), wall_s=('wall_s', 'sum'),
+                                   cpu_s=('cpu_s', 'sum'), max_wall_s=('wall_s', 'max'), rows=('rows', 'sum'),
+                                   rss_delta_mb=('rss_delta_mb', 'max'),
+                                   process_peak_rss_mb=('process_peak_rss_mb', 'max')).sort_values('wall_s', ascending=False)
+
+
+def stage(name):
+    """
+    Decorator that records a function call as a pipeline stage.
+
+    :param name: Stage name in the report
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def stage_(*args, **kwargs):
+            if not _settings['enabled']:
+                return fn(*args, **kwargs)
+            return _run_stage(name, fn, args, kwargs)
+        return stage_
+    return decorator
+
+
+def _run_stage(name, fn, args, kwargs):
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    stack = _local.stack
+    record = {'stage': name, 'depth': len(stack), 'rows': None, 'error': None}
+    frame = {'mem_start': 0, 'mem_peak': 0}
+    rss_start = _rss_mb()
+    if _settings['tracemalloc']:
+        current, peak = _tracemalloc.get_traced_memory()
+        # The parents' peaks so far must survive the reset
+        for parent in stack:
+            parent['mem_peak'] = max(parent['mem_peak'], peak)
+        _tracemalloc.reset_peak()
+        frame['mem_start'] = frame['mem_peak'] = current
+    stack.append(frame)
+    profiler = cProfile.Profile() if name in _settings['cprofile'] else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        if profiler is not None:
+            res = profiler.runcall(fn, *args, **kwargs)
+        else:
+            res = fn(*args, **kwargs)
+        record['rows'] = _count_rows(res)
+        return res
+    except BaseException as e:
+        record['error'] = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        stack.pop()
+        if _settings['tracemalloc']:
+            peak = max(frame['mem_peak'], _tracemalloc.get_traced_memory()[1])
+            record['tracemalloc_peak_mb'] = (peak - frame['mem_start']) / 2 ** 20
+            for parent in stack:
+                parent['mem_peak'] = max(parent['mem_peak'], peak)
+        rss_end = _rss_mb()
+        record['rss_delta_mb'] = None if rss_start is None or rss_end is None else rss_end - rss_start
+        record['process_peak_rss_mb'] = _process_peak_rss_mb()
+        records = getattr(_local, 'records', None)
+        if records is None:
+            records = _report['stages']
+        if profiler is not None:
+            file = getattr(_local, 'file', None) or _report['file']
+            record['cprofile'] = os.path.join(_settings['outdir'], '%s.%s.%s.prof' %
+                                              (os.path.basename(str(file)), name, len(records)))
+            profiler.dump_stats(record['cprofile'])
+        records.append(record)
+
+
+def _count_rows(res):
+    if isinstance(res, (pd.DataFrame, pd.Series)):
+        return len(res)
+    if isinstance(res, dict) and isinstance(res.get('data'), (pd.DataFrame, pd.Series)):
+        return len(res['data'])
+    return None
+
+
+def _rss_mb():
+    """
+    Current resident set size, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _process_peak_rss_mb():
+    """
+    Peak resident set size of the process since it started, not of a single stage.
+    """
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if os.uname().sysname == 'Darwin' else peak / 2 ** 10
@@ -0,0 +1,194 @@
+"""
+Local snapshots of the database's reference tables. Allows to validate candidate files without a database connection.
+
+A snapshot is a directory with one compressed Parquet file per table and a `snapshot.json` version stamp. Reading
+Parquet requires `pyarrow`.
+"""
+import hashlib
+import json
+import os
+import time
+
+from IEDC_tools import classifications, dbio, lazy, __version__
+
+pd = lazy.lazy_import('pandas')
+
+# The tables the validation functions need
+REFERENCE_TABLES = ('aspects', 'classification_definition', 'classification_items', 'units', 'licences', 'users')
+SNAPSHOT_FORMAT = 2
+STAMP_FILE = 'snapshot.json'
+
+# Version stamp of the currently active snapshot, if any
+_active = {}
+
+
+def export_snapshot(path, tables=REFERENCE_TABLES):
+    """
+    Downloads the reference tables and writes them to a snapshot directory.
+
+    :param path: Directory to write the snapshot to. Will be created if it doesn't exist.
+    :param tables: Tables to include in the snapshot
+    :return: The snapshot's version stamp (dictionary)
+    """
+    os.makedirs(path, exist_ok=True)
+    stamp = {'format': SNAPSHOT_FORMAT,
+             'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'created_by': 'IEDC_tools v%s' % __version__,
+             'database': dbio.database(),
+             'tables': {}}
+    for table in tables:
+        df = dbio.get_sql_table_as_df(table, use_snapshot=False)
+        df.to_parquet(os.path.join(path, table + '.parquet'), compression='zstd')
+        stamp['tables'][table] = _table_stamp(df)
+    with open(os.path.join(path, STAMP_FILE), 'w') as f:
+        json.dump(stamp, f, indent=2)
+    print("Wrote snapshot of %s tables to '%s'" % (len(tables), path))
+    return stamp
+
+
+def load_snapshot(path):
+    """
+    Reads a snapshot directory.
+
+    :param path: Snapshot directory
+    :return: Dictionary with the version 'stamp' and a dictionary of 'tables' (dataframes)
+    """
+    with open(os.path.join(path, STAMP_FILE)) as f:
+        stamp = json.load(f)
+    if stamp['format'] != SNAPSHOT_FORMAT:
+        raise AssertionError("Snapshot '%s' has format version %s, but IEDC_tools v%s expects %s. Please export a new "
+                             "snapshot." % (path, stamp['format'], __version__, SNAPSHOT_FORMAT))
+    tables = {}
+    for table in stamp['tables']:
+        tables[table] = pd.read_parquet(os.path.join(path, table + '.parquet'))
+        assert _df_hash(tables[table]) == stamp['tables'][table]['hash'], \
+            "Snapshot file for table '%s' in '%s' is corrupt or was modified." % (table, path)
+    return {'stamp': stamp, 'tables': tables}
+
+
+def activate(path, check=False):
+    """
+    Serve the reference tables from a local snapshot instead of the database, i.e. `dbio.get_sql_table_as_df()` will
+    read from the snapshot. Writing to one of the tables will switch that table back to the database.
+
+    :param path: Snapshot directory
+    :param check: Check if the snapshot is still up to date (requires database connection)
+    :return: The snapshot's version stamp (dictionary)
+    """
+    snapshot = load_snapshot(path)
+    if snapshot['stamp']['database'] != dbio.database():
+        raise AssertionError("Snapshot '%s' was taken from database '%s', but you are working on '%s'."
+                             % (path, snapshot['stamp']['database'], dbio.database()))
+    deactivate()
+    dbio.reference_tables.update(snapshot['tables'])
+    _active.update(snapshot['stamp'])
+    _active['path'] = path
+    print("Using snapshot '%s' of %s" % (path, snapshot['stamp']['created']))
+    if check:
+        assert_fresh()
+    return snapshot['stamp']
+
+
+def activate_live(tables=REFERENCE_TABLES):
+    """
+    Downloads the reference tables and serves them from memory, like a snapshot that is not written to disk. Meant for
+    long-running processes, see `daemon`, which call refresh_live() to keep the tables up to date.
+
+    :param tables: Tables to keep in memory
+    :return: The version stamp (dictionary)
+    """
+    deactivate()
+    stamp = {'format': SNAPSHOT_FORMAT,
+             'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'created_by': 'IEDC_tools v%s' % __version__,
+             'database': dbio.database(),
+             'tables': {}}
+    for table in tables:
+        df = dbio.get_sql_table_as_df(table, use_snapshot=False)
+        dbio.reference_tables[table] = df
+        stamp['tables'][table] = _table_stamp(df)
+    _active.update(stamp)
+    _active['path'] = '(memory)'
+    return stamp
+
+
+def refresh_live():
+    """
+    Downloads the tables of activate_live() again that were changed in the database since, or that were written to by
+    this process and are read from the database meanwhile.
+
+    :return: List of the refreshed tables
+    """
+    assert _active.get('path') == '(memory)', "No in-memory snapshot is active, see activate_live()"
+    served = {t: s for t, s in _active['tables'].items() if t in dbio.reference_tables}
+    refresh = [t for t in _active['tables'] if t not in served] + check_snapshot({'tables': served})
+    for table in refresh:
+        df = dbio.get_sql_table_as_df(table, use_snapshot=False)
+        dbio.reference_tables[table] = df
+        _active['tables'][table] = _table_stamp(df)
+    if set(refresh) & {'classification_definition', 'classification_items'}:
+        classifications.invalidate()
+    return refresh
+
+
+def deactivate():
+    """
+    Stop using the snapshot, i.e. read all tables from the database again.
+    """
+    dbio.reference_tables.clear()
+    _active.clear()
+    # The classification store may hold data from the other source
+    classifications.clear()
+
+
+def check_snapshot(stamp, thorough=False):
+    """
+    Compares a snapshot's version stamp with the live database.
+
+    :param stamp: Version stamp, e.g. as returned by `activate()` or `load_snapshot(path)['stamp']`
+    :param thorough: Download the tables and compare their content. Otherwise only the row count and the highest id are
+        compared, which will not notice rows that were edited in place.
+    :return: List of tables that are out of date
+    """
+    stale = []
+    for table, state in stamp['tables'].items():
+        if thorough:
+            is_stale = _df_hash(dbio.get_sql_table_as_df(table, use_snapshot=False)) != state['hash']
+        else:
+            live = dbio.get_sql_table_state(table)
+            is_stale = (live['rows'], live['max_id']) != (state['rows'], state['max_id'])
+        if is_stale:
+            stale.append(table)
+    return stale
+
+
+def assert_fresh(thorough=False):
+    """
+    Makes sure the active snapshot is up to date before anything is written to the database. Does nothing if no
+    snapshot is active.
+
+    :param thorough: See `check_snapshot()`
+    """
+    if not _active:
+        return
+    # Only check the tables that are still served from the snapshot
+    stamp = {'tables': {t: s for t, s in _active['tables'].items() if t in dbio.reference_tables}}
+    stale = check_snapshot(stamp, thorough=thorough)
+    if stale:
+        raise AssertionError("Snapshot '%s' of %s is out of date for the tables %s. Please export a new one or call "
+                             "snapshot.deactivate()." % (_active['path'], _active['created'], stale))
+
+
+def _table_stamp(df):
+    return {'rows': len(df.index),
+            'max_id': None if df.empty else int(df.index.max()),
+            'hash': _df_hash(df)}
+
+
+def _df_hash(df):
+    """
+    Content hash of a dataframe, including its index. The rows are sorted by the index first, as the database returns
+    them in no particular order.
+    """
+    row_hashes = pd.util.hash_pandas_object(df.sort_index().astype(str), index=True).values
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()
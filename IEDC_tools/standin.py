@@ -0,0 +1,194 @@
+"""
+A local stand-in for the IEDC database, based on SQLite. Used for benchmarks and for trying things out without access
+to the MySQL server.
+
+The stand-in has the tables and columns IEDC_tools uses, seeded with a few aspects, general classifications, units, and
+lookup values. It understands the MySQL flavour of SQL the library sends: `%s` placeholders and table names prefixed
+with the database name.
+"""
+import functools
+import hashlib
+import os
+import re
+import sqlite3
+
+from IEDC_tools import dbio, lazy
+
+np = lazy.lazy_import('numpy')
+
+# Database name of the stand-in. The library prefixes table names with it, see `dbio.database()`.
+DATABASE = 'standin'
+
+# Aspects of the stand-in, each gets a general classification with `n_items` items
+ASPECTS = ['time', 'region', 'product', 'process', 'material', 'sector', 'element', 'scenario', 'cohort',
+           'technology', 'waste', 'energy']
+MAX_ASPECTS = 12
+UNITS = ['1', 'kg', 't', 'Mt', 'yr', 'm2', 'MJ', 'GJ', 'cap']
+LOOKUPS = {'types': ['flow', 'stock', 'process_data', 'ratio', 'parameter'],
+           'layers': ['socioeconomic', 'environmental'],
+           'provenance': ['primary', 'secondary'],
+           'source_type': ['journal article', 'report', 'database'],
+           'licences': ['CC BY 4.0'],
+           'users': ['Jane Doe']}
+# Columns of the `datasets` table, i.e. the entries on the 'Cover' sheet of the data templates
+DATASET_COLUMNS = ['dataset_name', 'dataset_version', 'dataset_description', 'data_type', 'data_layer',
+                   'data_provenance'] + \
+                  [c for i in range(1, MAX_ASPECTS + 1) for c in ('aspect_%s' % i, 'aspect_%s_classification' % i)] + \
+                  ['type_of_source', 'project_license', 'submitting_user', 'reserve5']
+
+# Like MySQL's AUTO_INCREMENT, ids of deleted rows are not reused
+SCHEMA = """
+CREATE TABLE aspects ({pk}, aspect TEXT NOT NULL, dimension TEXT);
+CREATE TABLE classification_definition ({pk}, classification_name TEXT NOT NULL, dimension TEXT, description TEXT,
+  mutually_exclusive INTEGER, collectively_exhaustive INTEGER, created_from_dataset INTEGER, general INTEGER,
+  meaning_attribute1 TEXT, meaning_attribute2 TEXT, meaning_attribute3 TEXT);
+CREATE TABLE classification_items ({pk}, classification_id INTEGER NOT NULL, description TEXT, reference TEXT,
+  attribute1_oto TEXT, attribute2_oto TEXT, attribute3_oto TEXT);
+CREATE TABLE units ({pk}, unitcode TEXT NOT NULL, alt_unitcode TEXT, alt_unitcode2 TEXT);
+CREATE TABLE licences ({pk}, name TEXT NOT NULL, description TEXT);
+CREATE TABLE users ({pk}, name TEXT NOT NULL, username TEXT, start_date TEXT);
+CREATE TABLE types ({pk}, name TEXT NOT NULL);
+CREATE TABLE layers ({pk}, name TEXT NOT NULL);
+CREATE TABLE provenance ({pk}, name TEXT NOT NULL);
+CREATE TABLE source_type ({pk}, name TEXT NOT NULL);
+CREATE TABLE datasets ({pk}, {dataset_columns});
+CREATE TABLE data ({pk}, dataset_id INTEGER NOT NULL, {aspect_columns}, value REAL, unit_nominator INTEGER,
+  unit_denominator INTEGER, stats_array_1 INTEGER, stats_array_2 REAL, stats_array_3 REAL, stats_array_4 REAL,
+  comment TEXT);
+""".format(pk='id INTEGER PRIMARY KEY AUTOINCREMENT',
+           dataset_columns=', '.join('%s TEXT' % c for c in DATASET_COLUMNS),
+           aspect_columns=', '.join('aspect%s INTEGER' % i for i in range(1, MAX_ASPECTS + 1)))
+
+
+def item_label(aspect, i):
+    """
+    Attribute 1 of item `i` of the general classification of `aspect`. Years for 'time', e.g. 'region_3' otherwise.
+    """
+    if aspect == 'time':
+        return str(1900 + i)
+    return '%s_%s' % (aspect, i)
+
+
+def general_classification_id(aspect):
+    """
+    id of the general classification of an aspect in the stand-in database.
+    """
+    return ASPECTS.index(aspect) + 1
+
+
+def create_standin_db(path, n_items=1000, overwrite=True):
+    """
+    Creates and seeds a stand-in database file.
+
+    :param path: SQLite file to create
+    :param n_items: Number of items of each general classification
+    :param overwrite: Delete the file first if it exists
+    """
+    if overwrite and os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany("INSERT INTO aspects (aspect, dimension) VALUES (?, ?)", [(a, a) for a in ASPECTS])
+    conn.executemany("INSERT INTO classification_definition (id, classification_name, dimension, description, "
+                     "mutually_exclusive, collectively_exhaustive, created_from_dataset, general, meaning_attribute1) "
+                     "VALUES (?, ?, ?, ?, 1, 1, 0, 1, ?)",
+                     [(general_classification_id(a), '%s_general' % a, a, 'Stand-in classification', 'name')
+                      for a in ASPECTS])
+    conn.executemany("INSERT INTO classification_items (classification_id, description, reference, attribute1_oto, "
+                     "attribute2_oto, attribute3_oto) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(general_classification_id(a), None, 'stand-in', item_label(a, i), item_label(a, i).upper(),
+                       str(i)) for a in ASPECTS for i in range(n_items)])
+    conn.executemany("INSERT INTO units (unitcode, alt_unitcode) VALUES (?, ?)", [(u, u.upper()) for u in UNITS])
+    for table, names in LOOKUPS.items():
+        conn.executemany("INSERT INTO %s (name) VALUES (?)" % table, [(n,) for n in names])
+    conn.commit()
+    conn.close()
+
+
+class StandinCursor(sqlite3.Cursor):
+    """
+    Cursor that translates the MySQL flavoured statements of IEDC_tools to SQLite.
+    """
+
+    def execute(self, sql, parameters=None):
+        if parameters is None:
+            return super().execute(self.connection.translate(sql, False))
+        return super().execute(self.connection.translate(sql, True), parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(self.connection.translate(sql, True), seq_of_parameters)
+
+
+class StandinConnection(sqlite3.Connection):
+
+    def cursor(self, factory=StandinCursor):
+        return super().cursor(factory)
+
+    def translate(self, sql, placeholders):
+        # Tables are addressed as `database.table` by the library
+        sql = re.sub(r'\b%s\.' % DATABASE, 'main.', sql)
+        if placeholders:
+            sql = sql.replace('%s', '?')
+        return sql
+
+
+def connect(path):
+    """
+    Opens a connection to a stand-in database. Behaves like a pymysql connection as far as IEDC_tools is concerned.
+    """
+    # numpy numbers are not understood by sqlite3
+    for t, f in ((np.int64, int), (np.int32, int), (np.float64, float), (np.bool_, bool)):
+        sqlite3.register_adapter(t, f)
+    # Concurrent writers, e.g. `batch.run(threads=4)`, wait for each other's locks like on MySQL
+    conn = sqlite3.connect(path, timeout=60, factory=StandinConnection)
+    # MySQL functions used by the library that SQLite doesn't have
+    conn.create_function('CONCAT_WS', -1, _concat_ws, deterministic=True)
+    conn.create_function('MD5', 1, _md5, deterministic=True)
+    conn.create_function('CONV', 3, _conv, deterministic=True)
+    conn.create_aggregate('BIT_XOR', 1, _BitXor)
+    return conn
+
+
+def _concat_ws(separator, *values):
+    return separator.join(str(v) for v in values if v is not None)
+
+
+def _md5(value):
+    return None if value is None else hashlib.md5(str(value).encode()).hexdigest()
+
+
+def _conv(value, from_base, to_base):
+    assert int(to_base) == 10, "CONV() of the stand-in only converts to base 10"
+    return None if value is None else str(int(str(value), int(from_base)))
+
+
+class _BitXor:
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= int(value)
+
+    def finalize(self):
+        return self.value
+
+
+def activate(path):
+    """
+    Makes all `dbio` functions use the stand-in database instead of the MySQL server.
+
+    :param path: SQLite file, see create_standin_db()
+    """
+    assert os.path.exists(path), "Stand-in database '%s' does not exist. Use create_standin_db() first." % path
+    dbio.connection_factory = functools.partial(connect, path)
+    dbio.database_name = DATABASE
+
+
+def deactivate():
+    """
+    Switch back to the MySQL server.
+    """
+    dbio.connection_factory = None
+    dbio.database_name = None
@@ -0,0 +1,152 @@
+"""
+Generator for synthetic, valid LIST and TABLE data templates of configurable size. The aspects, classifications, units,
+and lookup values match the seed data of the stand-in database (see `standin`). Used for benchmarks.
+"""
+import os
+
+from IEDC_tools import lazy, standin
+
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+
+
+def write_template(file, data_type='LIST', rows=1000, n_aspects=3, col_levels=1, n_cols=10, units='GLOBAL',
+                   stats='GLOBAL', comments='GLOBAL', empty_share=0., custom_aspects=0, insert_empty_as_null=False,
+                   dataset_name=None, n_items=1000, seed=0):
+    """
+    Writes a synthetic data template Excel file.
+
+    :param file: Filename to write, including path
+    :param data_type: 'LIST' or 'TABLE'
+    :param rows: Number of rows in the Data sheet (without header)
+    :param n_aspects: Number of aspects. For TABLE, this includes the column aspects.
+    :param col_levels: TABLE only: number of aspects in the columns, i.e. header rows
+    :param n_cols: TABLE only: number of data columns
+    :param units: TABLE only: 'GLOBAL' (one unit on the Cover sheet) or 'TABLE' (unit sheets)
+    :param stats: 'GLOBAL' or 'TABLE'. For LIST 'TABLE' fills the stats_array column, otherwise it is 'none'.
+    :param comments: 'GLOBAL' or 'TABLE'. For LIST 'TABLE' fills the comment column, otherwise it is empty.
+    :param empty_share: Share of empty value cells, 0..1
+    :param custom_aspects: Number of aspects (the first ones) that use a custom classification
+    :param insert_empty_as_null: Value of the `Insert_Empty_Cells_as_NULL` switch on the Cover sheet
+    :param dataset_name: Default: filename without extension
+    :param n_items: Number of items per classification in the stand-in database
+    :param seed: Random seed
+    :return: dataset_name
+    """
+    assert data_type in ('LIST', 'TABLE'), "data_type must be 'LIST' or 'TABLE'"
+    assert n_aspects <= len(standin.ASPECTS), "The stand-in database only has %s aspects" % len(standin.ASPECTS)
+    if dataset_name is None:
+        dataset_name = os.path.splitext(os.path.basename(file))[0]
+    rng = np.random.default_rng(seed)
+    aspects = standin.ASPECTS[:n_aspects]
+    custom = aspects[:custom_aspects]
+    if data_type == 'LIST':
+        row_aspects, col_aspects = aspects, []
+    else:
+        assert 0 < col_levels < n_aspects, "TABLE needs at least one row and one column aspect"
+        row_aspects, col_aspects = aspects[:n_aspects - col_levels], aspects[n_aspects - col_levels:]
+    index = _combinations(row_aspects, rows, custom, n_items)
+    with pd.ExcelWriter(file, engine='openpyxl') as writer:
+        if data_type == 'LIST':
+            data = index.to_frame(index=False)
+            data['value'] = _values(rng, rows, empty_share)
+            data['unit nominator'] = 'kg'
+            data['unit denominator'] = 'yr'
+            data['stats_array string'] = '2;1.2;none;none' if stats == 'TABLE' else 'none'
+            data['comment'] = ['Comment %s' % i for i in range(rows)] if comments == 'TABLE' else np.nan
+            data.to_excel(writer, sheet_name='Data', index=False)
+        else:
+            columns = _combinations(col_aspects, n_cols, custom, n_items)
+            sheets = {'Data': _values(rng, rows * n_cols, empty_share).reshape(rows, n_cols)}
+            if units == 'TABLE':
+                sheets['Unit_nominator'] = 'kg'
+                sheets['Unit_denominator'] = 'yr'
+            if stats == 'TABLE':
+                sheets['stats_array_string'] = '2;1.2;none;none'
+            if comments == 'TABLE':
+                sheets['Comment'] = 'Comment'
+            for sheet, values in sheets.items():
+                pd.DataFrame(values, index=index, columns=columns).to_excel(writer, sheet_name=sheet)
+        _write_cover(writer.book.create_sheet('Cover', 0), data_type, dataset_name, aspects, custom,
+                     row_aspects, col_aspects, units, stats, comments, insert_empty_as_null)
+    return dataset_name
+
+
+def _labels(aspect, n, custom):
+    if aspect in custom:
+        return ['%s_custom_%s' % (aspect, i) for i in range(n)]
+    if aspect == 'time':
+        # Years end up as numbers in Excel, just like in the real templates
+        return [int(standin.item_label(aspect, i)) for i in range(n)]
+    return [standin.item_label(aspect, i) for i in range(n)]
+
+
+def _combinations(aspects, n, custom, n_items):
+    """
+    The first `n` unique combinations of the aspects' items, as (Multi)Index.
+    """
+    per_aspect = int(np.ceil(n ** (1. / len(aspects))))
+    assert not set(aspects).difference(custom) or per_aspect <= n_items, \
+        "Need %s items per classification, but the stand-in database has only %s" % (per_aspect, n_items)
+    codes = [(np.arange(n) // per_aspect ** k) % per_aspect for k in reversed(range(len(aspects)))]
+    levels = [_labels(a, per_aspect, custom) for a in aspects]
+    if len(aspects) == 1:
+        return pd.Index(levels[0], name=aspects[0])
+    return pd.MultiIndex(levels=levels, codes=codes, names=aspects)
+
+
+def _values(rng, n, empty_share):
+    values = rng.random(n) * 1000
+    values[rng.random(n) < empty_share] = np.nan
+    return values
+
+
+def _write_cover(ws, data_type, dataset_name, aspects, custom, row_aspects, col_aspects, units, stats, comments,
+                 insert_empty_as_null):
+    """
+    Fills the 'Cover' sheet, see file_io.read_candidate_meta() for the cell positions.
+    """
+    ws['A1'] = 'Synthetic IEDC data template'
+    # Dataset information, C3:D...
+    entries = [('dataset_id', 'auto'), ('dataset_name', dataset_name), ('dataset_version', 'v1.0'),
+               ('dataset_description', 'Synthetic dataset'), ('data_type', 'flow'), ('data_layer', 'socioeconomic'),
+               ('data_provenance', 'primary')]
+    for i in range(standin.MAX_ASPECTS):
+        if i < len(aspects):
+            classification = 'custom' if aspects[i] in custom else standin.general_classification_id(aspects[i])
+            entries += [('aspect_%s' % (i + 1), aspects[i]), ('aspect_%s_classification' % (i + 1), classification)]
+        else:
+            entries += [('aspect_%s' % (i + 1), 'none'), ('aspect_%s_classification' % (i + 1), 'none')]
+    entries += [('type_of_source', 'journal article'), ('project_license', 'CC BY 4.0'),
+                ('submitting_user', 'Jane Doe'), ('reserve5', None)]
+    ws['C3'], ws['D3'] = 'Column name', 'Dataset entries'
+    for r, (key, value) in enumerate(entries, start=4):
+        ws.cell(r, 3, key)
+        ws.cell(r, 4, value)
+    # Data sources, F5:I9
+    ws['F5'], ws['G5'] = 'Dataset_Source', 'Stand-in'
+    ws['F6'], ws['G6'] = 'Insert_Empty_Cells_as_NULL', str(insert_empty_as_null)
+    ws['F7'], ws['G7'], ws['H7'], ws['I7'] = 'Dataset_Unit', units if data_type == 'TABLE' else 'LIST', 'kg', 'yr'
+    ws['F8'], ws['G8'], ws['H8'] = 'Dataset_Uncertainty', stats, 'none'
+    ws['F9'], ws['G9'], ws['H9'] = 'Dataset_Comment', comments, 'Synthetic data'
+    ws['F10'], ws['G10'] = 'Dataset_RecordType', data_type
+    # Aspects, from row 11
+    if data_type == 'TABLE':
+        tables = [('F', 'Row Aspects classification', 'Row_Aspects_Attribute_No', row_aspects),
+                  ('H', 'Col Aspects classification', 'Col_Aspects_Attribute_No', col_aspects)]
+        data_col = 'J'
+    else:
+        tables = [('F', 'Aspects_classifications', 'Aspects_Attribute_No', row_aspects)]
+        data_col = 'H'
+    for col, name, attribute, table_aspects in tables:
+        c = ws[col + '11'].column
+        ws.cell(11, c, name)
+        ws.cell(11, c + 1, attribute)
+        for r, aspect in enumerate(table_aspects, start=12):
+            ws.cell(r, c, aspect)
+            ws.cell(r, c + 1, 'custom' if aspect in custom else 1)
+    c = ws[data_col + '11'].column
+    ws.cell(11, c, 'DATA')
+    ws.cell(11, c + 1, 'Description')
+    ws.cell(12, c, 'value')
+    ws.cell(12, c + 1, 'Synthetic values')
@@ -1,13 +1,23 @@
 """
 Functions to validate the input files prior to database insert / upload.
 """
+import os
 import time
 
-import numpy as np
-import pandas as pd
+from IEDC_tools import catalog, checkpoint, classifications, dbio, delete, file_io, fingerprint, integrity, lazy, \
+    profiling, snapshot, __version__
 
-import IEDC_paths, IEDC_pass
-from IEDC_tools import dbio, file_io, __version__
+np = lazy.lazy_import('numpy')
+pd = lazy.lazy_import('pandas')
+IEDC_paths = lazy.lazy_import('IEDC_paths')
+IEDC_pass = lazy.lazy_import('IEDC_pass')
+
+# Columns of classification_items written for custom classifications
+CUSTOM_ITEM_COLUMNS = ('classification_id', 'description', 'reference', 'attribute1_oto')
+# Further sheets of TABLE type files, by the Cover sheet field that asks for them
+TABLE_SHEETS = {'Dataset_Unit': ['Unit_nominator', 'Unit_denominator'],
+                'Dataset_Uncertainty': ['stats_array_string'],
+                'Dataset_Comment': ['Comment']}
 
 
 def check_datasets_entry(file_meta, create=True, crash_on_exist=True, update=True, replace=False):
@@ -17,15 +27,11 @@ def check_datasets_entry(file_meta, create=True, crash_on_exist=True, update=Tru
     :param crash_on_exist: if True: function terminates with assertion error if dataset/version already exists
     :param update: if True: function updates dataset entry if dataset/version already exists
     :param create: if True: funtion creates dataset entry for dataset/version
-    :param replace: if True: delete existing entry in dataset table and create new one with current data
+    :param replace: if True: delete existing entry in dataset table and its data and create new one with current data
     """
     db_datasets = dbio.get_sql_table_as_df('datasets')
-    dataset_info = file_meta['dataset_info']
     # Check if entry already exists
-    dataset_name_ver = [i[0] for i in dataset_info.loc[['dataset_name', 'dataset_version']]
-                        .where((pd.notnull(dataset_info.loc[['dataset_name', 'dataset_version']])), None).values]
-    if dataset_name_ver[1] in ['NULL']:
-        dataset_name_ver[1] = None
+    dataset_name_ver = get_dataset_name_ver(file_meta)
     # If exists already
     if dataset_name_ver in db_datasets[['dataset_name', 'dataset_version']].values.tolist(): # dataset name + verion already exists in dataset catalog
         if crash_on_exist:
@@ -41,7 +47,8 @@ def check_datasets_entry(file_meta, create=True, crash_on_exist=True, update=Tru
             else:
                 db_id = db_datasets.loc[(db_datasets['dataset_name'] == dataset_name_ver[0]) &
                                         (db_datasets['dataset_version'] == dataset_name_ver[1])].index[0]
-            dbio.run_this_command("DELETE FROM %s.datasets WHERE id = %s;" % (IEDC_pass.IEDC_database, db_id))
+            # Remove its data as well. The custom classifications are kept, the new entry will use them.
+            delete.delete_dataset(db_id, classifications=False)
             # add new one
             create_dataset_entry(file_meta)
         else:
@@ -58,7 +65,13 @@ def check_datasets_entry(file_meta, create=True, crash_on_exist=True, update=Tru
                                  % dataset_name_ver)
 
 
-def create_dataset_entry(file_meta):
+def get_dataset_entry(file_meta):
+    """
+    Translates the file's dataset information into a row of the `datasets` table, i.e. looks up the ids of types,
+    layers, aspects, classifications, licences, users, etc.
+    :param file_meta: data file metadata
+    :return: Dictionary of column: value
+    """
     dataset_info = file_meta['dataset_info']
     dataset_info = dataset_info.replace([np.nan], [None])
     dataset_info = dataset_info.replace({'na': None, 'nan': None, 'none': None,
@@ -99,15 +112,31 @@ def create_dataset_entry(file_meta):
         # not sure why but pymysql doesn't like np.int64
         if type(dataset_info[k]) == np.int64:
             dataset_info[k] = int(dataset_info[k])
+    return dataset_info
+
+
+def create_dataset_entry(file_meta):
+    dataset_info = get_dataset_entry(file_meta)
     dbio.dict_sql_insert('datasets', dataset_info)
     print("Created entry for %s in 'datasets' table." % [dataset_info[k] for k in ['dataset_name', 'dataset_version']])
     return None
 
 
 def update_dataset_entry(file_meta):
-    raise NotImplementedError
+    """
+    Updates the metadata of an existing entry in the `datasets` table in place, i.e. the dataset_id is kept. Use
+    update_data() to update the dataset's values in the `data` table.
+    :param file_meta: data file metadata
+    """
+    dataset_id = get_dataset_id(file_meta)
+    dataset_info = get_dataset_entry(file_meta)
+    dbio.dict_sql_update('datasets', dataset_info, dataset_id)
+    print("Updated entry for %s in 'datasets' table, dataset_id: %s" %
+          ([dataset_info[k] for k in ['dataset_name', 'dataset_version']], dataset_id))
+    return None
 
 
+@profiling.stage('create_aspects_table')
 def create_aspects_table(file_meta):
     """
     Pulls the info on classification and attributes together, i.e. make sense of the messy attributes in an actual
@@ -150,6 +179,7 @@ def create_aspects_table(file_meta):
     return aspect_table
 
 
+@profiling.stage('get_class_names')
 def get_class_names(file_meta, aspect_table):
     """
     Creates and looks up names for classification, i.e. classifications that are not found in the database (custom)
@@ -161,17 +191,17 @@ def get_class_names(file_meta, aspect_table):
     :return: Dataframe table with name, classification_id, attribute_no, and classification_definition
     """
     dataset_info = file_meta['dataset_info']
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
     r = []
     for aspect in aspect_table.index:
         if aspect_table.loc[aspect, 'classification_id'] == 'custom':
             r.append(aspect_table.loc[aspect, 'name'] + '__' + dataset_info.loc['dataset_name', 'Dataset entries'])
         else:
-            r.append(db_classdef.loc[aspect_table.loc[aspect, 'classification_id'], 'classification_name'])
+            r.append(classifications.get_class_name(aspect_table.loc[aspect, 'classification_id']))
     aspect_table['custom_name'] = r
     return aspect_table
 
 
+@profiling.stage('check_classification_definition')
 def check_classification_definition(class_names, crash=True, warn=True,
                                     custom_only=False, exclude_custom=False):
     """
@@ -185,7 +215,6 @@ def check_classification_definition(class_names, crash=True, warn=True,
     :param exclude_custom: Exclude custom classifications
     :return: True or False
     """
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
     exists = []
     for aspect in class_names.index:
         attrib_no = class_names.loc[aspect, 'attribute_no']
@@ -193,14 +222,13 @@ def check_classification_definition(class_names, crash=True, warn=True,
             continue  # skip already existing classifications
         if attrib_no == 'custom' and exclude_custom:
             continue  # skip custom classifications
-        if class_names.loc[aspect, 'custom_name'] in db_classdef['classification_name'].values:
+        class_id = classifications.get_class_id(class_names.loc[aspect, 'custom_name'])
+        if class_id is not None:
             exists.append(True)
             if crash:
                 raise AssertionError("""Classification '%s' already exists in the DB classification table (ID: %s). 
                 Aspect '%s' cannot be processed.""" %
-                                     (class_names.loc[aspect, 'custom_name'],
-                                      db_classdef[db_classdef['classification_name']
-                                                  == 'general_product_categories'].index[0], aspect))
+                                     (class_names.loc[aspect, 'custom_name'], class_id, aspect))
             elif warn:
                 print("WARNING: '%s' already exists in the DB classification table. "
                       "Adding it again may fail or create ambiguous values." %
@@ -210,6 +238,7 @@ def check_classification_definition(class_names, crash=True, warn=True,
     return exists
 
 
+@profiling.stage('check_classification_items')
 def check_classification_items(class_names, file_meta, file_data, crash=True, warn=True,
                                custom_only=False, exclude_custom=False):
     """
@@ -224,8 +253,6 @@ def check_classification_items(class_names, file_meta, file_data, crash=True, wa
     :param warn: Allows to suppress the warning message
     :return:
     """
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
-    db_classitems = dbio.get_sql_table_as_df('classification_items')
     exists = []  # True / False switch
     for aspect in class_names.index:
         attrib_no = class_names.loc[aspect, 'attribute_no']
@@ -239,14 +266,12 @@ def check_classification_items(class_names, file_meta, file_data, crash=True, wa
         if attrib_no == 'custom' and exclude_custom:
             continue  # skip custom classifications
         # make sure classification id exists -- must pass, otherwise the next command will fail
-        assert class_names.loc[aspect, 'custom_name'] in db_classdef['classification_name'].values, \
+        class_id = classifications.get_class_id(class_names.loc[aspect, 'custom_name'])
+        assert class_id is not None, \
             "Classification '%s' does not exist in table 'classification_definiton'" % \
             class_names.loc[aspect, 'custom_name']
-        # get classification_id
-        class_id = db_classdef.loc[db_classdef['classification_name'] ==
-                                   class_names.loc[aspect, 'custom_name']].index[0]
         # Check if the classification_id already exists in classification_items
-        if class_id in db_classitems['classification_id'].unique():
+        if classifications.has_items(class_id):
             exists.append(True)
             if crash:
                 raise AssertionError("classification_id '%s' already exists in the table classification_items." %
@@ -260,11 +285,6 @@ def check_classification_items(class_names, file_meta, file_data, crash=True, wa
             print(aspect, class_id, 'not in classification_items')
 
         # Next check if all attributes exist
-        if attrib_no == 'custom':
-            attrib_no = 'attribute1_oto'
-        else:
-            attrib_no = 'attribute' + str(int(attrib_no)) + '_oto'
-        checkme = db_classitems.loc[db_classitems['classification_id'] == class_id][attrib_no].values
         if file_meta['data_type'] == 'LIST':
             attributes = file_data[class_names.loc[aspect, 'name']].unique()
         elif file_meta['data_type'] == 'TABLE':
@@ -279,11 +299,13 @@ def check_classification_items(class_names, file_meta, file_data, crash=True, wa
                     attributes = file_data.columns.values
                 else:
                     attributes = file_data.columns.levels[int(class_names.loc[aspect, 'position'][-1])]
-        for attribute in attributes:
-            if str(attribute) in checkme:
+        found = classifications.lookup(class_id, attrib_no, attributes) >= 0
+        for attribute, attribute_exists in zip(attributes, found):
+            if attribute_exists:
                 exists.append(True)
                 if crash:
-                    raise AssertionError("'%s' already in %s" % (attribute, checkme))
+                    raise AssertionError("'%s' already in classification %s, %s" %
+                                         (attribute, class_id, classifications.attribute_column(attrib_no)))
                 elif warn:
                     print("WARNING: '%s' already in classification_items" % attribute)
             else:
@@ -292,6 +314,7 @@ def check_classification_items(class_names, file_meta, file_data, crash=True, wa
     return exists
 
 
+@profiling.stage('create_db_class_defs')
 def create_db_class_defs(file_meta, aspect_table):
     """
     Writes the custom classification to the table classification_definition.
@@ -304,20 +327,27 @@ def create_db_class_defs(file_meta, aspect_table):
     for aspect in class_names.index:
         if class_names.loc[aspect, 'classification_id'] != 'custom':
             continue  # skip already existing classifications
-        d = {'classification_name': str(class_names.loc[aspect, 'custom_name']),
-             'dimension': str(db_aspects.loc[class_names.loc[aspect, 'name'], 'dimension']),
-             'description': 'Custom classification, generated by IEDC_tools v%s' % __version__,
-             'mutually_exclusive': True,
-             'collectively_exhaustive': False,
-             'created_from_dataset': True,  # signifies that this is a custom classification
-             'general': False,
-             'meaning_attribute1': "'%s' aspect of dataset" % aspect  # cannot be NULL???
-             }
-        dbio.dict_sql_insert('classification_definition', d)
+        dbio.dict_sql_insert('classification_definition', _custom_class_definition(class_names, aspect, db_aspects))
         print("Wrote custom classification '%s' to classification_definitions" %
               class_names.loc[aspect, 'custom_name'])
 
 
+def _custom_class_definition(class_names, aspect, db_aspects):
+    """
+    The row of a custom classification in classification_definition.
+    """
+    return {'classification_name': str(class_names.loc[aspect, 'custom_name']),
+            'dimension': str(db_aspects.loc[class_names.loc[aspect, 'name'], 'dimension']),
+            'description': 'Custom classification, generated by IEDC_tools v%s' % __version__,
+            'mutually_exclusive': True,
+            'collectively_exhaustive': False,
+            'created_from_dataset': True,  # signifies that this is a custom classification
+            'general': False,
+            'meaning_attribute1': "'%s' aspect of dataset" % aspect  # cannot be NULL???
+            }
+
+
+@profiling.stage('create_db_class_items')
 def create_db_class_items(file_meta, aspects_table, file_data):
     """
     Writes the unique database items / attributes of a custom classification to the database.
@@ -325,42 +355,149 @@ def create_db_class_items(file_meta, aspects_table, file_data):
     :param file: Data file to read
     """
     class_names = get_class_names(file_meta, aspects_table)
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
     check_classification_items(class_names, file_meta, file_data, custom_only=True, crash=True)
     for aspect in class_names.index:
         if class_names.loc[aspect, 'classification_id'] != 'custom':
             continue  # skip already existing classifications
-        # get classification_id
-        class_id = db_classdef.loc[db_classdef['classification_name'] ==
-                                   class_names.loc[aspect, 'custom_name']].index[0]
-        d = {'classification_id': class_id,
-             'description': 'Custom classification, generated by IEDC_tools v%s' % __version__,
-             'reference': class_names.loc[aspect, 'custom_name'].split('__')[1]}
-        if file_meta['data_type'] == 'LIST':
-            attributes = sorted(file_data[class_names.loc[aspect, 'name']].apply(str).unique())
-        elif file_meta['data_type'] == 'TABLE':
-            if class_names.loc[aspect, 'position'][:-1] == 'col':
-                if len(file_meta['col_classifications'].values) == 1:
-                    # That means there is only one column level defined, i.e. no MultiIndex
-                    attributes = [str(i) for i in file_data.columns]
-                else:
-                    attributes = sorted(
-                        [str(i) for i in file_data.columns.levels[int(class_names.loc[aspect, 'position'][-1])]])
-            elif class_names.loc[aspect, 'position'][:-1] == 'row':
-                if len(file_meta['row_classifications'].values) == 1:
-                    attributes = [str(i) for i in file_data.index]
-                else:
-                    attributes = sorted(
-                        [str(i) for i in file_data.index.levels[int(class_names.loc[aspect, 'position'][-1])]])
-        df = pd.DataFrame({'classification_id': [d['classification_id']] * len(attributes),
-                           'description': [d['description']] * len(attributes),
-                           'reference': [d['reference']] * len(attributes),
-                           'attribute1_oto': attributes})
-        columns = ('classification_id', 'description', 'reference', 'attribute1_oto')
-        dbio.bulk_sql_insert('classification_items', columns, df.values.tolist())
+        class_id = classifications.get_class_id(class_names.loc[aspect, 'custom_name'])
+        attributes = _custom_class_attributes(file_meta, class_names, aspect, file_data)
+        dbio.bulk_sql_insert('classification_items', CUSTOM_ITEM_COLUMNS,
+                             _custom_class_items(class_id, class_names.loc[aspect, 'custom_name'], attributes))
         print("Wrote attributes for custom classification '%s' to classification_items: %s" % (class_id, attributes))
 
 
+def _custom_class_attributes(file_meta, class_names, aspect, file_data):
+    """
+    The distinct attributes of a custom classification in a data file.
+    """
+    if file_meta['data_type'] == 'LIST':
+        attributes = sorted(file_data[class_names.loc[aspect, 'name']].apply(str).unique())
+    elif file_meta['data_type'] == 'TABLE':
+        if class_names.loc[aspect, 'position'][:-1] == 'col':
+            if len(file_meta['col_classifications'].values) == 1:
+                # That means there is only one column level defined, i.e. no MultiIndex
+                attributes = [str(i) for i in file_data.columns]
+            else:
+                attributes = sorted(
+                    [str(i) for i in file_data.columns.levels[int(class_names.loc[aspect, 'position'][-1])]])
+        elif class_names.loc[aspect, 'position'][:-1] == 'row':
+            if len(file_meta['row_classifications'].values) == 1:
+                attributes = [str(i) for i in file_data.index]
+            else:
+                attributes = sorted(
+                    [str(i) for i in file_data.index.levels[int(class_names.loc[aspect, 'position'][-1])]])
+    return attributes
+
+
+def _custom_class_items(class_id, class_name, attributes):
+    """
+    Rows of classification_items for the attributes of a custom classification, see CUSTOM_ITEM_COLUMNS.
+    """
+    description = 'Custom classification, generated by IEDC_tools v%s' % __version__
+    reference = class_name.split('__')[1]
+    return [[class_id, description, reference, attribute] for attribute in attributes]
+
+
+def get_new_custom_classifications(file_meta, aspect_table, file_data):
+    """
+    Collects the custom classifications of a data file that are not in the database yet, to be written together with
+    the ones of other files by register_custom_classifications().
+
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :return: Dictionary of classification_name: {'definition': row of classification_definition, 'items': list of
+        attributes}
+    """
+    class_names = get_class_names(file_meta, aspect_table)
+    db_aspects = dbio.get_sql_table_as_df('aspects', index='aspect')
+    new = {}
+    for aspect in class_names.index:
+        if class_names.loc[aspect, 'classification_id'] != 'custom':
+            continue
+        if classifications.get_class_id(class_names.loc[aspect, 'custom_name']) is not None:
+            continue  # see create_db_class_items()
+        new[class_names.loc[aspect, 'custom_name']] = {
+            'definition': _custom_class_definition(class_names, aspect, db_aspects),
+            'items': _custom_class_attributes(file_meta, class_names, aspect, file_data)}
+    return new
+
+
+@profiling.stage('register_custom_classifications')
+def register_custom_classifications(new, chunk_size=10000):
+    """
+    Writes the custom classifications of many data files at once: all definitions in one statement, and then all
+    their items in chunks, instead of a few statements per classification like create_db_class_defs() and
+    create_db_class_items().
+
+    :param new: List of dictionaries, one per file, see get_new_custom_classifications(). Classifications with the same
+        name, e.g. of two versions of a dataset, are merged.
+    :param chunk_size: Number of items per insert statement
+    :return: Dictionary of classification_name: classification_id
+    """
+    merged = {}
+    for file_new in new:
+        for name, spec in file_new.items():
+            if name in merged:
+                known = set(merged[name]['items'])
+                merged[name]['items'] += [i for i in spec['items'] if i not in known]
+            else:
+                merged[name] = {'definition': spec['definition'], 'items': list(spec['items'])}
+    if not merged:
+        return {}
+    ids, n_items = _write_custom_classifications(merged, chunk_size)
+    print("Wrote %s custom classifications with %s attributes to classification_definitions and "
+          "classification_items: %s" % (len(merged), n_items, ', '.join(merged)))
+    return ids
+
+
+@dbio.db_cursor_write
+def _write_custom_classifications(curs, merged, chunk_size):
+    """
+    Writes the definitions and items of register_custom_classifications() in one transaction, so a failure doesn't
+    leave classifications without their items.
+    """
+    columns = list(next(iter(merged.values()))['definition'])
+    ids = dbio.insert_ids(curs, 'classification_definition', columns,
+                          [[spec['definition'][c] for c in columns] for spec in merged.values()], 'classification_name')
+    items = [item for name, spec in merged.items() for item in _custom_class_items(ids[name], name, spec['items'])]
+    dbio.table_changed('classification_items')
+    sql = "INSERT INTO classification_items (%s) VALUES (%s);" % (', '.join(CUSTOM_ITEM_COLUMNS),
+                                                                   ', '.join(['%s'] * len(CUSTOM_ITEM_COLUMNS)))
+    for start in range(0, len(items), chunk_size):
+        curs.executemany(sql, items[start:start + chunk_size])
+    return ids, len(items)
+
+
+def add_custom_class_items(file_meta, aspect_table, file_data):
+    """
+    Adds the attributes of a data file that are missing in its existing custom classifications, e.g. new years in a
+    corrected file of an uploaded dataset, see update_data(). Custom classifications that don't exist yet are left to
+    register_custom_classifications().
+
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :return: Number of attributes added
+    """
+    class_names = get_class_names(file_meta, aspect_table)
+    items = []
+    for aspect in class_names.index:
+        if class_names.loc[aspect, 'classification_id'] != 'custom':
+            continue
+        class_id = classifications.get_class_id(class_names.loc[aspect, 'custom_name'])
+        if class_id is None:
+            continue
+        attributes = _custom_class_attributes(file_meta, class_names, aspect, file_data)
+        found = classifications.lookup(class_id, class_names.loc[aspect, 'attribute_no'], attributes) >= 0
+        missing = [a for a, a_found in zip(attributes, found) if not a_found]
+        items += _custom_class_items(class_id, class_names.loc[aspect, 'custom_name'], missing)
+    if items:
+        dbio.bulk_sql_insert('classification_items', CUSTOM_ITEM_COLUMNS, items)
+        print("Added %s attributes to custom classifications: %s" % (len(items), [i[-1] for i in items]))
+    return len(items)
+
+
 def add_user(file_meta, quiet=False):
     dataset_info = file_meta['dataset_info']
     db_user = dbio.get_sql_table_as_df('users')
@@ -391,6 +528,7 @@ def add_license(file_meta, quiet=False):
         print("Licence '%s' written to db table 'licences'" % file_licence)
 
 
+@profiling.stage('parse_stats_array_list')
 def parse_stats_array_list(stats_array_strings):
     """
     Parses the 'stats_array string' from the Excel template. E.g. "3;10;3.0;none;" should fill the respecitve columns
@@ -412,7 +550,15 @@ def parse_stats_array_list(stats_array_strings):
     return [return_df[i].values for i in range(len(return_df.columns))]
 
 
-def parse_stats_array_table(file, file_meta, row_indices, col_indices):
+@profiling.stage('parse_stats_array_table')
+def parse_stats_array_table(file_meta, data=None):
+    """
+    Parses the stats arrays of a TABLE type file, either the one on the Cover sheet or the sheet `stats_array_string`.
+    :param file_meta: data file metadata
+    :param data: Long format of the file, see assemble_table(). Only needed for sheet `stats_array_string`.
+    :return: Dictionary with the type ('GLOBAL' or 'TABLE') and the data: a list of the four stats array fields or a
+        dataframe with the same index as `data`
+    """
     # db_sa = dbio.get_sql_table_as_df('stats_array', index=None)
     if file_meta['data_sources'].loc['Dataset_Uncertainty', 'a'] == 'GLOBAL':
         if file_meta['data_sources'].loc['Dataset_Uncertainty', 'b'] in ('none', 'None'):
@@ -422,11 +568,8 @@ def parse_stats_array_table(file, file_meta, row_indices, col_indices):
         return {'type': 'GLOBAL',
                 'data': sa_res}
     elif file_meta['data_sources'].loc['Dataset_Uncertainty', 'a'] == 'TABLE':
-        file_sa = file_io.read_stats_array_table(file, row_indices, col_indices)
-        sa_tmp = file_sa.reset_index().melt(file_sa.index.names)
-        sa_tmp = sa_tmp.set_index(row_indices)
         # parse the string https://stackoverflow.com/a/21032532/2075003
-        sa_res = sa_tmp['value'].str.split(';', expand=True)
+        sa_res = data['stats_array_string'].str.split(';', expand=True)
         sa_res.columns = ['stats_array_' + str(i+1) for i in range(4)]
         sa_res = sa_res.replace(['none'], [None])
         sa_res = sa_res.astype({'stats_array_1': int, 'stats_array_2': float,
@@ -437,7 +580,15 @@ def parse_stats_array_table(file, file_meta, row_indices, col_indices):
         raise AttributeError("Unknown data unit type specified. Must be either 'GLOBAL' or 'TABLE'.")
 
 
-def get_comment_table(file, file_meta, row_indices, col_indices):
+@profiling.stage('get_comment_table')
+def get_comment_table(file_meta, data=None):
+    """
+    The comments of a TABLE type file, either the one on the Cover sheet or the sheet `Comment`.
+    :param file_meta: data file metadata
+    :param data: Long format of the file, see assemble_table(). Only needed for sheet `Comment`.
+    :return: Dictionary with the type ('GLOBAL' or 'TABLE') and the data: a string or a series with the same index as
+        `data`
+    """
     if file_meta['data_sources'].loc['Dataset_Comment', 'a'] == 'GLOBAL':
         if file_meta['data_sources'].loc['Dataset_Comment', 'b'] in ('none', 'None'):
             comment = None
@@ -446,15 +597,13 @@ def get_comment_table(file, file_meta, row_indices, col_indices):
         return {'type': 'GLOBAL',
                 'data': comment}
     elif file_meta['data_sources'].loc['Dataset_Comment', 'a'] == 'TABLE':
-        comment = file_io.read_comment_table(file, row_indices, col_indices)
-        comment = comment.reset_index().melt(comment.index.names)
-        comment = comment.set_index(row_indices)
         return {'type': 'TABLE',
-                'data': comment}
+                'data': data['Comment']}
     else:
         raise AttributeError("Unknown data unit type specified. Must be either 'GLOBAL' or 'TABLE'.")
 
 
+@profiling.stage('get_unit_list')
 def get_unit_list(file_data):
     db_units = dbio.get_sql_table_as_df('units', index=None)
     res = pd.DataFrame()
@@ -470,7 +619,6 @@ def get_unit_list(file_data):
             else:
                 raise AssertionError("The following unit is not in units table: %s" %
                                      set(file_data[nom_denom].unique()).difference(db_units['unitcode'].values))
-        file_data[nom_denom] = file_data[nom_denom].apply(str)
         tmp = file_data.merge(db_units, left_on=nom_denom, right_on=merge_col, how='left')
         if len(tmp.index) != len(file_data.index):
             raise AssertionError("Duplicate entry on (unit nominator,unit denominator) tuple in the unit table. Data upload haltet. Check unit table!")
@@ -481,46 +629,74 @@ def get_unit_list(file_data):
     return res
 
 
-def upload_data_list(file_meta, aspect_table, file_data, crash=True):
+def get_dataset_name_ver(file_meta):
     """
-    Uploads the actual data from the Excel template file (sheet Data) into the database.
-    :param file: Name of the file to read. String.
-    :param crash: Will stop if an error occurs
-    :return:
+    Returns the dataset name and version of a data file as a list. An empty version is returned as None.
+    :param file_meta: data file metadata
     """
-    class_names = get_class_names(file_meta, aspect_table)
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
-    class_ids = [db_classdef[db_classdef['classification_name'] == i].index[0] for i
-                 in class_names['custom_name'].values]
-    db_classitems = dbio.get_sql_table_as_df('classification_items', addSQL="WHERE classification_id IN (%s)" %
-                                                                            ', '.join([str(s) for s in class_ids]))
-    db_classitems['i'] = db_classitems.index
-    db_datasets = dbio.get_sql_table_as_df('datasets')
-    db_data_ids = dbio.get_sql_table_as_df('data', ['DISTINCT dataset_id'], index=None).values
-    # Let's make sure all classifications and attributes exist in the database
-    assert all(check_classification_definition(class_names, crash=False, custom_only=False, warn=False)), \
-        "Not all classifications found in classification_definitions"
-    assert all(check_classification_items(class_names, file_meta, file_data,
-                                          crash=False, custom_only=False, warn=False)),\
-        "Not all classification_ids or attributes found in classification_items"
-    # Time to loop through the file's aspects
     dataset_info = file_meta['dataset_info']
-    # Check if entry already exists
     dataset_name_ver = [i[0] for i in dataset_info.loc[['dataset_name', 'dataset_version']]
                         .where((pd.notnull(dataset_info.loc[['dataset_name', 'dataset_version']])), None).values]
     if dataset_name_ver[1] in ['NULL']:
         dataset_name_ver[1] = None
+    return dataset_name_ver
+
+
+def get_dataset_id(file_meta):
+    """
+    Looks up the id of the file's dataset (name + version) in the `datasets` catalog.
+    :param file_meta: data file metadata
+    :return: dataset_id
+    """
+    db_datasets = dbio.get_sql_table_as_df('datasets')
+    dataset_name_ver = get_dataset_name_ver(file_meta)
     # If the dataset name+version entry does not exist yet
-    if dataset_name_ver not in db_datasets[['dataset_name', 'dataset_version']].values.tolist(): # dataset name + verion already exists in dataset catalog
+    if dataset_name_ver not in db_datasets[['dataset_name', 'dataset_version']].values.tolist():
         raise AssertionError("Database catalog does not contain the following dataset (dataset_name, dataset_version). Please use validate.check_datasets_entry to ensure that the catalog entry exists before uploading data for: %s"
                                  % dataset_name_ver)
-    dataset_name = dataset_name_ver[0] # file_meta['dataset_info'].loc['dataset_name',    'Dataset entries']
-    dataset_vers = dataset_name_ver[1] # file_meta['dataset_info'].loc['dataset_version', 'Dataset entries']
-    # get id of dataset_name_ver:
-    dataset_id = db_datasets[(db_datasets['dataset_name'] == dataset_name) & (db_datasets['dataset_version'] == dataset_vers)].index.values[0]
-    # Check that no data are present already in the data table:
-    if dataset_id in db_data_ids:
-         raise AssertionError("The database already contains values for dataset_id '%s' in the 'data' table. This upload is cancelled to avoid conflicts." % dataset_id)        
+    if dataset_name_ver[1] is None:
+        dataset_id = db_datasets.loc[(db_datasets['dataset_name'] == dataset_name_ver[0]) &
+                                     pd.isna(db_datasets['dataset_version'])].index[0]
+    else:
+        dataset_id = db_datasets.loc[(db_datasets['dataset_name'] == dataset_name_ver[0]) &
+                                     (db_datasets['dataset_version'] == dataset_name_ver[1])].index[0]
+    return int(dataset_id)
+
+
+def dataset_has_data(dataset_id):
+    """
+    Checks if the `data` table already contains values for a dataset_id.
+    """
+    return not dbio.get_sql_table_as_df('data', ['id'], index=None,
+                                        addSQL="WHERE dataset_id = %s LIMIT 1" % int(dataset_id)).empty
+
+
+def upload_incomplete(dataset_id):
+    """
+    Checks if an upload of a dataset was started but didn't finish, e.g. because the connection was lost after the
+    catalog entry or some chunks were written. The fingerprint is recorded last, see `fingerprint`, so the dataset has
+    none, and it has either no data at all or the checkpoints of the chunks committed so far, see `checkpoint`. Such an
+    upload can be resumed.
+    """
+    if fingerprint.get(dataset_id) is not None:
+        return False
+    return checkpoint.has_checkpoints(dataset_id) or not dataset_has_data(dataset_id)
+
+
+@profiling.stage('resolve_data_list')
+def resolve_data_list(file_meta, aspect_table, file_data, dataset_id, lookup=True):
+    """
+    Turns the data of a LIST type file into the shape of the database's `data` table, i.e. replaces classification
+    attributes, units, and stats arrays with their database ids.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param lookup: If False, the classification attributes are left as they are, e.g. to compute the dataset's
+        `fingerprint` before its custom classifications exist. See lookup_aspects().
+    :return: Dictionary with the `data` table's column names ('sql_columns') and the values ('data', a dataframe)
+    """
+    class_names = get_class_names(file_meta, aspect_table)
     # TODO: There is a bad mismatch between Excel templates and the db's data table. Ugly code ahead.
     more_df_columns = ['value', 'unit nominator', 'unit denominator', 'comment']
     more_sql_columns = ['value', 'unit_nominator', 'unit_denominator', 'stats_array_1', 'stats_array_2',
@@ -529,20 +705,7 @@ def upload_data_list(file_meta, aspect_table, file_data, crash=True):
     df_columns = ['dataset_id'] + class_names['name'].values.tolist() + more_df_columns
     sql_columns = ['dataset_id'] + [a.replace('_','') for a in class_names.index] + more_sql_columns
     # sql_columns = [a + '_oto' if a.startswith('aspect') else a for a in sql_columns]
-    data = file_data[df_columns]
-    # Now for the super tedious replacement of names with ids...
-    for n, aspect in enumerate(class_names.index):
-        db_classitems2 = db_classitems[db_classitems['classification_id'] == class_ids[n]]
-        attribute_no = class_names.loc[aspect, 'attribute_no']
-        if attribute_no == 'custom':
-            attribute_no = 1
-        class_name = class_names.loc[aspect, 'name']
-        file_data[class_name] = file_data[class_name].apply(str)
-        tmp = file_data.merge(db_classitems2, left_on=class_name, right_on='attribute%s_oto' %
-                                                                               str(int(attribute_no)), how='left')
-        if len(tmp.index) != len(data.index):
-            raise AssertionError("The database classification table contains at least one conflicting duplicate entry for the unique attribute attribute%s_oto of classification %s. Data upload halted. Check classification for duplicate entries!" % (str(int(attribute_no)), class_name))        
-        data.loc[:, class_name] = tmp['i']
+    data = file_data[df_columns].copy()
     units = get_unit_list(file_data)
     data['unit nominator'] = units['unit nominator']
     data['unit denominator'] = units['unit denominator']
@@ -551,15 +714,112 @@ def upload_data_list(file_meta, aspect_table, file_data, crash=True):
      enumerate(parse_stats_array_list(file_data['stats_array string']))]
     # data['stats_array_1'], data['stats_array_2'], data['stats_array_3'], data['stats_array_4'] = \
     #     parse_stats_array_list(file_data['stats_array string'])
-    # clean up some more mess
-    data = data.replace(['none'], [None])
-    data = data.replace([np.nan], [None])
-    # look up values in classification_items
-    dbio.bulk_sql_insert('data', sql_columns, data.values.tolist())
+    # clean up some more mess, but not in the classification attributes
+    other_columns = [c for c in data.columns if c not in class_names['name'].values]
+    data[other_columns] = data[other_columns].replace(['none'], [None])
+    data[other_columns] = data[other_columns].replace([np.nan], [None])
+    resolved = {'sql_columns': sql_columns,
+                'data': data}
+    if lookup:
+        resolved = lookup_aspects(file_meta, aspect_table, file_data, resolved)
+    return resolved
+
+
+def lookup_aspects(file_meta, aspect_table, file_data, resolved):
+    """
+    Replaces the classification attributes in resolved data with the ids of the classification items. All
+    classifications, including the custom ones, must exist in the database.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param resolved: see resolve_data_list(lookup=False) and resolve_data_table(lookup=False)
+    :return: Dictionary with the `data` table's column names ('sql_columns') and the values ('data', a dataframe)
+    """
+    class_names = get_class_names(file_meta, aspect_table)
+    class_ids = [classifications.get_class_id(i) for i in class_names['custom_name'].values]
+    # Let's make sure all classifications and attributes exist in the database
+    assert all(check_classification_definition(class_names, crash=False, custom_only=False, warn=False)), \
+        "Not all classifications found in classification_definitions"
+    assert all(check_classification_items(class_names, file_meta, file_data,
+                                          crash=False, custom_only=False, warn=False)),\
+        "Not all classification_ids or attributes found in classification_items"
+    data = resolved['data']
+    # Now for the super tedious replacement of names with ids...
+    for n, aspect in enumerate(class_names.index):
+        class_name = class_names.loc[aspect, 'name']
+        ids = classifications.lookup(class_ids[n], class_names.loc[aspect, 'attribute_no'], data[class_name])
+        assert not (ids < 0).any(), "The correct classification could not be found for '%s'" % class_name
+        data[class_name] = ids
+    return resolved
+
+
+def find_identical_datasets(file, file_meta, aspect_table, file_data, dataset_id=None, path=None):
+    """
+    Checks if the data of a candidate file are in the database already, i.e. if an uploaded dataset has the same
+    `fingerprint`. Writes nothing to the database.
+    :param file: Name of the file. Only needed for TABLE type files.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param dataset_id: id of the dataset in the `datasets` table, if it exists already. It doesn't count as identical,
+        e.g. when it is replaced.
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return: Dictionary with the fingerprint, the list of dataset_ids with the same data ('identical'), and the data
+        resolved without aspect ids ('resolved'), see lookup_aspects()
+    """
+    if file_meta['data_type'] == 'LIST':
+        resolved = resolve_data_list(file_meta, aspect_table, file_data, dataset_id, lookup=False)
+    else:
+        resolved = resolve_data_table(file, file_meta, aspect_table, file_data, dataset_id, lookup=False, path=path)
+    fp = fingerprint.compute(get_class_names(file_meta, aspect_table), resolved)
+    return {'fingerprint': fp,
+            'identical': fingerprint.find(fp, exclude=dataset_id),
+            'resolved': resolved}
+
+
+@profiling.stage('upload_data_list')
+def upload_data_list(file_meta, aspect_table, file_data, crash=True, chunk_size=10000, bulk_load=False):
+    """
+    Uploads the actual data from the Excel template file (sheet Data) into the database.
+    The upload is committed in chunks. If it is interrupted, running it again resumes after the last committed chunk.
+    :param file: Name of the file to read. String.
+    :param crash: Will stop if an error occurs
+    :param chunk_size: Number of rows per chunk, see `checkpoint.upload_checkpointed()`
+    :param bulk_load: Insert in a bulk load session, see `checkpoint.upload_checkpointed()`
+    :return:
+    """
+    # Validation may have run against a local snapshot. Make sure it wasn't outdated.
+    snapshot.assert_fresh()
+    dataset_name = get_dataset_name_ver(file_meta)[0]
+    dataset_id = get_dataset_id(file_meta)
+    # Check that no data are present already in the data table, unless an earlier upload was interrupted
+    if dataset_has_data(dataset_id) and not checkpoint.has_checkpoints(dataset_id):
+         raise AssertionError("The database already contains values for dataset_id '%s' in the 'data' table. This upload is cancelled to avoid conflicts." % dataset_id)        
+    identical = find_identical_datasets(None, file_meta, aspect_table, file_data, dataset_id)
+    if identical['identical']:
+        raise AssertionError("The data of '%s' are identical to the data of dataset_id %s. This upload is cancelled."
+                             % (dataset_name, identical['identical']))
+    resolved = lookup_aspects(file_meta, aspect_table, file_data, identical['resolved'])
+    checkpoint.upload_checkpointed(dataset_id, resolved['sql_columns'], resolved['data'], chunk_size=chunk_size,
+                                   bulk_load=bulk_load)
+    checkpoint.verify_upload(dataset_id, resolved['sql_columns'], resolved['data'])
+    catalog.record(dataset_id, catalog.compute(resolved['sql_columns'], resolved['data']))
+    fingerprint.record(dataset_id, identical['fingerprint'], len(resolved['data'].index))
+    # The upload is complete, there is nothing left to resume
+    checkpoint.clear_checkpoints(dataset_id)
     print("Wrote data for '%s', dataset_id: %s" % (dataset_name, dataset_id))
 
 
-def get_unit_table(file, file_meta, row_indices, col_indices):
+@profiling.stage('get_unit_table')
+def get_unit_table(file_meta, data=None):
+    """
+    Unit ids of a TABLE type file, either of the units on the Cover sheet or of the sheets `Unit_nominator` and
+    `Unit_denominator`.
+    :param file_meta: data file metadata
+    :param data: Long format of the file, see assemble_table(). Only needed for the unit sheets.
+    :return: Dictionary with the type ('GLOBAL' or 'TABLE') and the ids of the nominator and denominator: integers or
+        series with the same index as `data`
+    """
     db_units = dbio.get_sql_table_as_df('units', index=None)
     # first method for LIST type data and also for certain TABLE type
     if file_meta['data_sources'].loc['Dataset_Unit', 'a'] == 'GLOBAL':
@@ -582,12 +842,10 @@ def get_unit_table(file, file_meta, row_indices, col_indices):
                 'denominator': int(db_units.loc[db_units[merge_col['u_denominator']] ==
                                                 file_meta['u_denominator']]['id'])}
     elif file_meta['data_sources'].loc['Dataset_Unit', 'a'] == 'TABLE':
-        file_units = file_io.read_units_table(file, row_indices, col_indices)
         units = {}
-        for nom_denom in file_units:
-            units[nom_denom] = file_units[nom_denom].reset_index().melt(file_units[nom_denom].index.names)
-            units[nom_denom] = units[nom_denom].set_index(row_indices)
-            for u in units[nom_denom]['value'].unique():
+        for nom_denom in ('Unit_nominator', 'Unit_denominator'):
+            unit_ids = {}
+            for u in data[nom_denom].unique():
                 # check if all units present in one of the units columns
                 if str(u) in db_units['unitcode'].values:
                     merge_col = 'unitcode'
@@ -597,12 +855,8 @@ def get_unit_table(file, file_meta, row_indices, col_indices):
                     merge_col = 'alt_unitcode2'
                 else:
                     raise AssertionError("The following unit is not in units table: %s" % u)
-                units[nom_denom].loc[units[nom_denom]['value'] == u, 'icol'] = \
-                    int(db_units.loc[db_units[merge_col] == str(u)]['id'])
-            # TODO: Remove
-            #  res = pd.DataFrame(index=ordered_index.set_index(row_indices).index)
-            #  res['nominator'] = units[nom_denom]['value']
-            #  res['icol'] = units['icol']
+                unit_ids[u] = int(db_units.loc[db_units[merge_col] == str(u)]['id'])
+            units[nom_denom] = data[nom_denom].map(unit_ids).astype(int)
         return {'type': 'TABLE',
                 'nominator': units['Unit_nominator'],
                 'denominator': units['Unit_denominator']}
@@ -610,122 +864,334 @@ def get_unit_table(file, file_meta, row_indices, col_indices):
         raise AttributeError("Unknown data unit type specified. Must be either 'GLOBAL' or 'TABLE'.")
 
 
-def upload_data_table(file, file_meta, aspect_table, file_data, crash=True):
+def skip_empty_cells(file_meta):
     """
-    Uploads the actual data from the Excel template file (sheet Data) into the database.
-    Dataset entry must already be present in dataset table, use validate.check_datasets_entry to ensure that.
-    Main table data must not contain any values for this dataset id (unique for dataset name and version).
+    Checks the `Insert_Empty_Cells_as_NULL` switch of a TABLE type file.
+    :return: True if empty cells are not uploaded
+    """
+    # Not all classifications have this field yet...
+    # Check if NULL values should be skipped or added  https://github.com/IndEcol/IE_data_commons/issues/21
+    return 'Insert_Empty_Cells_as_NULL' in file_meta['data_sources'].index and \
+        file_meta['data_sources'].loc['Insert_Empty_Cells_as_NULL', 'a'] == 'False'
+
+
+def table_cells(file_meta, file_data):
+    """
+    The cells of a TABLE type file that are uploaded, in the order of melting the table column by column. Empty cells
+    are left out if `Insert_Empty_Cells_as_NULL` is False, so the later steps only handle the filled cells.
+    :param file_meta: data file metadata
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :return: Tuple of numpy arrays (row positions, column positions)
+    """
+    if skip_empty_cells(file_meta):
+        filled = file_data.notna().values
+    else:
+        filled = np.ones(file_data.shape, dtype=bool)
+    # Transposed, so the cells are sorted by column
+    cols, rows = np.nonzero(filled.T)
+    return rows, cols
+
+
+def melt_cells(table, cells):
+    """
+    Turns cells of a sheet of a TABLE type file into long format: one column per row and column aspect, and the column
+    'value'. For all cells, the values are the same as of `table.reset_index().melt(table.index.names)`.
+    :param table: Dataframe of a sheet, e.g. `Data` or `Comment`
+    :param cells: Tuple of row and column positions, see table_cells()
+    :return: Dataframe
+    """
+    rows, cols = cells
+    res = {}
+    # The aspects as categorical, so each label is looked up only once, see classifications.lookup()
+    for labels, positions in ((table.index, rows), (table.columns, cols)):
+        for name in labels.names:
+            codes, categories = labels.get_level_values(name).factorize()
+            res[name] = pd.Categorical.from_codes(codes.take(positions), categories=categories)
+    res['value'] = table.values[rows, cols]
+    return pd.DataFrame(res)
+
+
+@profiling.stage('assemble_table')
+def assemble_table(file, file_meta, file_data, path=None):
+    """
+    Turns all sheets of a TABLE type file into one long format dataframe. Reads the unit, stats array, and comment
+    sheets that the Cover sheet asks for, see TABLE_SHEETS, and checks that their rows and columns are the same as in
+    sheet `Data`, see `integrity.check_alignment()`. Only the cells of table_cells() are kept.
     :param file: Name of the file to read. String.
-    :param crash: Will stop if an error occurs
-    :return:
+    :param file_meta: data file metadata
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return: Dataframe with a column per aspect, the column 'value', and a column per further sheet, e.g. 'Comment'
+    """
+    sheet_names = [sheet for field, sheets in TABLE_SHEETS.items()
+                   if file_meta['data_sources'].loc[field, 'a'] == 'TABLE' for sheet in sheets]
+    sheets = file_io.read_table_sheets(file, sheet_names, file_data.index.names, file_data.columns.names, path=path)
+    integrity.assert_integrity(os.path.basename(file), integrity.check_alignment(file_data, sheets))
+    cells = table_cells(file_meta, file_data)
+    data = melt_cells(file_data, cells)
+    for sheet in sheet_names:
+        data[sheet] = sheets[sheet].values[cells]
+    return data
+
+
+@profiling.stage('resolve_data_table')
+def resolve_data_table(file, file_meta, aspect_table, file_data, dataset_id, lookup=True, path=None):
+    """
+    Turns the data of a TABLE type file into the shape of the database's `data` table, i.e. melts the table to long
+    format and replaces classification attributes, units, and stats arrays with their database ids. If empty cells are
+    skipped, see skip_empty_cells(), only the filled cells are melted and resolved.
+    :param file: Name of the file to read. String.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param dataset_id: id of the dataset in the `datasets` table
+    :param lookup: If False, the classification attributes are left as they are, see resolve_data_list()
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return: Dictionary with the `data` table's column names ('sql_columns') and the values ('data', a dataframe)
     """
     class_names = get_class_names(file_meta, aspect_table)
-    db_classdef = dbio.get_sql_table_as_df('classification_definition')
-    class_ids = [db_classdef[db_classdef['classification_name'] == i].index[0] for i
-                 in class_names['custom_name'].values]
-    db_classitems = dbio.get_sql_table_as_df('classification_items', addSQL="WHERE classification_id IN (%s)" %
-                                                                            ', '.join([str(s) for s in class_ids]))
-    db_classitems['i'] = db_classitems.index
-    db_datasets = dbio.get_sql_table_as_df('datasets')
-    db_data_ids = dbio.get_sql_table_as_df('data', ['DISTINCT dataset_id'], index=None).values
-    # Let's make sure all classifications and attributes exist in the database
-    assert all(check_classification_definition(class_names, crash=False, custom_only=False, warn=False)), \
-        "Not all classifications found in classification_definitions"
-    assert all(check_classification_items(class_names, file_meta, file_data,
-                                          crash=False, custom_only=False, warn=False)), \
-        "Not all classification_ids or attributes found in classification_items"
-    dataset_info = file_meta['dataset_info']
-    # Check if entry already exists
-    dataset_name_ver = [i[0] for i in dataset_info.loc[['dataset_name', 'dataset_version']]
-                        .where((pd.notnull(dataset_info.loc[['dataset_name', 'dataset_version']])), None).values]
-    if dataset_name_ver[1] in ['NULL']:
-        dataset_name_ver[1] = None
-    # If the dataset name+version entry does not exist yet
-    if dataset_name_ver not in db_datasets[['dataset_name', 'dataset_version']].values.tolist(): # dataset name + verion already exists in dataset catalog
-        raise AssertionError("Database catalog does not contain the following dataset (dataset_name, dataset_version). Please use validate.check_datasets_entry to ensure that the catalog entry exists before uploading data for: %s"
-                                 % dataset_name_ver)
-    dataset_name = dataset_name_ver[0] # file_meta['dataset_info'].loc['dataset_name',    'Dataset entries']
-    dataset_vers = dataset_name_ver[1] # file_meta['dataset_info'].loc['dataset_version', 'Dataset entries']
-    # get id of dataset_name_ver:
-    dataset_id = db_datasets[(db_datasets['dataset_name'] == dataset_name) & (db_datasets['dataset_version'] == dataset_vers)].index.values[0]
-    # Check that no data are present already in the data table:
-    if dataset_id in db_data_ids:
-         raise AssertionError("The database already contains values for dataset_id '%s' in the 'data' table. This upload is cancelled to avoid conflicts." % dataset_id)
-    # Gotta love Pandas: http://pandas.pydata.org/pandas-docs/stable/generated/pandas.melt.html
-    # https://stackoverflow.com/q/53464475/2075003
-    data = file_data.reset_index().melt(file_data.index.names)
+    data = assemble_table(file, file_meta, file_data, path)
+    if skip_empty_cells(file_meta):
+        # No entry for empty data points
+        print("`Insert_Empty_Cells_as_NULL` is set to False. Skipping %i empty / NULL values."
+              % (file_data.size - len(data.index)))
     data.insert(0, 'dataset_id', dataset_id)
-    # Now for the super tedious replacement of names with ids...
-    for n, aspect in enumerate(class_names.index):
-        db_classitems2 = db_classitems[db_classitems['classification_id'] == class_ids[n]]
-        attribute_no = class_names.loc[aspect, 'attribute_no']
-        if attribute_no == 'custom':
-            attribute_no = 1
-        class_name = class_names.loc[aspect, 'name']
-        if class_names.loc[aspect, 'position'][:3] == 'col':
-            if len(file_meta['col_classifications'].values) == 1:
-                # That means there is only one column level defined, i.e. no MultiIndex
-                file_data.columns = [str(c) for c in file_data.columns]
-            else:
-                file_data.columns.set_levels(
-                    [str(i) for i in file_data.columns.levels[file_data.columns.names.index(class_name)]],
-                    level=file_data.columns.names.index(class_name), inplace=True)
-        elif class_names.loc[aspect, 'position'][:3] == 'row':
-            if len(file_meta['row_classifications'].values) == 1:
-                file_data = file_data.rename({c: str(c) for c in file_data.index})
-            else:
-                file_data.index.set_levels(
-                    [str(i) for i in file_data.index.levels[file_data.index.names.index(class_name)]],
-                    level=file_data.index.names.index(class_name), inplace=True)
-        # Make sure the columns that will be used to match have the same data type
-        data[class_name] = data[class_name].astype(str)
-        tmp = data.merge(db_classitems2, left_on=class_name,
-                         right_on='attribute%s_oto' % str(int(attribute_no)), how='left')
-        if len(tmp.index) != len(data.index):
-            raise AssertionError("The database classification table contains at least one conflicting duplicate entry for the unique attribute attribute%s_oto of classification %s. Data upload halted. Check classification for duplicate entries!" % (str(int(attribute_no)), class_name))
-        assert not any(pd.isna(tmp['i'])), "The correct classification could not be found for '%s'" % class_name         
-        data.loc[:, class_name] = tmp['i']
-    units = get_unit_table(file, file_meta, file_data.index.names, file_data.columns.names)
-    if units['type'] == 'TABLE':
-        data['unit_nominator'] = units['nominator']['icol'].apply(int).values
-        data['unit_denominator'] = units['denominator']['icol'].apply(int).values
-    elif units['type'] == 'GLOBAL':
-        data['unit_nominator'] = units['nominator']
-        data['unit_denominator'] = units['denominator']
+    # Integers for the GLOBAL type, otherwise series with the same index as data
+    units = get_unit_table(file_meta, data)
+    data['unit_nominator'] = units['nominator']
+    data['unit_denominator'] = units['denominator']
     # parse the stats_array_string column
-    stats_array = parse_stats_array_table(file, file_meta, file_data.index.names, file_data.columns.names)
+    stats_array = parse_stats_array_table(file_meta, data)
     if stats_array['type'] == 'TABLE':
-        data = pd.concat([data, stats_array['data'].reset_index(drop=True, inplace=True)], axis=1)
         for c in stats_array['data']:
-            data[c] = stats_array['data'][c].values
+            data[c] = stats_array['data'][c]
     elif stats_array['type'] == 'GLOBAL':
         for n, c in enumerate(['stats_array_' + str(i+1) for i in range(4)]):
             data[c] = stats_array['data'][n]
         # [data.insert(len(data.columns) - 1, 'stats_array_%s' % str(n + 1), l) for n, l in
         #  enumerate(stats_array['data'])]
-    comment = get_comment_table(file, file_meta, file_data.index.names, file_data.columns.names)
-    if comment['type'] == 'GLOBAL':
-        data['comment'] = comment['data']
-    elif comment['type'] == 'TABLE':
-        data['comment'] = comment['data']['value'].values
+    comment = get_comment_table(file_meta, data)
+    data['comment'] = comment['data']
     # Seems to be a bug!  https://github.com/pandas-dev/pandas/issues/16784
     #  data = data.replace(['none'], [None])
-    data = data.replace([np.nan], [None])
-    for r in ['na', 'nan']:
-        data = data.replace(r, None)
-    # Not all classifications have this field yet...
-    if 'Insert_Empty_Cells_as_NULL' in file_meta['data_sources'].index:
-        # Check if NULL values should be skipped or added  https://github.com/IndEcol/IE_data_commons/issues/21
-        if file_meta['data_sources'].loc['Insert_Empty_Cells_as_NULL', 'a'] == 'False':
-            # No entry for empty data points
-            print("`Insert_Empty_Cells_as_NULL` is set to False. Skipping %i empty / NULL values." % len(data[data['value'].isna()]))
-            data = data[data['value'].notna()]
+    # Not in the classification attributes, they are looked up in the end
+    other_columns = [c for c in data.columns if c not in class_names['name'].values]
+    data[other_columns] = data[other_columns].replace([np.nan], [None])
+    # Values are numbers already, see file_io.TABLE_SCHEMA
+    data['comment'] = data['comment'].replace(['na', 'nan'], [None, None])
     # Get column names and order right
     more_sql_columns = ['value', 'unit_nominator', 'unit_denominator', 'stats_array_1', 'stats_array_2',
                         'stats_array_3', 'stats_array_4', 'comment']
-    data = data[['dataset_id'] + class_names['name'].to_list() + more_sql_columns]
+    data = data[['dataset_id'] + class_names['name'].to_list() + more_sql_columns].copy()
     sql_columns = ['dataset_id'] + [a.replace('_', '') for a in class_names.index] + more_sql_columns
-    # look up values in classification_items
-    dbio.bulk_sql_insert('data', sql_columns, data.values.tolist())
+    resolved = {'sql_columns': sql_columns,
+                'data': data}
+    if lookup:
+        resolved = lookup_aspects(file_meta, aspect_table, file_data, resolved)
+    return resolved
+
+
+@profiling.stage('upload_data_table')
+def upload_data_table(file, file_meta, aspect_table, file_data, crash=True, chunk_size=10000, bulk_load=False,
+                      path=None):
+    """
+    Uploads the actual data from the Excel template file (sheet Data) into the database.
+    Dataset entry must already be present in dataset table, use validate.check_datasets_entry to ensure that.
+    Main table data must not contain any values for this dataset id (unique for dataset name and version).
+    The upload is committed in chunks. If it is interrupted, running it again resumes after the last committed chunk.
+    :param file: Name of the file to read. String.
+    :param crash: Will stop if an error occurs
+    :param chunk_size: Number of rows per chunk, see `checkpoint.upload_checkpointed()`
+    :param bulk_load: Insert in a bulk load session, see `checkpoint.upload_checkpointed()`
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return:
+    """
+    # Validation may have run against a local snapshot. Make sure it wasn't outdated.
+    snapshot.assert_fresh()
+    dataset_name = get_dataset_name_ver(file_meta)[0]
+    dataset_id = get_dataset_id(file_meta)
+    # Check that no data are present already in the data table, unless an earlier upload was interrupted
+    if dataset_has_data(dataset_id) and not checkpoint.has_checkpoints(dataset_id):
+         raise AssertionError("The database already contains values for dataset_id '%s' in the 'data' table. This upload is cancelled to avoid conflicts." % dataset_id)
+    identical = find_identical_datasets(file, file_meta, aspect_table, file_data, dataset_id, path)
+    if identical['identical']:
+        raise AssertionError("The data of '%s' are identical to the data of dataset_id %s. This upload is cancelled."
+                             % (dataset_name, identical['identical']))
+    resolved = lookup_aspects(file_meta, aspect_table, file_data, identical['resolved'])
+    checkpoint.upload_checkpointed(dataset_id, resolved['sql_columns'], resolved['data'], chunk_size=chunk_size,
+                                   bulk_load=bulk_load)
+    checkpoint.verify_upload(dataset_id, resolved['sql_columns'], resolved['data'])
+    catalog.record(dataset_id, catalog.compute(resolved['sql_columns'], resolved['data']))
+    fingerprint.record(dataset_id, identical['fingerprint'], len(resolved['data'].index))
+    # The upload is complete, there is nothing left to resume
+    checkpoint.clear_checkpoints(dataset_id)
     print("Wrote data for '%s', dataset_id: %s" % (dataset_name, dataset_id))
 
+
+@profiling.stage('dry_run_checks')
+def dry_run_checks(file, file_meta, aspect_table, file_data, path=None):
+    """
+    Runs the checks of the upload routine for a candidate file without writing anything to the database. Together with
+    `snapshot.activate()` this works without a database connection.
+
+    :param file: Name of the file. Only needed for TABLE type files.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return: List of problems found. Empty if the file is ready for upload.
+    """
+    # The file's own problems first, a broken file is rejected before any database lookups
+    if file_meta['data_type'] == 'TABLE':
+        try:
+            data = assemble_table(file, file_meta, file_data, path)
+        except (AssertionError, AttributeError, ValueError) as e:
+            return [str(e)]
+    problems = []
+    class_names = get_class_names(file_meta, aspect_table)
+    if not all(check_classification_definition(class_names, crash=False, warn=False, exclude_custom=True)):
+        problems.append("Not all classifications found in classification_definitions")
+    # The custom classifications of a dataset in the catalog exist already, e.g. when it is replaced or resumed
+    in_catalog = get_dataset_name_ver(file_meta) in \
+        dbio.get_sql_table_as_df('datasets')[['dataset_name', 'dataset_version']].values.tolist()
+    if not in_catalog and any(check_classification_definition(class_names, crash=False, warn=False,
+                                                              custom_only=True)):
+        problems.append("Custom classification already exists in classification_definitions")
+    if not all(check_classification_items(class_names, file_meta, file_data, crash=False, warn=False,
+                                          exclude_custom=True)):
+        problems.append("Not all classification_ids or attributes found in classification_items")
+    try:
+        if file_meta['data_type'] == 'LIST':
+            get_unit_list(file_data)
+            parse_stats_array_list(file_data['stats_array string'])
+        elif file_meta['data_type'] == 'TABLE':
+            get_unit_table(file_meta, data)
+            parse_stats_array_table(file_meta, data)
+    except (AssertionError, AttributeError, ValueError) as e:
+        problems.append(str(e))
+    dataset_info = file_meta['dataset_info']
+    if dataset_info.loc['submitting_user'].values[0] not in dbio.get_sql_table_as_df('users')['name'].values:
+        print("INFO: User '%s' will be added to db table users" % dataset_info.loc['submitting_user'].values[0])
+    if dataset_info.loc['project_license'].values[0] not in dbio.get_sql_table_as_df('licences')['name'].values:
+        print("INFO: Licence '%s' will be added to db table licences" % dataset_info.loc['project_license'].values[0])
+    return problems
+
+
+def check_candidates(path=None, snapshot_path=None):
+    """
+    Runs `dry_run_checks()` for all candidate files in a directory.
+
+    :param path: Directory of the candidate files. Default: IEDC_paths.candidates
+    :param snapshot_path: If given, validate against this local snapshot of the reference tables instead of the
+        database, see `snapshot.export_snapshot()`.
+    :return: Dictionary of filename: list of problems
+    """
+    if path is None:
+        path = IEDC_paths.candidates
+    if snapshot_path is not None:
+        snapshot.activate(snapshot_path)
+    classifications.clear()
+    res = {}
+    for file in file_io.get_candidate_filenames(path, verbose=1):
+        try:
+            file_meta = file_io.read_candidate_meta(file, path=path)
+            aspect_table = create_aspects_table(file_meta)
+            if file_meta['data_type'] == 'LIST':
+                file_data = file_io.read_candidate_data_list(file, path)
+            else:
+                file_data = file_io.read_candidate_data_table(file, aspect_table, path)
+            res[file] = dry_run_checks(file, file_meta, aspect_table, file_data, path)
+        except Exception as e:
+            res[file] = ["%s: %s" % (type(e).__name__, e)]
+        print("%s: %s" % (file, 'OK' if not res[file] else '; '.join(res[file])))
+    return res
+
+
+@profiling.stage('update_data')
+def update_data(file, file_meta, aspect_table, file_data, batch_size=10000, path=None):
+    """
+    Brings the values of an existing dataset in the `data` table up to date with a (corrected) data file. Only the
+    rows that differ are written: file rows are matched with the database rows by their aspects, then new rows are
+    inserted, changed rows updated, and rows that are not in the file anymore deleted.
+    :param file: Name of the file to read. String. Only needed for TABLE type files.
+    :param file_meta: data file metadata
+    :param aspect_table: Aspects table, see create_aspects_table()
+    :param file_data: Dataframe of Excel file, sheet `Data`
+    :param batch_size: Number of rows per insert / update / delete statement
+    :param path: Directory of the file. Default: IEDC_paths.candidates
+    :return: Dictionary with the number of rows inserted, updated, deleted
+    """
+    snapshot.assert_fresh()
+    dataset_id = get_dataset_id(file_meta)
+    if file_meta['data_type'] == 'LIST':
+        resolved = resolve_data_list(file_meta, aspect_table, file_data, dataset_id, lookup=False)
+    else:
+        resolved = resolve_data_table(file, file_meta, aspect_table, file_data, dataset_id, lookup=False, path=path)
+    fp = fingerprint.compute(get_class_names(file_meta, aspect_table), resolved)
+    # The corrected file may use attributes that its custom classifications don't have yet
+    register_custom_classifications([get_new_custom_classifications(file_meta, aspect_table, file_data)])
+    add_custom_class_items(file_meta, aspect_table, file_data)
+    resolved = lookup_aspects(file_meta, aspect_table, file_data, resolved)
+    sql_columns = resolved['sql_columns']
+    keys = [c for c in sql_columns if c.startswith('aspect')]
+    fields = [c for c in sql_columns if c != 'dataset_id' and c not in keys]
+    new = resolved['data'].copy()
+    new.columns = sql_columns
+    new[keys] = new[keys].astype('int64')
+    assert not new.duplicated(keys).any(), "The file contains duplicate rows for the same aspects: %s" % \
+        new[new.duplicated(keys, keep=False)][keys].values.tolist()
+    old = dbio.get_sql_table_as_df('data', ['id'] + keys + fields, index=None,
+                                   addSQL="WHERE dataset_id = %s" % dataset_id)
+    old[keys] = old[keys].astype('int64')
+    diff = old.merge(new, on=keys, how='outer', suffixes=('_db', ''), indicator=True)
+    changed = pd.Series(False, index=diff.index)
+    for field in fields:
+        changed |= ~_same_values(diff[field + '_db'], diff[field])
+    inserts = diff.loc[diff['_merge'] == 'right_only', sql_columns]
+    updates = diff.loc[(diff['_merge'] == 'both') & changed, fields + ['id']]
+    deletes = diff.loc[diff['_merge'] == 'left_only', 'id']
+    # The dataset doesn't match its fingerprint while it is changed. Without one, it is not taken for complete, e.g.
+    # by find_identical_datasets() or a work queue, should the update fail.
+    fingerprint.clear(dataset_id)
+    _write_data_delta(sql_columns, fields, inserts, updates, deletes, batch_size)
+    # The dataset is complete now, an interrupted upload doesn't need to be resumed anymore
+    checkpoint.clear_checkpoints(dataset_id)
+    catalog.record(dataset_id, catalog.compute(sql_columns, new))
+    fingerprint.record(dataset_id, fp, len(new.index))
+    res = {'inserted': len(inserts.index), 'updated': len(updates.index), 'deleted': len(deletes.index)}
+    print("Updated data for dataset_id %s: %s inserted, %s updated, %s deleted, %s unchanged" %
+          (dataset_id, res['inserted'], res['updated'], res['deleted'],
+           len(new.index) - res['inserted'] - res['updated']))
+    return res
+
+
+@dbio.db_cursor_write
+def _write_data_delta(curs, sql_columns, fields, inserts, updates, deletes, batch_size):
+    """
+    Deletes, updates, and inserts the rows of update_data() in one transaction, so a failure leaves the dataset as it
+    was.
+    """
+    dbio.table_changed('data')
+    for start in range(0, len(deletes.index), batch_size):
+        ids = deletes.iloc[start:start + batch_size].astype(int).tolist()
+        curs.execute("DELETE FROM data WHERE id IN (%s);" % ', '.join(['%s'] * len(ids)), ids)
+    sql = "UPDATE data SET %s WHERE id = %%s;" % ', '.join(["%s = %%s" % c for c in fields])
+    for start in range(0, len(updates.index), batch_size):
+        batch = updates.iloc[start:start + batch_size].astype(object).replace([np.nan], [None])
+        batch['id'] = batch['id'].astype(int)
+        curs.executemany(sql, batch.values.tolist())
+    sql = "INSERT INTO data (%s) VALUES (%s);" % (', '.join(sql_columns), ', '.join(['%s'] * len(sql_columns)))
+    for start in range(0, len(inserts.index), batch_size):
+        batch = inserts.iloc[start:start + batch_size].astype(object).replace([np.nan], [None])
+        curs.executemany(sql, batch.values.tolist())
+
+
+def _same_values(a, b):
+    """
+    Element-wise comparison of a database and a file column, where NULL equals NULL and '3' equals 3.0.
+    """
+    a_num, b_num = pd.to_numeric(a, errors='coerce'), pd.to_numeric(b, errors='coerce')
+    numeric = (a_num.notna() | a.isna()) & (b_num.notna() | b.isna())
+    same_num = (a_num == b_num) | (a_num.isna() & b_num.isna())
+    same_str = (a.astype(str) == b.astype(str)) | (a.isna() & b.isna())
+    return same_num.where(numeric, same_str)
@@ -0,0 +1,401 @@
+"""
+Work queue for ingesting candidate files with several workers, in several processes or on several machines, see
+`IEDC_workqueue.py`.
+
+A worker claims one file at a time with a lease: for `lease` seconds, no other worker gets the file. The worker renews
+the lease while it parses, validates and uploads the file, and records the outcome at the end. If a worker crashes, its
+lease expires and another worker retries the file, up to `max_attempts` times in total.
+
+A retry must not upload the dataset a second time. Before anything is written, the first attempt records the dataset_id
+the file's dataset had, if any. A later attempt that finds a different dataset_id knows that an earlier attempt created
+the catalog entry: if the dataset's fingerprint was recorded, the upload finished and nothing is written, otherwise the
+partial upload is resumed, see `process_item()` and `validate.upload_incomplete()`.
+
+`WorkQueue` is the interface, `SQLiteQueue` implements it with an SQLite file. All workers need to reach this file,
+e.g. on a shared drive, and the candidate files under the same path. SQLite relies on the file locks of the file
+system, which some network file systems don't implement properly.
+"""
+import abc
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from IEDC_tools import batch, dbio, file_io, fingerprint, integrity, lazy, validate
+
+pd = lazy.lazy_import('pandas')
+IEDC_paths = lazy.lazy_import('IEDC_paths')
+
+STATES = ('pending', 'leased', 'done', 'failed')
+UPLOAD_OPTIONS = {'replace': False, 'update': False, 'skip_identical': True, 'bulk_load': False}
+
+
+class WorkQueue(abc.ABC):
+    """
+    Candidate files to be ingested, each in one of the STATES:
+     - pending: waiting for a worker, maybe after a failed attempt
+     - leased: claimed by a worker until its lease expires
+     - done: processed, see the 'status' of the item, e.g. 'uploaded', 'skipped', or 'invalid'
+     - failed: every attempt failed with an error or an expired lease
+
+    Items are dictionaries with the 'id', 'file', 'path', upload 'options', 'attempts', and while leased the 'worker',
+    its 'lease' token, and the lease duration 'lease_s'.
+    """
+
+    @abc.abstractmethod
+    def add(self, files, path=None, **options):
+        """
+        Adds files to the queue. Files that are in the queue already are left as they are.
+
+        :param files: List of filenames
+        :param path: Directory of the files. None: each worker's IEDC_paths.candidates
+        :param options: Upload options, see UPLOAD_OPTIONS
+        :return: Number of files added
+        """
+
+    @abc.abstractmethod
+    def claim(self, worker, lease=300.):
+        """
+        Claims the next pending file. Expired leases are released first, see release_expired().
+
+        :param worker: Name of the worker
+        :param lease: Seconds the file is reserved for the worker
+        :return: Item, or None if no file is pending
+        """
+
+    @abc.abstractmethod
+    def renew(self, item):
+        """
+        Extends the lease of an item by its lease duration.
+
+        :return: False if the lease was lost, e.g. because it expired and the file went to another worker
+        """
+
+    @abc.abstractmethod
+    def record_dataset(self, item, dataset_id):
+        """
+        Records the dataset_id of the item's dataset before anything is written. Only the first call for an item
+        counts, later attempts get the recorded value back.
+
+        :param dataset_id: dataset_id of the dataset in the catalog, or None if it isn't in the catalog
+        :return: The dataset_id recorded by the first attempt
+        """
+
+    @abc.abstractmethod
+    def complete(self, item, result):
+        """
+        Records the outcome of a processed file.
+
+        :param result: Dictionary with the 'status', 'dataset_id', 'rows', and 'error', see process_item()
+        :return: False if the lease was lost, so the outcome was not recorded
+        """
+
+    @abc.abstractmethod
+    def fail(self, item, error):
+        """
+        Records a failed attempt. The file is retried unless it reached max_attempts.
+
+        :return: False if the lease was lost, so the failure was not recorded
+        """
+
+    @abc.abstractmethod
+    def release(self, item):
+        """
+        Gives a claimed file back without counting the attempt, e.g. when a worker is stopped.
+        """
+
+    @abc.abstractmethod
+    def release_expired(self):
+        """
+        Makes the files whose lease expired pending again, or failed if they reached max_attempts.
+
+        :return: Number of files whose lease expired
+        """
+
+    @abc.abstractmethod
+    def counts(self):
+        """
+        :return: Dictionary of state: number of files
+        """
+
+    @abc.abstractmethod
+    def status(self):
+        """
+        :return: Dataframe with one row per file
+        """
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    Work queue in an SQLite file. Every call opens its own connection, so an instance can be shared by threads.
+    """
+
+    def __init__(self, db, max_attempts=3):
+        """
+        :param db: Filename of the SQLite file. Created if it doesn't exist.
+        :param max_attempts: Number of attempts per file before it is marked failed
+        """
+        self.db = db
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS work_items (
+                  id INTEGER PRIMARY KEY,
+                  file TEXT NOT NULL,
+                  path TEXT NOT NULL,
+                  options TEXT NOT NULL,
+                  state TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  worker TEXT,
+                  lease TEXT,
+                  lease_s REAL,
+                  lease_until REAL,
+                  dataset_checked INTEGER NOT NULL DEFAULT 0,
+                  dataset_before INTEGER,
+                  status TEXT,
+                  dataset_id INTEGER,
+                  rows INTEGER,
+                  error TEXT,
+                  added REAL NOT NULL,
+                  updated REAL,
+                  UNIQUE (file, path));""")
+
+    @contextlib.contextmanager
+    def _connect(self, exclusive=False):
+        """
+        Connection in a transaction that is committed on success. `exclusive` takes the write lock right away, so
+        reading and updating an item can't interleave with another worker.
+        """
+        conn = sqlite3.connect(self.db, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE;" if exclusive else "BEGIN;")
+            yield conn
+            conn.execute("COMMIT;")
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        finally:
+            conn.close()
+
+    def add(self, files, path=None, **options):
+        unknown = set(options) - set(UPLOAD_OPTIONS)
+        assert not unknown, "Unknown options %s. Must be in %s" % (sorted(unknown), list(UPLOAD_OPTIONS))
+        now = time.time()
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO work_items (file, path, options, added) VALUES (?, ?, ?, ?);",
+                             [(f, path or '', json.dumps(options), now) for f in files])
+            return conn.total_changes - before
+
+    def claim(self, worker, lease=300.):
+        with self._connect(exclusive=True) as conn:
+            now = time.time()
+            self._release_expired(conn, now)
+            row = conn.execute("SELECT id FROM work_items WHERE state = 'pending' ORDER BY attempts, id LIMIT 1;") \
+                .fetchone()
+            if row is None:
+                return None
+            conn.execute("""UPDATE work_items SET state = 'leased', attempts = attempts + 1, worker = ?, lease = ?,
+                            lease_s = ?, lease_until = ?, updated = ? WHERE id = ?;""",
+                         (worker, uuid.uuid4().hex, lease, now + lease, now, row['id']))
+            return self._item(conn.execute("SELECT * FROM work_items WHERE id = ?;", (row['id'],)).fetchone())
+
+    def renew(self, item):
+        return self._update_leased(item, "lease_until = ?", (time.time() + item['lease_s'],))
+
+    def record_dataset(self, item, dataset_id):
+        with self._connect(exclusive=True) as conn:
+            row = conn.execute("SELECT lease, dataset_checked, dataset_before FROM work_items WHERE id = ?;",
+                               (item['id'],)).fetchone()
+            assert row['lease'] == item['lease'], "Lost the lease on '%s'" % item['file']
+            if row['dataset_checked']:
+                return row['dataset_before']
+            conn.execute("UPDATE work_items SET dataset_checked = 1, dataset_before = ? WHERE id = ?;",
+                         (dataset_id, item['id']))
+            return dataset_id
+
+    def complete(self, item, result):
+        return self._update_leased(item, "state = 'done', status = ?, dataset_id = ?, rows = ?, error = ?",
+                                   (result['status'], result['dataset_id'], result['rows'], result['error']))
+
+    def fail(self, item, error):
+        state = 'failed' if item['attempts'] >= self.max_attempts else 'pending'
+        return self._update_leased(item, "state = ?, status = 'failed', error = ?", (state, str(error)))
+
+    def release(self, item):
+        return self._update_leased(item, "state = 'pending', attempts = attempts - 1", ())
+
+    def release_expired(self):
+        with self._connect(exclusive=True) as conn:
+            return self._release_expired(conn, time.time())
+
+    def counts(self):
+        with self._connect() as conn:
+            found = dict(conn.execute("SELECT state, COUNT(*) FROM work_items GROUP BY state;").fetchall())
+        return {s: found.get(s, 0) for s in STATES}
+
+    def status(self):
+        conn = sqlite3.connect(self.db, timeout=60)
+        try:
+            return pd.read_sql_query("SELECT id, file, path, state, status, attempts, worker, dataset_id, rows, error, "
+                                     "added, updated FROM work_items ORDER BY id;", conn, index_col='id')
+        finally:
+            conn.close()
+
+    def _release_expired(self, conn, now):
+        expired = "state = 'leased' AND lease_until < ?"
+        conn.execute("""UPDATE work_items SET state = 'failed', status = 'failed', error = 'Lease expired',
+                        lease = NULL, updated = ? WHERE %s AND attempts >= ?;""" % expired,
+                     (now, now, self.max_attempts))
+        n_failed = conn.execute("SELECT changes();").fetchone()[0]
+        conn.execute("UPDATE work_items SET state = 'pending', lease = NULL, updated = ? WHERE %s;" % expired,
+                     (now, now))
+        return n_failed + conn.execute("SELECT changes();").fetchone()[0]
+
+    def _update_leased(self, item, assignments, values):
+        """
+        Updates an item if the worker still holds its lease. Every update but a renewal ends the lease.
+        """
+        if not assignments.startswith('lease_until'):
+            assignments += ", lease = NULL"
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE work_items SET %s, updated = ? WHERE id = ? AND lease = ? "
+                                  "AND state = 'leased';" % assignments,
+                                  tuple(values) + (time.time(), item['id'], item['lease']))
+            return cursor.rowcount == 1
+
+    @staticmethod
+    def _item(row):
+        item = dict(row)
+        item['options'] = json.loads(item['options'])
+        return item
+
+
+def add_directory(queue, path=None, files=None, **options):
+    """
+    Adds the candidate files of a directory to a queue.
+
+    :param queue: WorkQueue, or the filename of an SQLite queue
+    :param path: Directory of the files. None: IEDC_paths.candidates, looked up by each worker
+    :param files: List of filenames. Default: all candidate files in the directory
+    :param options: Upload options, see UPLOAD_OPTIONS
+    :return: Number of files added
+    """
+    queue = _queue(queue)
+    if files is None:
+        files = file_io.get_candidate_filenames(path or IEDC_paths.candidates, verbose=1)
+    added = queue.add(files, path, **options)
+    print("Added %s of %s files to the queue" % (added, len(files)))
+    return added
+
+
+def process_item(queue, item):
+    """
+    Parses, validates and uploads the file of a claimed item with `batch.run()` and records the outcome in the queue.
+    The lease is renewed in the background meanwhile.
+
+    :return: Dictionary with the 'status' (see `batch.run()`), 'dataset_id', 'rows', and 'error'
+    """
+    result = {'status': 'failed', 'dataset_id': None, 'rows': None, 'error': None}
+    stop = _keep_lease(queue, item)
+    try:
+        file, path = item['file'], item['path'] or IEDC_paths.candidates
+        options = {o: item['options'].get(o, default) for o, default in UPLOAD_OPTIONS.items()}
+        parsed = batch.parse_file(file, path)
+        file_meta = parsed['file_meta']
+        dataset_id = validate.get_dataset_id(file_meta) if file_io.ds_in_db(file_meta, crash=False) else None
+        before = queue.record_dataset(item, dataset_id)
+        if dataset_id is not None and dataset_id != before and fingerprint.get(dataset_id) is not None:
+            # An earlier attempt finished the upload but not the queue entry
+            result.update(status='uploaded', dataset_id=dataset_id)
+        else:
+            if dataset_id is not None and dataset_id != before:
+                # An earlier attempt created the catalog entry and stopped during the upload. batch.run() resumes it.
+                print("Resuming the partial upload of '%s', dataset_id: %s" % (file, dataset_id))
+                options.update(update=False)
+            # Nothing was written to the database so far. If the lease went to another worker meanwhile, e.g. while
+            # the file was parsed, that worker uploads the file.
+            assert queue.renew(item), "Lost the lease on '%s' before the upload" % file
+            summary = batch.run(path, files=[file], workers=0, parsed={file: parsed}, **options)
+            row = summary.astype(object).where(summary.notnull(), None).iloc[0]
+            result.update({c: row[c] for c in ('status', 'dataset_id', 'rows', 'error')})
+    except integrity.IntegrityError as e:
+        # Retrying won't help
+        result.update(status='invalid', error=str(e))
+    except Exception as e:
+        print(traceback.format_exc())
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        stop.set()
+    if result['status'] == 'failed':
+        recorded = queue.fail(item, result['error'])
+    else:
+        recorded = queue.complete(item, result)
+    if not recorded:
+        print("WARNING: Lost the lease on '%s', its outcome '%s' was not recorded" % (item['file'], result['status']))
+    return result
+
+
+def work(queue, worker=None, lease=300., poll=5., max_items=None, wait=False):
+    """
+    Runs a worker: processes one file of the queue after the other until no file is left. The database connection is
+    kept open in between, see `dbio.keep_connections()`. The reference tables are always read from the database, as
+    other workers may add custom classifications at any time, which would make a snapshot out of date.
+
+    :param queue: WorkQueue, or the filename of an SQLite queue
+    :param worker: Name of the worker. Default: host name and process id
+    :param lease: Seconds a claimed file is reserved for the worker. The lease is renewed every `lease` / 3 seconds.
+    :param poll: Seconds between looks into the queue while the remaining files are leased by other workers
+    :param max_items: Stop after this many files. None: until the queue is empty
+    :param wait: Don't stop when the queue is empty, wait for new files instead
+    :return: Dataframe with one row per processed file
+    """
+    queue = _queue(queue)
+    if worker is None:
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    dbio.keep_connections()
+    results = []
+    while max_items is None or len(results) < max_items:
+        item = queue.claim(worker, lease)
+        if item is None:
+            counts = queue.counts()
+            if not wait and not counts['pending'] and not counts['leased']:
+                break
+            time.sleep(poll)
+            continue
+        print("%s: '%s', attempt %s" % (worker, item['file'], item['attempts']))
+        try:
+            result = process_item(queue, item)
+        except KeyboardInterrupt:
+            queue.release(item)
+            raise
+        results.append(dict(result, id=item['id'], file=item['file'], attempt=item['attempts']))
+    results = pd.DataFrame(results, columns=['id', 'file', 'attempt', 'status', 'dataset_id', 'rows', 'error'])
+    print("%s done: %s" % (worker, ', '.join('%s %s' % (n, s) for s, n in results['status'].value_counts().items())))
+    return results
+
+
+def _queue(queue):
+    return SQLiteQueue(queue) if isinstance(queue, str) else queue
+
+
+def _keep_lease(queue, item):
+    """
+    Renews the lease of an item in a background thread until the returned event is set.
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(item['lease_s'] / 3.):
+            if not queue.renew(item):
+                print("WARNING: Lost the lease on '%s'" % item['file'])
+                return
+
+    threading.Thread(target=renew, daemon=True).start()
+    return stop
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Parses, validates, and uploads all candidate files (LIST and TABLE) in a directory. Replaces the loops in
+`debug_list.py` and `debug_table.py`. A file that fails does not stop the others, see the summary report at the end.
+
+Usage example:
+    python IEDC_upload_batch.py --workers 4 --threads 4 --report batch_report.csv
+    python IEDC_upload_batch.py --dry-run --snapshot ./snapshot
+    python IEDC_upload_batch.py --profile ./profiles --tracemalloc --cprofile resolve_data_table
+"""
+import argparse
+
+from IEDC_tools import batch, profiling
+
+
+# The guard is required for the process pool on Windows
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=None,
+                        help="Directory of the candidate files. Default: IEDC_paths.candidates")
+    parser.add_argument('--files', nargs='*', help="Only process these files")
+    parser.add_argument('--exclude', nargs='*', default=[], help="Skip these files")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of parser processes. Default: number of CPUs. 0: no process pool")
+    parser.add_argument('--dry-run', action='store_true', help="Only parse and validate, don't write to the database")
+    parser.add_argument('--replace', action='store_true', help="Replace datasets that are already in the database")
+    parser.add_argument('--update', action='store_true',
+                        help="Update datasets that are already in the database with the rows that changed")
+    parser.add_argument('--snapshot', default=None,
+                        help="Validate against this local snapshot of the reference tables")
+    parser.add_argument('--group-rows', type=int, default=50000,
+                        help="Insert small datasets together up to this many rows")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of datasets inserted concurrently, each over its own database connection")
+    parser.add_argument('--allow-identical', action='store_true',
+                        help="Upload files even if the same data are in the database already")
+    parser.add_argument('--bulk-load', action='store_true',
+                        help="Upload large datasets without the database's unique and foreign key checks, then verify")
+    parser.add_argument('--spill-dir', default=None,
+                        help="Insert large datasets chunk by chunk from a memory-mapped file in this directory")
+    parser.add_argument('--report', default=None, help="Write the summary report to this CSV file")
+    parser.add_argument('--profile', default=None, help="Write a profiling report per file to this directory")
+    parser.add_argument('--tracemalloc', action='store_true', help="Profiling: also record Python memory peaks")
+    parser.add_argument('--cprofile', nargs='*', default=[], help="Profiling: run these stages under cProfile")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profiling.enable(tracemalloc=args.tracemalloc, cprofile=args.cprofile, outdir=args.profile)
+
+    summary = batch.run(path=args.path, files=args.files, exclude=args.exclude, workers=args.workers,
+                        upload=not args.dry_run, replace=args.replace,
+                        update=args.update, snapshot_path=args.snapshot,
+                        group_rows=args.group_rows, report=args.report, profile_dir=args.profile,
+                        threads=args.threads, skip_identical=not args.allow_identical,
+                        bulk_load=args.bulk_load, spill_dir=args.spill_dir)
+    print(summary[['data_type', 'status', 'stage', 'rows', 'rows_per_s', 'error']].to_string())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Ingests a directory of candidate files with several workers, in several processes or on several machines that share a
+queue file. Workers claim one file at a time with a lease. Files of workers that crash are retried by the others once
+the lease expires, without uploading a dataset twice, see `IEDC_tools.workqueue`.
+
+Usage example:
+    python IEDC_workqueue.py --queue /shared/ingest.sqlite --add /shared/candidates
+    python IEDC_workqueue.py --queue /shared/ingest.sqlite --work
+    python IEDC_workqueue.py --queue /shared/ingest.sqlite --status
+"""
+import argparse
+
+from IEDC_tools import workqueue
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queue', required=True, help="SQLite file of the queue. Created if it doesn't exist.")
+    parser.add_argument('--add', nargs='?', const='', default=None, metavar='DIR',
+                        help="Add the candidate files of a directory to the queue. Default: IEDC_paths.candidates of "
+                             "each worker")
+    parser.add_argument('--files', nargs='+', default=None, help="Add only these files of the directory")
+    parser.add_argument('--replace', action='store_true', help="Added files: replace datasets that exist")
+    parser.add_argument('--update', action='store_true', help="Added files: update datasets that exist")
+    parser.add_argument('--work', action='store_true', help="Run a worker until the queue is empty")
+    parser.add_argument('--worker', default=None, help="Name of the worker. Default: host name and process id")
+    parser.add_argument('--lease', type=float, default=300., help="Seconds a claimed file is reserved for the worker")
+    parser.add_argument('--wait', action='store_true', help="Worker: wait for new files when the queue is empty")
+    parser.add_argument('--max-attempts', type=int, default=3, help="Attempts per file before it is marked failed")
+    parser.add_argument('--status', action='store_true', help="Print the state of every file in the queue")
+    args = parser.parse_args()
+
+    queue = workqueue.SQLiteQueue(args.queue, max_attempts=args.max_attempts)
+    if args.add is not None:
+        workqueue.add_directory(queue, args.add or None, files=args.files, replace=args.replace, update=args.update)
+    if args.work:
+        workqueue.work(queue, worker=args.worker, lease=args.lease, wait=args.wait)
+    if args.status:
+        print(queue.status().to_string())
+        print(queue.counts())
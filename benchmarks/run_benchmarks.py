@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks of the upload pipeline against a local stand-in database (see `IEDC_tools.standin`).
+
+Writes synthetic LIST and TABLE templates (see `IEDC_tools.synthetic`) and times every stage of the pipeline: reading
+the metadata, reading the data, validation, creating the catalog entries, resolution of names to ids, and the insert.
+The insert is timed a second time in a bulk load session (see `IEDC_tools.checkpoint`), and the throughput of both is
+reported.
+Results are appended to a JSON file and compared with the previous run of the same configuration. A stage that got
+slower by more than the threshold is flagged as a regression, and the script exits with status 1.
+
+The startup cost is checked as well: importing the package in a fresh interpreter must stay within a time budget and
+must not load pandas, numpy, openpyxl, pymysql, pyarrow, or the configuration modules, see `IEDC_tools.lazy`.
+
+Usage example:
+    python benchmarks/run_benchmarks.py --rows 20000 --repeat 3
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Allow running the script from anywhere in the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from IEDC_tools import checkpoint, delete, file_io, standin, synthetic, validate, __version__
+
+# name: arguments for synthetic.write_template(). Number of rows is set on the command line.
+SCENARIOS = {
+    'list': dict(data_type='LIST', n_aspects=3, custom_aspects=1, stats='TABLE', comments='TABLE'),
+    'table_global': dict(data_type='TABLE', n_aspects=3, col_levels=1, n_cols=20),
+    'table_sheets': dict(data_type='TABLE', n_aspects=4, col_levels=2, n_cols=20, units='TABLE', stats='TABLE',
+                         comments='TABLE', custom_aspects=1),
+}
+STAGES = ['meta', 'data', 'validation', 'catalog', 'resolution', 'insert']
+# Timed as well, but not part of the total: the same insert again, in a bulk load session
+EXTRA_STAGES = ['bulk_insert']
+# Modules that must not be loaded by merely importing IEDC_tools
+DEFERRED_MODULES = ['pandas', 'numpy', 'openpyxl', 'pymysql', 'pyarrow', 'IEDC_pass', 'IEDC_paths']
+IMPORT_SCRIPT = """
+import importlib, json, os, pkgutil, sys, time
+start = time.perf_counter()
+import IEDC_tools
+for module in pkgutil.iter_modules([os.path.dirname(IEDC_tools.__file__)]):
+    importlib.import_module('IEDC_tools.' + module.name)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % DEFERRED_MODULES
+
+
+def run_scenario(name, kwargs, rows, empty_share, workdir):
+    """
+    Runs the pipeline once for a freshly written template and returns the seconds per stage.
+    """
+    kwargs = dict(kwargs)
+    if kwargs['data_type'] == 'TABLE':
+        kwargs['rows'] = max(rows // kwargs['n_cols'], 1)
+    else:
+        kwargs['rows'] = rows
+    file = name + '.xlsx'
+    synthetic.write_template(os.path.join(workdir, file), empty_share=empty_share, **kwargs)
+    timings = {}
+
+    def timed(stage, fn, *args, **kw):
+        start = time.perf_counter()
+        res = fn(*args, **kw)
+        timings[stage] = time.perf_counter() - start
+        return res
+
+    file_meta = timed('meta', file_io.read_candidate_meta, file, path=workdir)
+    aspect_table = validate.create_aspects_table(file_meta)
+    if file_meta['data_type'] == 'LIST':
+        file_data = timed('data', file_io.read_candidate_data_list, file, workdir)
+    else:
+        file_data = timed('data', file_io.read_candidate_data_table, file, aspect_table, workdir)
+    problems = timed('validation', validate.dry_run_checks, file, file_meta, aspect_table, file_data, workdir)
+    assert not problems, problems
+
+    def catalog():
+        validate.create_db_class_defs(file_meta, aspect_table)
+        validate.create_db_class_items(file_meta, aspect_table, file_data)
+        validate.check_datasets_entry(file_meta)
+        return validate.get_dataset_id(file_meta)
+    dataset_id = timed('catalog', catalog)
+    if file_meta['data_type'] == 'LIST':
+        resolved = timed('resolution', validate.resolve_data_list, file_meta, aspect_table, file_data, dataset_id)
+    else:
+        resolved = timed('resolution', validate.resolve_data_table, file, file_meta, aspect_table, file_data,
+                         dataset_id, path=workdir)
+    timed('insert', checkpoint.upload_checkpointed, dataset_id, resolved['sql_columns'], resolved['data'])
+    delete.delete_in_batches('data', 'dataset_id', dataset_id, verbose=False)
+    checkpoint.clear_checkpoints(dataset_id)
+    timed('bulk_insert', checkpoint.upload_checkpointed, dataset_id, resolved['sql_columns'], resolved['data'],
+          bulk_load=True)
+    timings['rows'] = len(resolved['data'].index)
+    delete.delete_dataset(dataset_id, verbose=False)
+    return timings
+
+
+def import_time(repeat=3):
+    """
+    Seconds it takes to import the package in a fresh interpreter (fastest of `repeat` runs), and the deferred modules
+    that got loaded anyway. Runs without the configuration modules on the path, like on a machine without credentials.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=env,
+                                               cwd=tempfile.gettempdir())) for _ in range(repeat)]
+    return min(r['seconds'] for r in runs), sorted(set(m for r in runs for m in r['loaded']))
+
+
+def compare(results, previous, threshold, noise=0.01):
+    """
+    Flags stages that got slower than in the previous run by more than `threshold` (relative) and `noise` seconds.
+    """
+    regressions = []
+    for scenario, stages in results.items():
+        for stage in STAGES + EXTRA_STAGES:
+            if scenario not in previous or stage not in previous[scenario]:
+                continue
+            old, new = previous[scenario][stage], stages[stage]
+            if new > old * (1 + threshold) and new - old > noise:
+                regressions.append((scenario, stage, old, new))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help="Number of values per dataset")
+    parser.add_argument('--empty-share', type=float, default=0.2, help="Share of empty cells")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario, the fastest one counts")
+    parser.add_argument('--scenarios', nargs='*', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--threshold', type=float, default=0.25, help="Relative slow-down flagged as regression")
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                                          'results.json'),
+                        help="JSON file the results are appended to")
+    parser.add_argument('--import-budget', type=float, default=0.5, help="Maximum seconds to import the package")
+    args = parser.parse_args()
+
+    import_s, loaded = import_time()
+    print("Import time: %.3f s (budget %.3f s)" % (import_s, args.import_budget))
+    startup_failed = False
+    if import_s > args.import_budget:
+        print("REGRESSION: importing IEDC_tools took %.3f s, budget is %.3f s" % (import_s, args.import_budget))
+        startup_failed = True
+    if loaded:
+        print("REGRESSION: importing IEDC_tools loads %s. These should be imported lazily." % ', '.join(loaded))
+        startup_failed = True
+
+    config = {'rows': args.rows, 'empty_share': args.empty_share}
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        standin.create_standin_db(os.path.join(workdir, 'standin.db'))
+        standin.activate(os.path.join(workdir, 'standin.db'))
+        for name in args.scenarios:
+            runs = [run_scenario(name, SCENARIOS[name], args.rows, args.empty_share, workdir)
+                    for _ in range(args.repeat)]
+            results[name] = {stage: min(r[stage] for r in runs) for stage in STAGES + EXTRA_STAGES}
+            results[name]['total'] = sum(results[name][stage] for stage in STAGES)
+            results[name]['rows'] = runs[0]['rows']
+            results[name]['insert_rows_per_s'] = results[name]['rows'] / results[name]['insert']
+            results[name]['bulk_rows_per_s'] = results[name]['rows'] / results[name]['bulk_insert']
+        standin.deactivate()
+    table = pd.DataFrame(results).T
+    print(table.to_string(float_format=lambda x: '%.3f' % x))
+    for name, res in results.items():
+        print("Insert throughput %s: %.0f rows/s, bulk load %.0f rows/s (%+.0f%%)" %
+              (name, res['insert_rows_per_s'], res['bulk_rows_per_s'],
+               (res['bulk_rows_per_s'] / res['insert_rows_per_s'] - 1) * 100))
+
+    history = []
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            history = json.load(f)
+    previous = [h for h in history if h['config'] == config]
+    regressions = compare(results, previous[-1]['results'], args.threshold) if previous else []
+    for scenario, stage, old, new in regressions:
+        print("REGRESSION: %s / %s took %.3f s, previously %.3f s (+%.0f%%)" %
+              (scenario, stage, new, old, (new / old - 1) * 100))
+    history.append({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': git_revision(),
+                    'version': __version__, 'python': platform.python_version(), 'pandas': pd.__version__,
+                    'config': config, 'import_s': import_s, 'results': results})
+    os.makedirs(os.path.dirname(args.results), exist_ok=True)
+    with open(args.results, 'w') as f:
+        json.dump(history, f, indent=1)
+    return 1 if regressions or startup_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())